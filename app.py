@@ -1,27 +1,52 @@
+from __future__ import annotations  # 处理器的类型注解不在导入时求值（telegram 等依赖按需导入）
+
 import os
+import argparse
 import json
 import shutil
 import time
 import logging
-import magic
+import logging.handlers
+import queue
+import atexit
 import datetime
 import glob
-from functools import wraps
-from dotenv import load_dotenv
-from flask import Flask, render_template, request, jsonify, redirect, url_for, send_from_directory
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Updater, CommandHandler, CallbackContext, MessageHandler, Filters, CallbackQueryHandler
-from pyrogram import Client, errors
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.interval import IntervalTrigger
-from apscheduler.triggers.cron import CronTrigger
-from apscheduler.jobstores.base import JobLookupError
+import re
+import bisect
+import sqlite3
+import hashlib
+import hmac
+import secrets
+import asyncio
+import threading
+import signal
+import socket
+import subprocess
+import sys
+from collections import OrderedDict, deque
+try:
+    import fcntl  # session文件进程锁，仅类Unix系统可用
+except ImportError:
+    fcntl = None
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import wraps, lru_cache
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from telegram import Update
+    from telegram.ext import CallbackContext
+# pyrogram、python-telegram-bot、apscheduler、flask、magic、requests 在用到的函数内导入：
+# import app 只读取配置、定义函数，不加载这些依赖，也不创建目录、数据库和日志处理器，
+# 运行所需的初始化由 init_app()（存储、审计、关键词等）和 create_app()（Flask应用）完成
 
 # ======================== 初始化配置 ========================
-load_dotenv()
+if __name__ == "__main__":
+    # .env 只由入口加载（gunicorn 由 gunicorn.conf.py 加载），被导入时不修改环境变量
+    from dotenv import load_dotenv
+    load_dotenv()
 # 基础配置
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-API_ID = int(os.getenv("API_ID"))
+API_ID = int(os.getenv("API_ID") or 0)  # 在 main() 中按角色检查是否已配置
 API_HASH = os.getenv("API_HASH")
 BOT_USERNAME = os.getenv("BOT_USERNAME")
 FLASK_HOST = os.getenv("FLASK_HOST", "0.0.0.0")
@@ -32,69 +57,438 @@ DOMAIN = os.getenv("DOMAIN")
 MESSAGE_LIMIT = int(os.getenv("MESSAGE_LIMIT", 5))          # 每分钟最多发送消息数
 GROUP_MSG_LIMIT = int(os.getenv("GROUP_MSG_LIMIT", 20))     # 每天单群组最多发送消息数
 LOG_RETENTION_DAYS = int(os.getenv("LOG_RETENTION_DAYS", 30))# 日志保留天数
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")     # 限流存储：memory（单进程）/ sqlite（同一主机多进程共享）/ redis（多主机共享）
+REDIS_URL = os.getenv("REDIS_URL", "redis://127.0.0.1:6379/0")
+KEYWORDS_RELOAD_INTERVAL = int(os.getenv("KEYWORDS_RELOAD_INTERVAL", 5))  # 违规关键词文件检查间隔（秒）
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")  # 管理接口令牌（请求头 X-Admin-Token），为空时管理接口不可用
+
+# 上传配置
+MEDIA_UPLOAD_MAX_MB = int(os.getenv("MEDIA_UPLOAD_MAX_MB", 50))      # Web端单个媒体文件上限（MB）
+SESSION_UPLOAD_MAX_MB = int(os.getenv("SESSION_UPLOAD_MAX_MB", 1))   # Session文件上限（MB）
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", 4))             # 机器人媒体同时下载数
+DOWNLOAD_QUEUE_SIZE = int(os.getenv("DOWNLOAD_QUEUE_SIZE", 20))      # 排队等待下载的上限，超出时提示稍后再试
+DOWNLOAD_TIMEOUT = int(os.getenv("DOWNLOAD_TIMEOUT", 60))            # 下载连接/读取超时（秒）
+
+# 审计日志配置
+AUDIT_QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE", 10000))   # 待写入日志队列上限，满时丢弃并计数
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", 500))     # 单次批量写入的最大条数
+
+# 连接池配置
+CLIENT_POOL_SIZE = int(os.getenv("CLIENT_POOL_SIZE", 50))    # 同时保持的最大连接数
+CLIENT_IDLE_TTL = int(os.getenv("CLIENT_IDLE_TTL", 600))     # 空闲连接保留秒数
+
+# 群组权限缓存配置
+PEER_CACHE_TTL = int(os.getenv("PEER_CACHE_TTL", 21600))           # 群组访问校验结果缓存秒数
+PEER_CACHE_PERSIST = os.getenv("PEER_CACHE_PERSIST", "1") == "1"  # 是否持久化（重启后保留）
+PEER_CACHE_FLUSH_INTERVAL = 5  # 群组校验缓存批量写入数据库的间隔（秒）
+
+# 发送引擎配置
+SEND_ENGINE = os.getenv("SEND_ENGINE", "asyncio")               # asyncio：事件循环直接调度；thread：调度器线程池阻塞等待
+SEND_CONCURRENCY = int(os.getenv("SEND_CONCURRENCY", 200))      # 全局同时发送数
+ACCOUNT_CONCURRENCY = int(os.getenv("ACCOUNT_CONCURRENCY", 3))  # 单账号同时发送数
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 5))  # 广播任务同时发送的群组数（共用一个客户端）
+BROADCAST_MAX_TARGETS = int(os.getenv("BROADCAST_MAX_TARGETS", 100))  # 单个广播任务最多群组数
+
+# 多进程任务分片配置
+TASK_WORKERS = int(os.getenv("TASK_WORKERS", 1))                   # all 角色下启动的任务worker进程数，0为不在本机启动（由单独的 worker 角色执行）
+WORKER_HEARTBEAT_INTERVAL = int(os.getenv("WORKER_HEARTBEAT_INTERVAL", 5))  # worker心跳与任务同步间隔（秒）
+WORKER_TTL = int(os.getenv("WORKER_TTL", 20))                       # 超过该秒数无心跳的worker视为已退出
+
+# 进程角色配置
+APP_ROLE = os.getenv("APP_ROLE", "all")                 # all：机器人+Web+任务worker；bot / web / worker：只运行对应角色
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", 2))          # Web服务（gunicorn）工作进程数
+WEB_THREADS = int(os.getenv("WEB_THREADS", 4))          # 每个Web工作进程的线程数，慢速上传只占用其中一个
+SHUTDOWN_TIMEOUT = int(os.getenv("SHUTDOWN_TIMEOUT", 30))  # 退出时等待进行中的发送/请求完成的最长秒数
+
+# 机器人接收更新方式
+BOT_MODE = os.getenv("BOT_MODE", "polling")                 # polling：长轮询；webhook：Telegram 推送到Web服务（需 HTTPS 的 DOMAIN）
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")            # webhook 校验令牌（请求头 X-Telegram-Bot-Api-Secret-Token），1-256位字母数字_-
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 100))  # 待处理更新队列上限，满时返回503由Telegram稍后重试
 
 # 目录配置（适配Docker挂载）
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 SESSION_DIR = os.path.join(BASE_DIR, "data", "user_sessions")
-TASKS_FILE = os.path.join(BASE_DIR, "user_tasks.json")
+TASKS_FILE = os.path.join(BASE_DIR, "user_tasks.json")  # 旧版任务文件，仅用于一次性迁移
+DB_DIR = os.path.join(BASE_DIR, "data", "db")
+TASKS_DB = os.path.join(DB_DIR, "user_tasks.db")
+PEER_CACHE_DB = os.path.join(DB_DIR, "peer_cache.db")
+MEDIA_CACHE_DB = os.path.join(DB_DIR, "media_cache.db")
+MEDIA_STORE_DB = os.path.join(DB_DIR, "media_store.db")
+AUDIT_INDEX_DB = os.path.join(DB_DIR, "audit_index.db")
+RATE_LIMIT_DB = os.path.join(DB_DIR, "rate_limit.db")
+WORKERS_DB = os.path.join(DB_DIR, "workers.db")
 STATIC_DIR = os.path.join(BASE_DIR, "static")
 MEDIA_DIR = os.path.join(BASE_DIR, "data", "user_media")
-LOG_FILE = os.path.join(BASE_DIR, "data", "logs", "operation.log")
+MEDIA_BLOB_DIR = os.path.join(MEDIA_DIR, "blobs")  # 按SHA-256存放的媒体内容
+MEDIA_TMP_DIR = os.path.join(MEDIA_DIR, "tmp")     # 上传/下载中的临时文件
+LOG_DIR = os.path.join(BASE_DIR, "data", "logs")
+LOG_FILE = os.path.join(LOG_DIR, "operation.log")  # 旧版单文件日志，按天拆分后不再写入
 BANNED_KEYWORDS_FILE = os.path.join(BASE_DIR, "banned_keywords.txt")
-
-# 创建必要目录
-os.makedirs(SESSION_DIR, exist_ok=True)
-os.makedirs(STATIC_DIR, exist_ok=True)
-os.makedirs(MEDIA_DIR, exist_ok=True)
-os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+# 运行时目录（由 init_app() 创建）
+DATA_DIRS = (SESSION_DIR, STATIC_DIR, MEDIA_DIR, LOG_DIR, DB_DIR, MEDIA_BLOB_DIR, MEDIA_TMP_DIR)
 
 # ======================== 全局状态管理 ========================
-# 用户消息频率记录
-user_message_records = {}
 # 用户任务创建状态（按钮交互用）
 user_task_state = {}  # {user_id: {"step": 步骤, "temp_data": 临时数据}}
 # 用户任务数据
 user_tasks = {}
+# 任务反向索引（execute_task按任务ID直接定位）
+task_index = {}  # {task_id: (user_id, task_info)}
 
 # ======================== 安全合规核心配置 ========================
 # 1. 日志配置（操作审计，不记录敏感内容）
-logging.basicConfig(
-    filename=LOG_FILE,
-    format="%(asctime)s - user_id=%(user_id)s - operation=%(operation)s - result=%(result)s - detail=%(detail)s",
-    level=logging.INFO,
-    encoding="utf-8"
-)
+# 第三方库日志输出到标准错误（容器日志），审计日志由独立管道按天写入 LOG_DIR
+def setup_logging():
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO
+    )
+    # 调度器每个作业都会输出INFO日志且量大，只保留警告以上
+    logging.getLogger("apscheduler").setLevel(logging.WARNING)
+
+AUDIT_TIME_FORMAT = "%Y-%m-%d %H:%M:%S,%f"
+AUDIT_FIELDS = ("task_id", "chat_id", "latency_ms", "error")  # 可选的结构化字段
+
+def list_log_segments():
+    """返回所有按天分段 [(日期, 路径)]，按日期升序"""
+    segments = []
+    for path in glob.glob(os.path.join(LOG_DIR, "operation-*.*")):
+        name = os.path.splitext(os.path.basename(path))[0][len("operation-"):]
+        try:
+            segments.append((datetime.datetime.strptime(name, "%Y-%m-%d").date(), path))
+        except ValueError:
+            continue
+    return sorted(segments)
+
+class AuditLog:
+    """结构化审计日志：按天追加JSONL分段，SQLite索引记录每行的(日期, 用户, 操作)与文件偏移
+
+    查询用户历史时按索引分页定位到具体行读取，不扫描整个文件。
+    机器人、Web与各worker进程共用索引库：写入遇到锁等待最长30秒，仍失败时索引行留到下一批一起重试，
+    已写入分段的记录不会因此在历史查询中缺失。
+    """
+
+    MAX_UNINDEXED = 100000  # 等待重试的索引行上限，超出时丢弃最早的行
+
+    def __init__(self, log_dir, index_path):
+        self.log_dir = log_dir
+        self._lock = threading.Lock()
+        self._unindexed = []  # 分段已写入、索引写入失败待重试的行
+        self._conn = sqlite3.connect(index_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS audit_index (
+                id        INTEGER PRIMARY KEY AUTOINCREMENT,
+                day       TEXT NOT NULL,
+                user_id   TEXT NOT NULL,
+                operation TEXT NOT NULL,
+                result    TEXT NOT NULL,
+                ts        REAL NOT NULL,
+                offset    INTEGER NOT NULL,
+                length    INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_audit_user ON audit_index(user_id, ts);
+            CREATE INDEX IF NOT EXISTS idx_audit_user_op ON audit_index(user_id, operation, ts);
+            CREATE INDEX IF NOT EXISTS idx_audit_day ON audit_index(day, operation);
+        """)
+
+    def segment_path(self, day):
+        return os.path.join(self.log_dir, f"operation-{day}.jsonl")
+
+    def append(self, records):
+        """追加一批记录（dict，需含 ts），每个分段一次写入，索引一次事务提交"""
+        by_day = {}
+        for record in records:
+            day = datetime.date.fromtimestamp(record["ts"]).isoformat()
+            by_day.setdefault(day, []).append(record)
+        with self._lock:
+            rows = []
+            for day, day_records in by_day.items():
+                lines = [(json.dumps(r, ensure_ascii=False) + "\n").encode("utf-8") for r in day_records]
+                with open(self.segment_path(day), "ab") as f:
+                    # 多进程（任务worker）共用分段文件：加文件锁后再取末尾偏移，保证索引偏移准确
+                    if fcntl is not None:
+                        fcntl.flock(f, fcntl.LOCK_EX)
+                    f.seek(0, os.SEEK_END)
+                    offset = f.tell()
+                    f.write(b"".join(lines))
+                    f.flush()
+                for record, line in zip(day_records, lines):
+                    rows.append((day, str(record.get("user_id")), record.get("operation", ""),
+                                 record.get("result", ""), record["ts"], offset, len(line)))
+                    offset += len(line)
+            self._unindexed.extend(rows)
+            self._flush_index()
+
+    def flush_index(self):
+        """重试写入之前失败的索引行（写入线程退出前调用），返回仍未写入的行数"""
+        with self._lock:
+            if self._unindexed:
+                self._flush_index()
+            return len(self._unindexed)
+
+    def _flush_index(self):
+        """把待写入的索引行在一个事务中提交（需持有 self._lock）；失败时保留到下次重试"""
+        rows = self._unindexed
+        try:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO audit_index (day, user_id, operation, result, ts, offset, length) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error:
+            overflow = len(rows) - self.MAX_UNINDEXED
+            if overflow > 0:
+                del rows[:overflow]
+                AUDIT_LOG_DROPPED.inc("index_failed", amount=overflow)
+            logging.getLogger("app").warning("审计日志索引写入失败，%d条记录留待下一批重试", len(rows), exc_info=True)
+            return
+        self._unindexed = []
+
+    def query(self, user_id, operations=None, day=None, before=None, limit=20):
+        """按时间倒序分页查询用户记录，返回 (记录列表, 下一页游标)；before 为上一页返回的游标（记录行号）"""
+        sql = "SELECT id, day, offset, length FROM audit_index WHERE user_id = ?"
+        params = [str(user_id)]
+        if operations:
+            sql += f" AND operation IN ({','.join('?' * len(operations))})"
+            params.extend(operations)
+        if day:
+            sql += " AND day = ?"
+            params.append(day)
+        if before:
+            # 旧日志转换写入的记录行号较大，按 (时间, 行号) 定位游标之后的记录
+            sql += " AND (ts, id) < (SELECT ts, id FROM audit_index WHERE id = ?)"
+            params.append(int(before))
+        sql += " ORDER BY ts DESC, id DESC LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+
+        records, handles = [], {}
+        try:
+            for _, row_day, offset, length in rows:
+                if row_day not in handles:
+                    path = self.segment_path(row_day)
+                    handles[row_day] = open(path, "rb") if os.path.exists(path) else None
+                f = handles[row_day]
+                if f is None:
+                    continue
+                f.seek(offset)
+                try:
+                    records.append(json.loads(f.read(length)))
+                except ValueError:
+                    continue
+        finally:
+            for f in handles.values():
+                if f:
+                    f.close()
+        next_cursor = rows[-1][0] if len(rows) == limit else None
+        return records, next_cursor
+
+    def delete_before(self, cutoff_day):
+        """整段删除 cutoff_day 之前的分段及其索引，返回删除的分段数"""
+        removed = 0
+        with self._lock:
+            for day, path in list_log_segments():
+                if day >= cutoff_day:
+                    break
+                os.remove(path)
+                removed += 1
+            self._conn.execute("DELETE FROM audit_index WHERE day < ?", (cutoff_day.isoformat(),))
+        return removed
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """非阻塞入队：队列已满时丢弃记录并计数，调用方不等待磁盘I/O"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def prepare(self, record):
+        # 审计记录不带参数和异常信息，无需在调用线程格式化/复制
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            AUDIT_LOG_DROPPED.inc("queue_full")
+
+class AuditLogWriter:
+    """审计日志批量写入线程：取出队列中已积压的记录，转换为JSON后批量交给 AuditLog 追加
+
+    负载越高单批越大，每个分段每批只有一次 write/flush；丢弃计数变化时补记一条说明。
+    """
+
+    _STOP = object()
+
+    def __init__(self, log_queue, audit_log, handler, batch_size=500):
+        self.queue = log_queue
+        self.audit_log = audit_log
+        self.handler = handler
+        self.batch_size = batch_size
+        self.written = 0
+        self._reported_dropped = 0
+        self._thread = threading.Thread(target=self._run, name="audit-log", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        """写完队列中剩余的记录后退出"""
+        if not self._thread.is_alive():
+            return
+        try:
+            self.queue.put(self._STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
 
-def log_operation(user_id, operation, result, detail=""):
-    """记录用户操作日志"""
-    extra = {
-        'user_id': user_id,
-        'operation': operation,
-        'result': result,
-        'detail': detail[:200]  # 限制详情长度
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = self._next_batch()
+            if self._STOP in batch:
+                stopping = True
+                batch = [record for record in batch if record is not self._STOP]
+            records = [record.audit for record in batch]
+            dropped = self.handler.dropped
+            if dropped > self._reported_dropped:
+                records.append(audit_record("system", "audit_log", "dropped", f"队列已满，累计丢弃{dropped}条日志"))
+                self._reported_dropped = dropped
+            if not records:
+                continue
+            try:
+                self.audit_log.append(records)
+                self.written += len(records)
+            except (OSError, sqlite3.Error):
+                AUDIT_LOG_DROPPED.inc("write_failed", amount=len(records))
+                logging.getLogger("app").exception("审计日志写入失败，丢弃%d条记录", len(records))
+        unindexed = self.audit_log.flush_index()
+        if unindexed:
+            AUDIT_LOG_DROPPED.inc("index_failed", amount=unindexed)
+            logging.getLogger("app").error("审计日志索引写入失败，退出时仍有%d条记录未写入索引", unindexed)
+
+
+audit_queue = queue.Queue(maxsize=AUDIT_QUEUE_SIZE)
+audit_handler = DroppingQueueHandler(audit_queue)
+audit_logger = logging.getLogger("audit")
+audit_logger.setLevel(logging.INFO)
+audit_logger.propagate = False
+audit_log = None     # 由 init_app() 创建，同时挂载 audit_handler 并启动写入线程
+audit_writer = None
+
+def audit_record(user_id, operation, result, detail="", **fields):
+    """构造审计记录，只保留有值的结构化字段（task_id/chat_id/latency_ms/error）"""
+    record = {
+        "user_id": str(user_id),
+        "operation": operation,
+        "result": result,
+        "detail": detail[:500],  # 限制详情长度，结构化信息放在独立字段
     }
-    logging.info("", extra=extra)
+    for key in AUDIT_FIELDS:
+        value = fields.get(key)
+        if value is not None:
+            record[key] = value
+    now = time.time()
+    record["ts"] = now
+    record["time"] = datetime.datetime.fromtimestamp(now).strftime(AUDIT_TIME_FORMAT)[:-3]
+    return record
+
+def elapsed_ms(started):
+    """从 time.monotonic() 起点到现在的毫秒数"""
+    return round((time.monotonic() - started) * 1000, 1)
+
+def log_operation(user_id, operation, result, detail="", **fields):
+    """记录用户操作日志（只入队，由 audit_writer 批量写入）
+
+    fields 支持 task_id、chat_id、latency_ms、error（异常类名），便于按字段查询。
+    """
+    audit_logger.info("", extra={"audit": audit_record(user_id, operation, result, detail, **fields)})
 
 # 2. 清理过期日志
+LOG_COMPACT_BATCH = 1000  # 转换旧日志时每批追加的记录数
+LEGACY_LOG_LINE = re.compile(
+    r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}) - user_id=(.*?) - operation=(.*?) - result=(.*?) - detail=(.*)$"
+)
+
+def compact_legacy_log(cutoff_day):
+    """把旧版单文件 operation.log 逐行转换为结构化记录写入按天分段，丢弃 cutoff_day 之前的记录
+
+    先改名再读取，写入线程早已不写该文件，转换期间不会丢失新日志；
+    逐行流式处理，内存只占一批记录。返回保留的记录数。
+    """
+    compacting = LOG_FILE + ".compacting"
+    # 上次转换中断时先处理遗留的文件，下次清理再处理新的旧版日志
+    if not os.path.exists(compacting) and os.path.exists(LOG_FILE):
+        os.replace(LOG_FILE, compacting)
+    if not os.path.exists(compacting):
+        return 0
+
+    batch, kept = [], 0
+    record = None
+    # 没有时间戳的开头几行（如多行异常）归入文件修改时间
+    fallback_ts = os.path.getmtime(compacting)
+
+    def emit(record):
+        nonlocal batch, kept
+        if record is None or datetime.date.fromtimestamp(record["ts"]) < cutoff_day:
+            return
+        batch.append(record)
+        kept += 1
+        if len(batch) >= LOG_COMPACT_BATCH:
+            audit_log.append(batch)
+            batch = []
+
+    with open(compacting, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            match = LEGACY_LOG_LINE.match(line)
+            if match:
+                emit(record)
+                log_time, user_id, operation, result, detail = match.groups()
+                log_dt = datetime.datetime.strptime(log_time, AUDIT_TIME_FORMAT)
+                record = {"user_id": user_id, "operation": operation, "result": result,
+                          "detail": detail, "ts": log_dt.timestamp(), "time": log_time.replace(",", ".")}
+            elif record is not None:
+                record["detail"] += "\n" + line  # 续行跟随上一条记录
+            elif line:
+                record = {"user_id": "system", "operation": "legacy_log", "result": "", "detail": line,
+                          "ts": fallback_ts, "time": datetime.datetime.fromtimestamp(fallback_ts).strftime(AUDIT_TIME_FORMAT)[:-3]}
+    emit(record)
+    if batch:
+        audit_log.append(batch)
+    os.remove(compacting)
+    return kept
+
 def clean_expired_logs():
-    """清理超过保留天数的日志"""
+    """清理超过保留天数的日志：整段删除过期的按天分段及索引，旧版单文件日志流式转换"""
     try:
-        cutoff_date = datetime.datetime.now() - datetime.timedelta(days=LOG_RETENTION_DAYS)
-        with open(LOG_FILE, "r", encoding="utf-8") as f:
-            lines = f.readlines()
-        with open(LOG_FILE, "w", encoding="utf-8") as f:
-            for line in lines:
-                if " - user_id=" not in line:
-                    f.write(line)
-                    continue
-                log_time_str = line.split(" - ")[0]
-                try:
-                    log_time = datetime.datetime.strptime(log_time_str, "%Y-%m-%d %H:%M:%S,%f")
-                    if log_time >= cutoff_date:
-                        f.write(line)
-                except:
-                    f.write(line)
-        log_operation("system", "clean_logs", "success", f"清理了{LOG_RETENTION_DAYS}天前的日志")
+        cutoff_day = datetime.date.today() - datetime.timedelta(days=LOG_RETENTION_DAYS)
+        compacted = compact_legacy_log(cutoff_day)
+        removed = audit_log.delete_before(cutoff_day)
+        detail = f"删除了{removed}个{LOG_RETENTION_DAYS}天前的日志分段"
+        if compacted:
+            detail += f"，旧日志转换保留{compacted}条"
+        log_operation("system", "clean_logs", "success", detail)
     except Exception as e:
         log_operation("system", "clean_logs", "failed", str(e))
 
@@ -105,241 +499,2511 @@ def load_banned_keywords():
         with open(BANNED_KEYWORDS_FILE, "r", encoding="utf-8") as f:
             return [line.strip() for line in f if line.strip()]
     return []
-BANNED_KEYWORDS = load_banned_keywords()
+BANNED_KEYWORDS = []  # 由 init_app() 加载
+
+class KeywordMatcher:
+    """Aho–Corasick 多模式匹配：关键词一次性编译为自动机，单次扫描找出所有命中"""
+
+    # 关键词很少时，逐个子串查找（C实现）比Python逐字符扫描更快
+    SMALL_SET_SIZE = 128
+
+    def __init__(self, keywords):
+        self.keywords = []
+        self._goto = [{}]     # 状态转移表：state -> {字符: 下一状态}
+        self._fail = [0]      # 失败指针
+        self._output = [()]   # 每个状态命中的关键词下标（含失败链上的）
+        for keyword in keywords:
+            if keyword:
+                self._add(keyword)
+        self._build()
+
+    def __len__(self):
+        return len(self.keywords)
+
+    def _add(self, keyword):
+        state = 0
+        for ch in keyword:
+            next_state = self._goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][ch] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(())
+            state = next_state
+        if not self._output[state]:
+            self._output[state] = (len(self.keywords),)
+            self.keywords.append(keyword)
+
+    def _build(self):
+        """按BFS顺序计算失败指针，并把失败链上的命中合并到当前状态"""
+        queue = list(self._goto[0].values())
+        head = 0
+        while head < len(queue):
+            state = queue[head]
+            head += 1
+            for ch, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail_target = self._goto[fail].get(ch, 0)
+                self._fail[next_state] = fail_target if fail_target != next_state else 0
+                if self._output[self._fail[next_state]]:
+                    self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def _scan(self, text):
+        """逐字符扫描，产出 (结束位置, 命中关键词下标元组)"""
+        goto, fail, output = self._goto, self._fail, self._output
+        root = goto[0]
+        state = 0
+        for pos, ch in enumerate(text):
+            if state == 0 and ch not in root:
+                continue
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                yield pos, output[state]
+
+    def search(self, text):
+        """返回第一个命中的 (起始位置, 关键词)，无命中返回 None"""
+        if not text or not self.keywords:
+            return None
+        if len(self.keywords) <= self.SMALL_SET_SIZE:
+            hits = [(text.find(keyword), keyword) for keyword in self.keywords if keyword in text]
+            return min(hits) if hits else None
+        for pos, matched in self._scan(text):
+            keyword = self.keywords[matched[0]]
+            return pos - len(keyword) + 1, keyword
+        return None
+
+    def find_all(self, text):
+        """返回所有命中的 [(起始位置, 关键词)]，按结束位置排序"""
+        if not text or not self.keywords:
+            return []
+        result = []
+        for pos, matched in self._scan(text):
+            for index in matched:
+                keyword = self.keywords[index]
+                result.append((pos - len(keyword) + 1, keyword))
+        return result
+
+keyword_matcher = KeywordMatcher(BANNED_KEYWORDS)  # init_app() 加载关键词后替换
+
+def _keywords_file_signature():
+    """关键词文件的 (mtime_ns, size)，文件不存在时返回 None"""
+    try:
+        stat = os.stat(BANNED_KEYWORDS_FILE)
+        return stat.st_mtime_ns, stat.st_size
+    except OSError:
+        return None
+
+_keywords_signature = None
+
+def reload_banned_keywords(force=False):
+    """关键词文件变化时重建匹配器并原子替换（由后台定时任务调用，不占用发送路径）"""
+    global BANNED_KEYWORDS, keyword_matcher, _keywords_signature
+    signature = _keywords_file_signature()
+    if not force and signature == _keywords_signature:
+        return False
+    # 文件刚被修改，可能还在写入，留到下一轮再加载
+    if signature and time.time() - signature[0] / 1e9 < 1:
+        return False
+    try:
+        keywords = load_banned_keywords()
+        matcher = KeywordMatcher(keywords)
+    except Exception as e:
+        log_operation("system", "reload_keywords", "failed", str(e))
+        return False
+    # 构建完成后一次性替换引用，正在执行的 check_content 仍使用旧匹配器
+    BANNED_KEYWORDS, keyword_matcher, _keywords_signature = keywords, matcher, signature
+    log_operation("system", "reload_keywords", "success", f"加载{len(matcher)}个关键词")
+    return True
+
+# 4. 频率限制（滑动窗口，存储可替换）
+class MemoryRateStore:
+    """进程内滑动窗口存储：按key分段加锁，空闲的计数桶定期淘汰"""
+
+    blocking = False  # 只有内存操作，可直接在事件循环中调用
+
+    def __init__(self, stripes=64):
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        self._buckets = {}  # {key: (window, deque[发送时间戳])}
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _lock_for(self, key):
+        return self._locks[hash(key) % len(self._locks)]
+
+    def _locks_for(self, rules):
+        return [lock for _, lock in sorted({id(lock): lock for lock in (self._lock_for(key) for key, _, _ in rules)}.items())]
+
+    def hit(self, rules, now, record=True):
+        """rules=[(key, limit, window)]，全部未超限时（record=True）为每个key记一次
+
+        返回 (是否放行, 需等待秒数, 超限的规则下标, 本次记录的标识)
+        """
+        locks = self._locks_for(rules)
+        for lock in locks:
+            lock.acquire()
+        try:
+            buckets = []
+            for index, (key, limit, window) in enumerate(rules):
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = self._buckets.setdefault(key, (window, deque()))
+                timestamps = bucket[1]
+                while timestamps and timestamps[0] <= now - window:
+                    timestamps.popleft()
+                if len(timestamps) >= limit:
+                    return False, timestamps[0] + window - now, index, None
+                buckets.append(timestamps)
+            if record:
+                for timestamps in buckets:
+                    timestamps.append(now)
+            return True, 0, None, now
+        finally:
+            for lock in locks:
+                lock.release()
+
+    def release(self, rules, token):
+        """撤销一次 hit 的记录"""
+        locks = self._locks_for(rules)
+        for lock in locks:
+            lock.acquire()
+        try:
+            for key, _, _ in rules:
+                bucket = self._buckets.get(key)
+                if bucket is not None:
+                    try:
+                        bucket[1].remove(token)
+                    except ValueError:
+                        pass
+        finally:
+            for lock in locks:
+                lock.release()
+
+    def evict_idle(self, now=None):
+        """移除窗口内已无记录的计数桶，返回移除数量"""
+        now = now or time.time()
+        removed = 0
+        for key, (window, timestamps) in list(self._buckets.items()):
+            if timestamps and timestamps[-1] > now - window:
+                continue
+            with self._lock_for(key):
+                bucket = self._buckets.get(key)
+                if bucket and (not bucket[1] or bucket[1][-1] <= now - bucket[0]):
+                    del self._buckets[key]
+                    removed += 1
+        return removed
+
+class RedisRateStore:
+    """Redis（或兼容协议的本地服务）滑动窗口存储，多个工作进程共享限额
+
+    每个key是一个有序集合，检查与记录在同一个Lua脚本中原子完成，key过期后自动回收。
+    """
+
+    blocking = True  # 网络请求，事件循环中经线程调用
+
+    SCRIPT = """
+    local now = tonumber(ARGV[1])
+    local member = ARGV[2]
+    local record = ARGV[3] == '1'
+    for i, key in ipairs(KEYS) do
+        local limit = tonumber(ARGV[2 + i * 2])
+        local window = tonumber(ARGV[3 + i * 2])
+        redis.call('ZREMRANGEBYSCORE', key, '-inf', now - window)
+        if redis.call('ZCARD', key) >= limit then
+            local oldest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+            return {0, tostring(tonumber(oldest[2]) + window - now), i - 1}
+        end
+    end
+    if record then
+        for i, key in ipairs(KEYS) do
+            redis.call('ZADD', key, now, member)
+            redis.call('EXPIRE', key, math.ceil(tonumber(ARGV[3 + i * 2])))
+        end
+    end
+    return {1, '0', -1}
+    """
+
+    def __init__(self, url):
+        import redis  # 可选依赖，仅在使用Redis后端时需要
+        self._redis = redis.Redis.from_url(url)
+        self._script = self._redis.register_script(self.SCRIPT)
+        self._seq = 0
+
+    def __len__(self):
+        return 0  # 计数桶由Redis按过期时间回收，不占用进程内存
+
+    def hit(self, rules, now, record=True):
+        self._seq += 1
+        member = f"{now:.6f}:{os.getpid()}:{threading.get_ident()}:{self._seq}"
+        args = [now, member, "1" if record else "0"]
+        for _, limit, window in rules:
+            args.extend([limit, window])
+        allowed, retry_after, index = self._script(keys=[key for key, _, _ in rules], args=args)
+        if not allowed:
+            return False, float(retry_after), index, None
+        return True, 0, None, member
+
+    def release(self, rules, token):
+        pipe = self._redis.pipeline()
+        for key, _, _ in rules:
+            pipe.zrem(key, token)
+        pipe.execute()
+
+    def evict_idle(self, now=None):
+        return 0
+
+class SqliteRateStore:
+    """SQLite滑动窗口存储：同一主机上的多个进程共享计数（多worker模式下账号换手后限额仍然准确）
+
+    记录名额的 hit 在一个 BEGIN IMMEDIATE 事务内完成检查与记录，进程间串行；只检查（record=False）时直接读取，不占写锁。
+    """
+
+    blocking = True  # 写事务可能等待其他进程（最长30秒），事件循环中经线程调用
+
+    def __init__(self, db_path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS rate_events (
+                key   TEXT NOT NULL,
+                ts    REAL NOT NULL,
+                token TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_rate_events_key_ts ON rate_events(key, ts);
+            CREATE INDEX IF NOT EXISTS idx_rate_events_token ON rate_events(token);
+        """)
+        self._seq = 0
+
+    def __len__(self):
+        return 0  # 计数保存在数据库中，不占用进程内存
+
+    def _exceeded(self, rules, now):
+        """返回第一条超限的规则 (下标, 需等待秒数)，都未超限时返回 None"""
+        for index, (key, limit, window) in enumerate(rules):
+            count = self._conn.execute(
+                "SELECT COUNT(*) FROM rate_events WHERE key = ? AND ts > ?", (key, now - window)
+            ).fetchone()[0]
+            if count >= limit:
+                # 窗口内最早的、使计数回到限额以下的那条记录过期后才有空闲名额
+                oldest = self._conn.execute(
+                    "SELECT ts FROM rate_events WHERE key = ? AND ts > ? ORDER BY ts LIMIT 1 OFFSET ?",
+                    (key, now - window, count - limit)
+                ).fetchone()[0]
+                return index, oldest + window - now
+        return None
+
+    def hit(self, rules, now, record=True):
+        if not record:
+            with self._lock:
+                exceeded = self._exceeded(rules, now)
+            return (True, 0, None, None) if exceeded is None else (False, exceeded[1], exceeded[0], None)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                exceeded = self._exceeded(rules, now)
+                if exceeded is not None:
+                    self._conn.execute("COMMIT")
+                    return False, exceeded[1], exceeded[0], None
+                token = None
+                if record:
+                    self._seq += 1
+                    token = f"{now:.6f}:{os.getpid()}:{self._seq}"
+                    self._conn.executemany(
+                        "INSERT INTO rate_events (key, ts, token) VALUES (?, ?, ?)",
+                        [(key, now, token) for key, _, _ in rules]
+                    )
+                self._conn.execute("COMMIT")
+                return True, 0, None, token
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def release(self, rules, token):
+        with self._lock:
+            self._conn.execute("DELETE FROM rate_events WHERE token = ?", (token,))
+
+    def evict_idle(self, now=None):
+        """删除超过最长窗口（1天）的记录，返回删除数量"""
+        now = now or time.time()
+        with self._lock:
+            return self._conn.execute("DELETE FROM rate_events WHERE ts <= ?", (now - 86400,)).rowcount
+
+class RateReservation:
+    """预占的发送名额：发送成功后 commit 保留，失败时 release 归还"""
+
+    def __init__(self, store, rules, token):
+        self._store = store
+        self._rules = rules
+        self._token = token
+        self._done = False
+
+    def commit(self):
+        self._done = True
+
+    def release(self):
+        if not self._done:
+            self._done = True
+            self._store.release(self._rules, self._token)
+
+class RateLimiter:
+    """消息发送频率限制：每账号每分钟 MESSAGE_LIMIT 条，每账号每群组每天 GROUP_MSG_LIMIT 条
+
+    发送前 reserve 预占名额，确认送达后 commit，失败（内容违规、群组不存在等）时 release，
+    只有真正发出的消息才计入限额；调度器可先用 check 判断是否有空闲名额。
+    """
+
+    def __init__(self, store, per_minute=MESSAGE_LIMIT, per_chat_daily=GROUP_MSG_LIMIT):
+        self.store = store
+        self.per_minute = per_minute
+        self.per_chat_daily = per_chat_daily
+
+    def _rules(self, user_id, chat_id):
+        return [
+            (f"rl:user:{user_id}", self.per_minute, 60),
+            (f"rl:chat:{user_id}:{chat_id}", self.per_chat_daily, 86400),
+        ]
+
+    async def run(self, func, *args):
+        """在事件循环中调用限流方法：存储会阻塞（SQLite/Redis）时放到线程中执行，进程内存储直接调用"""
+        if self.store.blocking:
+            return await asyncio.to_thread(func, *args)
+        return func(*args)
+
+    def check(self, user_id, chat_id, now=None):
+        """只检查不记录，返回 (是否有空闲名额, 距下一个空闲名额的秒数)"""
+        allowed, retry_after, _, _ = self.store.hit(self._rules(user_id, chat_id), now or time.time(), record=False)
+        return allowed, retry_after
+
+    def try_reserve(self, user_id, chat_id, now=None):
+        """预占一次发送名额，返回 (RateReservation 或 None, 超限规则 per_minute/per_chat_daily, 距空闲名额秒数)"""
+        rules = self._rules(user_id, chat_id)
+        allowed, retry_after, index, token = self.store.hit(rules, now or time.time())
+        if allowed:
+            return RateReservation(self.store, rules, token), None, 0
+        return None, "per_minute" if index == 0 else "per_chat_daily", retry_after
+
+    def reserve(self, user_id, chat_id, now=None):
+        """预占一次发送名额，返回 (RateReservation 或 None, 提示信息)"""
+        reservation, rule, _ = self.try_reserve(user_id, chat_id, now)
+        if reservation is not None:
+            return reservation, ""
+        if rule == "per_minute":
+            RATE_LIMIT_REJECTIONS.inc("per_minute")
+            log_operation(str(user_id), "send_message", "failed", f"频率超限：每分钟最多{self.per_minute}条")
+            return None, f"发送频率过高，请1分钟后再试（每分钟最多{self.per_minute}条）"
+        RATE_LIMIT_REJECTIONS.inc("per_chat_daily")
+        log_operation(str(user_id), "send_message", "failed", f"群组消息超限：每天单群组最多{self.per_chat_daily}条")
+        return None, f"向该群组发送消息过多，请明天再试（每天最多{self.per_chat_daily}条）"
+
+def create_rate_store():
+    """按 RATE_LIMIT_BACKEND 创建限流存储"""
+    if RATE_LIMIT_BACKEND == "redis":
+        return RedisRateStore(REDIS_URL)
+    if RATE_LIMIT_BACKEND == "sqlite":
+        return SqliteRateStore(RATE_LIMIT_DB)
+    return MemoryRateStore()
+
+rate_limiter = None  # 由 init_app() 创建（Redis/SQLite 后端会在创建时连接）
 
-# 4. 频率限制装饰器
 def rate_limit(func):
-    """消息发送频率限制"""
+    """消息发送频率限制：预占名额，发送成功才计入"""
     @wraps(func)
-    def wrapper(user_id, chat_id, *args, **kwargs):
-        now = time.time()
-        user_id_str = str(user_id)
-        chat_id_str = str(chat_id)
-        
-        if user_id_str not in user_message_records:
-            user_message_records[user_id_str] = {
-                "last_time": now,
-                "count": 0,
-                "group_counts": {},
-                "group_reset_time": now
-            }
-        
-        user_record = user_message_records[user_id_str]
-        
-        # 重置每天的群组计数
-        if now - user_record["group_reset_time"] > 86400:
-            user_record["group_counts"] = {}
-            user_record["group_reset_time"] = now
-        
-        # 每分钟消息数限制
-        if now - user_record["last_time"] < 60:
-            user_record["count"] += 1
-            if user_record["count"] > MESSAGE_LIMIT:
-                log_operation(user_id_str, "send_message", "failed", f"频率超限：每分钟最多{MESSAGE_LIMIT}条")
-                return False, f"发送频率过高，请1分钟后再试（每分钟最多{MESSAGE_LIMIT}条）"
+    async def wrapper(user_id, chat_id, *args, **kwargs):
+        reservation, msg = await rate_limiter.run(rate_limiter.reserve, str(user_id), str(chat_id))
+        if reservation is None:
+            return False, msg
+        try:
+            success, msg = await func(user_id, chat_id, *args, **kwargs)
+        except BaseException:
+            await rate_limiter.run(reservation.release)
+            raise
+        if success:
+            reservation.commit()
         else:
-            user_record["count"] = 1
-            user_record["last_time"] = now
-        
-        # 每天单群组消息数限制
-        if chat_id_str not in user_record["group_counts"]:
-            user_record["group_counts"][chat_id_str] = 0
-        user_record["group_counts"][chat_id_str] += 1
-        if user_record["group_counts"][chat_id_str] > GROUP_MSG_LIMIT:
-            log_operation(user_id_str, "send_message", "failed", f"群组消息超限：每天单群组最多{GROUP_MSG_LIMIT}条")
-            return False, f"向该群组发送消息过多，请明天再试（每天最多{GROUP_MSG_LIMIT}条）"
-        
-        return func(user_id, chat_id, *args, **kwargs)
+            await rate_limiter.run(reservation.release)
+        return success, msg
     return wrapper
 
-# 5. 内容风控
-def check_content(content):
-    """检查内容是否包含违规关键词"""
-    if not content:
-        return True, "内容合规"
-    for keyword in BANNED_KEYWORDS:
-        if keyword in content:
-            return False, f"内容包含违规关键词：{keyword}"
-    return True, "内容合规"
+# 5. 内容风控
+def check_content(content):
+    """检查内容是否包含违规关键词（单次扫描）"""
+    if not content:
+        return True, "内容合规"
+    matched = keyword_matcher.search(content)
+    if matched:
+        CONTENT_REJECTIONS.inc()
+        return False, f"内容包含违规关键词：{matched[1]}"
+    return True, "内容合规"
+
+# 6. 文件权限设置
+def set_file_permission(file_path):
+    """设置文件权限为600"""
+    try:
+        os.chmod(file_path, 0o600)
+        return True
+    except:
+        return False
+
+# ======================== 运行指标 ========================
+class Counter:
+    """计数器（Prometheus counter），按标签值元组分别累加"""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name, self.help, self.labels = name, help_text, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self, const_names=(), const_values=()):
+        with self._lock:
+            items = list(self._values.items())
+        names = const_names + self.labels
+        return [f"{self.name}{format_labels(names, const_values + label_values)} {value}" for label_values, value in items]
+
+class Histogram:
+    """直方图（Prometheus histogram）：observe 只做一次二分查找和三次累加，输出时再累计各桶"""
+
+    kind = "histogram"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name, self.help, self.labels = name, help_text, tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # {标签值: [各桶计数..., +Inf桶计数, 总和]}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self, const_names=(), const_values=()):
+        lines = []
+        with self._lock:
+            items = [(label_values, list(counts)) for label_values, counts in self._values.items()]
+        names = const_names + self.labels
+        for label_values, counts in items:
+            label_values = const_values + label_values
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts[:-1]):
+                cumulative += count
+                labels = format_labels(names + ("le",), label_values + (str(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            base = format_labels(names, label_values)
+            lines.append(f"{self.name}_sum{base} {counts[-1]}")
+            lines.append(f"{self.name}_count{base} {cumulative}")
+        return lines
+
+class Gauge:
+    """瞬时值（Prometheus gauge），输出时调用 func 读取，不在热路径上维护"""
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, func):
+        self.name, self.help, self.func = name, help_text, func
+
+    def samples(self, const_names=(), const_values=()):
+        try:
+            value = self.func()
+        except Exception:
+            return []
+        return [f"{self.name}{format_labels(const_names, const_values)} {value}"]
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def samples(self, const_names=(), const_values=()):
+        """本进程各指标的样本行 {指标名: [样本行]}；const_* 为附加到每个样本的标签（多进程发布时区分进程）"""
+        return {metric.name: metric.samples(const_names, const_values) for metric in self._metrics}
+
+    def render(self, parts=None):
+        """输出 Prometheus 文本；parts 为多个进程的样本（同名指标合并在同一组 HELP/TYPE 下），默认只输出本进程"""
+        if parts is None:
+            parts = [self.samples()]
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for part in parts:
+                lines.extend(part.get(metric.name, ()))
+        return "\n".join(lines) + "\n"
+
+class MetricsSnapshotStore:
+    """各进程发布的指标样本（SQLite）：发送与调度发生在 worker 进程，Web进程的 /metrics 从这里汇总输出
+
+    每个进程一行，随心跳整体覆盖；超过 max_age 未更新的进程（已崩溃）不再输出。
+    """
+
+    def __init__(self, db_path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS metric_snapshots (
+                process    TEXT PRIMARY KEY,
+                samples    TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+
+    def publish(self, process, samples):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO metric_snapshots (process, samples, updated_at) VALUES (?, ?, ?)",
+                (process, json.dumps(samples, ensure_ascii=False), time.time())
+            )
+
+    def collect(self, max_age):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT samples FROM metric_snapshots WHERE updated_at > ? ORDER BY process", (time.time() - max_age,)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def remove(self, process):
+        with self._lock:
+            self._conn.execute("DELETE FROM metric_snapshots WHERE process = ?", (process,))
+
+metrics = MetricsRegistry()
+TASK_RUNS = metrics.register(Counter("tg_task_runs_total", "定时任务执行次数", ("type", "result")))
+TASK_DURATION = metrics.register(Histogram("tg_task_duration_seconds", "定时任务执行耗时（含等待发送名额）", ("type",)))
+SEND_LATENCY = metrics.register(Histogram("tg_send_latency_seconds", "发送RPC耗时（含群组校验）", ("method", "result")))
+CLIENT_CONNECT = metrics.register(Histogram("tg_client_connect_seconds", "用户客户端启动/连接耗时"))
+RATE_LIMIT_REJECTIONS = metrics.register(Counter("tg_rate_limit_rejections_total", "发送频率限制拒绝次数", ("rule",)))
+CONTENT_REJECTIONS = metrics.register(Counter("tg_content_rejections_total", "内容风控拒绝次数"))
+SCHEDULER_MISFIRES = metrics.register(Counter("tg_scheduler_misfires_total", "超过宽限时间被跳过的任务次数"))
+SCHEDULER_LAG = metrics.register(Histogram("tg_scheduler_lag_seconds", "任务计划时间到提交执行的延迟"))
+JOB_START_LAG = metrics.register(Histogram("tg_job_start_lag_seconds", "任务计划时间到实际开始执行的延迟（含线程池排队）"))
+SCHEDULER_SKIPPED = metrics.register(Counter("tg_scheduler_skipped_total", "上一次执行未结束（达到最大实例数）被跳过的次数"))
+WEBHOOK_UPDATES = metrics.register(Counter("tg_webhook_updates_total", "webhook 收到的更新数", ("result",)))
+AUDIT_LOG_DROPPED = metrics.register(Counter("tg_audit_log_dropped_total", "丢弃的审计日志数（队列已满/写入失败/索引写入失败）", ("reason",)))
+metrics.register(Gauge("tg_tasks", "内存中的任务数", lambda: len(task_index)))
+metrics.register(Gauge("tg_task_users", "有任务的用户数", lambda: len(user_tasks)))
+metrics.register(Gauge("tg_rate_limit_buckets", "进程内限流计数桶数（替代 user_message_records）", lambda: len(rate_limiter.store)))
+metrics.register(Gauge("tg_client_pool_size", "连接池中的客户端数", lambda: len(client_pool)))
+metric_snapshots = None  # 由 init_app() 创建
+
+def publish_metrics(process):
+    """发布本进程的指标样本（带 process 标签），机器人与 worker 进程随心跳调用"""
+    metric_snapshots.publish(process, metrics.samples(("process",), (process,)))
+
+def scheduler_metrics_listener(event):
+    """调度器事件：错过执行计数，提交时记录相对计划时间的延迟"""
+    from apscheduler.events import EVENT_JOB_MISSED
+    if event.code == EVENT_JOB_MISSED:
+        SCHEDULER_MISFIRES.inc()
+        return
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for run_time in event.scheduled_run_times:
+        SCHEDULER_LAG.observe(max((now - run_time).total_seconds(), 0))
+
+# ======================== 数据存储函数 ========================
+TASK_CHANGE_RETENTION = 86400  # 任务变更日志保留1天，超过该时间未同步的进程全量加载
+
+class TaskStore:
+    """任务存储（SQLite WAL模式）：按行增删，写入开销与任务总数无关
+
+    每次增删改同时在 task_changes 追加一行（自增序号），其他进程按序号只读取变化的任务，
+    不随任务总数重新加载；变更日志保留 TASK_CHANGE_RETENTION 秒，落后更久的进程改为全量加载。
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id    TEXT PRIMARY KEY,
+                user_id    TEXT NOT NULL,
+                chat_id    TEXT,
+                data       TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_tasks_user_id ON tasks(user_id);
+            CREATE INDEX IF NOT EXISTS idx_tasks_chat_id ON tasks(chat_id);
+            CREATE TABLE IF NOT EXISTS task_changes (
+                seq        INTEGER PRIMARY KEY AUTOINCREMENT,
+                task_id    TEXT NOT NULL,
+                user_id    TEXT NOT NULL,
+                changed_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS task_changes_pruned (
+                id  INTEGER PRIMARY KEY CHECK (id = 0),
+                seq INTEGER NOT NULL
+            );
+        """)
+
+    def _write(self, sql, params, changes_sql, changes_params):
+        """在同一事务中执行写入并追加变更记录（changes_sql 在写入前执行，删除时仍能查到任务所属用户）"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(changes_sql, changes_params)
+                self._conn.execute(sql, params)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def upsert(self, user_id, task_id, task_info):
+        """新增或覆盖单个任务"""
+        now = time.time()
+        self._write(
+            "INSERT INTO tasks (task_id, user_id, chat_id, data, updated_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(task_id) DO UPDATE SET user_id=excluded.user_id, chat_id=excluded.chat_id, "
+            "data=excluded.data, updated_at=excluded.updated_at",
+            (task_id, str(user_id), task_info.get("chat_id"), json.dumps(task_info, ensure_ascii=False), now),
+            "INSERT INTO task_changes (task_id, user_id, changed_at) VALUES (?, ?, ?)", (task_id, str(user_id), now)
+        )
+
+    def delete(self, task_id):
+        """删除单个任务"""
+        self._write(
+            "DELETE FROM tasks WHERE task_id = ?", (task_id,),
+            "INSERT INTO task_changes (task_id, user_id, changed_at) "
+            "SELECT task_id, user_id, ? FROM tasks WHERE task_id = ?", (time.time(), task_id)
+        )
+
+    def delete_user(self, user_id):
+        """删除某个用户的全部任务"""
+        self._write(
+            "DELETE FROM tasks WHERE user_id = ?", (str(user_id),),
+            "INSERT INTO task_changes (task_id, user_id, changed_at) "
+            "SELECT task_id, user_id, ? FROM tasks WHERE user_id = ?", (time.time(), str(user_id))
+        )
+
+    def mark_fired(self, task_id, fired_at):
+        """记录一次性任务已执行（写入 data.fired_at），重启或重新分配后不再恢复其作业；任务已删除时不写入"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT user_id, data FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+                if row is not None:
+                    user_id, data = row
+                    task_info = json.loads(data)
+                    task_info["fired_at"] = fired_at
+                    now = time.time()
+                    self._conn.execute(
+                        "INSERT INTO task_changes (task_id, user_id, changed_at) VALUES (?, ?, ?)", (task_id, user_id, now)
+                    )
+                    self._conn.execute(
+                        "UPDATE tasks SET data = ?, updated_at = ? WHERE task_id = ?",
+                        (json.dumps(task_info, ensure_ascii=False), now, task_id)
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def load_all(self, user_filter=None):
+        """读取全部任务，返回 {user_id: {task_id: task_info}}；user_filter 为真时只解析其返回 True 的用户的任务"""
+        result = {}
+        with self._lock:
+            rows = self._conn.execute("SELECT task_id, user_id, data FROM tasks").fetchall()
+        for task_id, user_id, data in rows:
+            if user_filter is None or user_filter(user_id):
+                result.setdefault(user_id, {})[task_id] = json.loads(data)
+        return result
+
+    def last_change(self):
+        """最新的变更序号（先取序号再全量加载，之后从该序号增量同步）"""
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM task_changes").fetchone()[0]
+
+    def changes_since(self, seq):
+        """读取序号 seq 之后变化的任务，返回 (最新序号, {task_id: (user_id, task_info 或 None 表示已删除)})
+
+        所需的变更记录已被清理时返回 None，调用方改为全量加载。
+        """
+        with self._lock:
+            pruned = self._conn.execute("SELECT seq FROM task_changes_pruned").fetchone()
+            if pruned and seq < pruned[0]:
+                return None
+            rows = self._conn.execute(
+                "SELECT c.seq, c.task_id, c.user_id, t.user_id, t.data FROM task_changes c "
+                "LEFT JOIN tasks t ON t.task_id = c.task_id WHERE c.seq > ? ORDER BY c.seq", (seq,)
+            ).fetchall()
+        latest, changed = seq, {}
+        for latest, task_id, changed_user_id, user_id, data in rows:
+            # 同一任务多次变化时只按当前状态处理一次
+            if task_id not in changed:
+                changed[task_id] = (user_id, json.loads(data)) if data is not None else (changed_user_id, None)
+        return latest, changed
+
+    def prune_changes(self, max_age=None):
+        """清理超过保留时间的变更记录（机器人维护作业定期调用）"""
+        cutoff = time.time() - (TASK_CHANGE_RETENTION if max_age is None else max_age)
+        with self._lock:
+            row = self._conn.execute("SELECT MAX(seq) FROM task_changes WHERE changed_at < ?", (cutoff,)).fetchone()
+            if row[0] is None:
+                return 0
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                removed = self._conn.execute("DELETE FROM task_changes WHERE seq <= ?", (row[0],)).rowcount
+                self._conn.execute("INSERT OR REPLACE INTO task_changes_pruned (id, seq) VALUES (0, ?)", (row[0],))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return removed
+
+    def tasks_by_chat(self, chat_id):
+        """查询发往某个群组的任务，返回 [(user_id, task_id)]"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT user_id, task_id FROM tasks WHERE chat_id = ?", (str(chat_id),)
+            ).fetchall()
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+
+    def migrate_from_json(self, json_path):
+        """一次性迁移旧版 user_tasks.json，成功后重命名为 .migrated
+
+        空文件按没有任务处理；内容无法解析时移到 .corrupt 并报错（只在首次启动时记录一次失败）。
+        """
+        if not os.path.exists(json_path):
+            return 0
+        with open(json_path, "r", encoding="utf-8") as f:
+            content = f.read()
+        if not content.strip():
+            os.replace(json_path, json_path + ".migrated")
+            return 0
+        try:
+            legacy_tasks = json.loads(content)
+            if not isinstance(legacy_tasks, dict):
+                raise ValueError("顶层不是对象")
+        except ValueError as e:
+            os.replace(json_path, json_path + ".corrupt")
+            raise ValueError(f"{os.path.basename(json_path)} 格式无效，已移到 .corrupt：{e}") from e
+        now = time.time()
+        rows = [
+            (task_id, str(user_id), task_info.get("chat_id"), json.dumps(task_info, ensure_ascii=False), now)
+            for user_id, tasks in legacy_tasks.items()
+            for task_id, task_info in tasks.items()
+        ]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO tasks (task_id, user_id, chat_id, data, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    rows
+                )
+                self._conn.executemany(
+                    "INSERT INTO task_changes (task_id, user_id, changed_at) VALUES (?, ?, ?)",
+                    [(task_id, user_id, now) for task_id, user_id, _, _, _ in rows]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        os.replace(json_path, json_path + ".migrated")
+        return len(rows)
+
+task_store = None  # 由 init_app() 创建
+
+def load_user_tasks():
+    """加载用户定时任务（首次启动时从旧版JSON文件迁移）"""
+    global user_tasks
+    try:
+        migrated = task_store.migrate_from_json(TASKS_FILE)
+        if migrated:
+            log_operation("system", "migrate_tasks", "success", f"从{os.path.basename(TASKS_FILE)}迁移{migrated}个任务")
+    except Exception as e:
+        log_operation("system", "migrate_tasks", "failed", str(e))
+    _task_index_state["seq"] = task_store.last_change()
+    user_tasks = task_store.load_all()
+    rebuild_task_index()
+
+def rebuild_task_index():
+    """根据 user_tasks 重建任务反向索引"""
+    task_index.clear()
+    for user_id, tasks in user_tasks.items():
+        for task_id, task_info in tasks.items():
+            task_index[task_id] = (user_id, task_info)
+
+def index_task(user_id, task_id, task_info):
+    """登记任务（同时写入 user_tasks 与反向索引）"""
+    if user_id not in user_tasks:
+        user_tasks[user_id] = {}
+    user_tasks[user_id][task_id] = task_info
+    task_index[task_id] = (user_id, task_info)
+
+def unindex_task(user_id, task_id):
+    """移除任务（同时从 user_tasks 与反向索引中删除）"""
+    user_tasks.get(user_id, {}).pop(task_id, None)
+    task_index.pop(task_id, None)
+
+def find_task(task_id):
+    """按任务ID查找任务，返回 (user_id, task_info)，不存在时返回 (None, None)"""
+    return task_index.get(task_id, (None, None))
+
+def apply_task_change(task_id, user_id, task_info):
+    """应用一条任务变更（task_info 为 None 表示已删除），返回本地任务是否有变化"""
+    current = task_index.get(task_id)
+    if task_info is None:
+        if current is None:
+            return False
+        unindex_task(current[0], task_id)
+        return True
+    if current == (user_id, task_info):
+        return False
+    if current is not None and current[0] != user_id:
+        unindex_task(current[0], task_id)
+    index_task(user_id, task_id, task_info)
+    return True
+
+_task_index_state = {"seq": None}  # 已同步到的任务变更序号
+
+def refresh_task_index():
+    """机器人/Web进程读取任务前调用：按变更序号只同步其他进程修改过的任务，变更日志已清理时全量加载"""
+    global user_tasks
+    seq = _task_index_state["seq"]
+    changes = None if seq is None else task_store.changes_since(seq)
+    if changes is None:
+        _task_index_state["seq"] = task_store.last_change()
+        user_tasks = task_store.load_all()
+        rebuild_task_index()
+        return
+    _task_index_state["seq"], changed = changes
+    for task_id, (user_id, task_info) in changed.items():
+        apply_task_change(task_id, user_id, task_info)
+
+# ======================== 工具函数 ========================
+def get_user_client(user_id):
+    """获取Pyrogram客户端"""
+    from pyrogram import Client
+    session_path = os.path.join(SESSION_DIR, f"user_{user_id}")
+    client = Client(
+        name=session_path,
+        api_id=API_ID,
+        api_hash=API_HASH,
+        workdir=SESSION_DIR
+    )
+    return client
+
+class SendEngine:
+    """异步发送引擎：在独立事件循环线程中直接 await Pyrogram 异步接口
+
+    所有客户端与发送协程都运行在这个事件循环里，全局/单账号并发分别由信号量限制，
+    调度器线程不会被单次发送占住。
+    """
+
+    def __init__(self, global_limit=SEND_CONCURRENCY, account_limit=ACCOUNT_CONCURRENCY):
+        self.global_limit = global_limit
+        self.account_limit = account_limit
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._global_sem = None
+        self._account_sems = {}  # {user_id: asyncio.Semaphore}
+        self._inflight = set()   # 占用或等待发送名额的任务（退出时等待其完成）
+
+    @property
+    def loop(self):
+        """懒启动事件循环线程"""
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._global_sem = asyncio.Semaphore(self.global_limit)
+                self._thread = threading.Thread(target=self._run_loop, name="send-engine", daemon=True)
+                self._thread.start()
+        return self._loop
+
+    @property
+    def is_running(self):
+        return self._loop is not None
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    def submit(self, coro):
+        """提交协程到引擎事件循环，立即返回 concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """提交协程并阻塞等待结果（供同步代码调用）"""
+        return self.submit(coro).result(timeout)
+
+    @asynccontextmanager
+    async def slot(self, user_id):
+        """占用一个发送并发名额：先按账号排队，再占全局名额"""
+        user_id = str(user_id)
+        account_sem = self._account_sems.get(user_id)
+        if account_sem is None:
+            account_sem = self._account_sems[user_id] = asyncio.Semaphore(self.account_limit)
+        task = asyncio.current_task()
+        self._inflight.add(task)
+        try:
+            async with account_sem:
+                async with self._global_sem:
+                    yield
+        finally:
+            self._inflight.discard(task)
+
+    async def _drain(self, timeout):
+        await asyncio.sleep(0)  # 让刚提交的作业先进入 slot
+        pending = {task for task in self._inflight if not task.done()}
+        if not pending:
+            return 0
+        _, pending = await asyncio.wait(pending, timeout=timeout)
+        return len(pending)
+
+    def drain(self, timeout):
+        """等待进行中（含排队等待名额）的发送完成，返回超时后仍未完成的数量；调用前应先暂停调度器"""
+        if not self.is_running:
+            return 0
+        return self.run(self._drain(timeout))
+
+    def shutdown(self):
+        """停止事件循环线程"""
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = None
+        if loop is None:
+            return
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+
+send_engine = SendEngine()
+
+class SessionBusyError(RuntimeError):
+    """账号session正被其他进程使用"""
+
+class SessionLock:
+    """账号session文件的进程间独占锁（flock）：同一账号同一时刻只会被一个进程打开
+
+    多worker模式下账号换手时，新旧worker对归属的判断可能短暂重叠，由该锁兜底。
+    """
+
+    def __init__(self, user_id):
+        self.path = os.path.join(SESSION_DIR, f"user_{user_id}.lock")
+        self._fd = None
+
+    def acquire(self):
+        if fcntl is None:
+            return
+        fd = os.open(self.path, os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            raise SessionBusyError(f"账号session正被其他进程使用：{os.path.basename(self.path)}")
+        self._fd = fd
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+class UserClientPool:
+    """Pyrogram客户端连接池：按user_id复用已连接的客户端，按LRU/TTL淘汰空闲连接
+
+    客户端全部运行在发送引擎的事件循环中，避免同一个客户端被多个线程的事件循环交叉使用。
+    """
+
+    def __init__(self, engine, max_size=CLIENT_POOL_SIZE, idle_ttl=CLIENT_IDLE_TTL):
+        self.engine = engine
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self._clients = OrderedDict()  # {user_id: {"client": Client, "in_use": 引用数, "last_used": 时间戳, "lock": asyncio.Lock}}
+        self._cond = asyncio.Condition()
+        self._reaper = None
+        self._session_locks = {}  # {client: SessionLock}
+        self._stopping = {}  # {user_id: asyncio.Event}：已移出连接池、正在断开的客户端
+
+    def __len__(self):
+        return len(self._clients)
+
+    async def call(self, user_id, func):
+        """用该用户的已连接客户端执行 func(client) 协程（需在引擎事件循环中 await）"""
+        if self._reaper is None:
+            self._reaper = asyncio.get_running_loop().create_task(self._reap_idle())
+        client = await self._acquire(user_id)
+        try:
+            try:
+                return await func(client)
+            except (ConnectionError, OSError):
+                # 连接已断开：丢弃旧客户端，重连后重试一次
+                client = await self._reconnect(user_id)
+                return await func(client)
+        finally:
+            await self._release(user_id)
+
+    async def _acquire(self, user_id):
+        """取出（必要时创建并连接）用户客户端，连接数达到上限时先淘汰最久未用的空闲连接"""
+        user_id = str(user_id)
+        evicted = []
+        async with self._cond:
+            while user_id not in self._clients and len(self._clients) >= self.max_size:
+                popped = self._pop_lru_idle()
+                if popped is None:
+                    await self._cond.wait()
+                else:
+                    evicted.append(popped)
+            entry = self._clients.get(user_id)
+            if entry is None:
+                entry = {"client": None, "in_use": 0, "last_used": time.time(), "lock": asyncio.Lock()}
+                self._clients[user_id] = entry
+            entry["in_use"] += 1
+            self._clients.move_to_end(user_id)
+        # 断开被淘汰的连接不占用条件锁，其他账号的取用/归还不等待网络关闭
+        for evicted_user_id, client in evicted:
+            await self._stop_evicted(evicted_user_id, client)
+        try:
+            async with entry["lock"]:
+                if entry["client"] is None or not entry["client"].is_connected:
+                    await self._connect(entry, user_id)
+                return entry["client"]
+        except Exception:
+            await self._release(user_id)
+            raise
+
+    async def _connect(self, entry, user_id):
+        """（重新）创建并启动客户端，旧客户端尽力关闭"""
+        old_client, entry["client"] = entry["client"], None
+        await self._stop_client(old_client)
+        stopping = self._stopping.get(str(user_id))
+        if stopping is not None:
+            # 该账号刚被淘汰的旧客户端仍在断开，等其释放session锁
+            await stopping.wait()
+        session_lock = SessionLock(user_id)
+        session_lock.acquire()
+        client = get_user_client(user_id)
+        self._session_locks[client] = session_lock
+        started = time.monotonic()
+        try:
+            await client.start()
+        except BaseException:
+            self._session_locks.pop(client, None)
+            session_lock.release()
+            raise
+        CLIENT_CONNECT.observe(time.monotonic() - started)
+        entry["client"] = client
+
+    async def _reconnect(self, user_id):
+        entry = self._clients.get(str(user_id))
+        if entry is None:
+            raise ConnectionError(f"连接已被关闭：user_{user_id}")
+        async with entry["lock"]:
+            await self._connect(entry, user_id)
+        return entry["client"]
+
+    async def _release(self, user_id):
+        async with self._cond:
+            entry = self._clients.get(str(user_id))
+            if entry is not None:
+                entry["in_use"] -= 1
+                entry["last_used"] = time.time()
+                # 连接失败的占位记录直接移除，下次重新创建
+                if entry["in_use"] <= 0 and entry["client"] is None:
+                    del self._clients[str(user_id)]
+            self._cond.notify_all()
+
+    def _pop_lru_idle(self):
+        """弹出最久未使用的空闲客户端，返回 (user_id, client)（不存在时返回None；需持有条件锁）"""
+        for user_id, entry in self._clients.items():
+            if entry["in_use"] <= 0:
+                del self._clients[user_id]
+                self._stopping[user_id] = asyncio.Event()
+                return user_id, entry["client"]
+        return None
+
+    async def _stop_evicted(self, user_id, client):
+        """断开已移出连接池的客户端（在条件锁外调用），完成后唤醒等待该账号重新连接的请求"""
+        try:
+            await self._stop_client(client)
+        finally:
+            stopping = self._stopping.pop(user_id, None)
+            if stopping is not None:
+                stopping.set()
+
+    async def _stop_client(self, client):
+        if client is None:
+            return
+        try:
+            await client.stop()
+        except Exception:
+            pass
+        finally:
+            session_lock = self._session_locks.pop(client, None)
+            if session_lock is not None:
+                session_lock.release()
+
+    async def _reap_idle(self):
+        """定期关闭空闲超过TTL的连接"""
+        while True:
+            await asyncio.sleep(min(60, self.idle_ttl))
+            now = time.time()
+            expired = []
+            async with self._cond:
+                for user_id, entry in list(self._clients.items()):
+                    if entry["in_use"] <= 0 and now - entry["last_used"] > self.idle_ttl:
+                        expired.append((user_id, self._clients.pop(user_id)["client"]))
+                        self._stopping[user_id] = asyncio.Event()
+                if expired:
+                    self._cond.notify_all()
+            for user_id, client in expired:
+                await self._stop_evicted(user_id, client)
+
+    async def _close(self, user_id):
+        async with self._cond:
+            entry = self._clients.pop(str(user_id), None)
+            self._cond.notify_all()
+        if entry is not None:
+            async with entry["lock"]:
+                await self._stop_client(entry["client"])
+
+    def close(self, user_id):
+        """关闭并移除某个用户的连接（删除/替换session文件前调用）"""
+        if not self.engine.is_running:
+            return
+        self.engine.run(self._close(user_id))
+
+    async def _close_all(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        async with self._cond:
+            entries = list(self._clients.values())
+            self._clients.clear()
+        for entry in entries:
+            await self._stop_client(entry["client"])
+
+    def shutdown(self):
+        """断开所有连接（随调度器一起关闭）"""
+        if not self.engine.is_running:
+            return
+        self.engine.run(self._close_all())
+
+client_pool = UserClientPool(send_engine)
+
+@lru_cache(maxsize=None)
+def chat_access_errors():
+    """无法访问群组/用户时Telegram返回的错误，出现时清除对应的权限缓存"""
+    from pyrogram import errors
+    return (
+        errors.PeerIdInvalid,
+        errors.ChatIdInvalid,
+        errors.ChannelInvalid,
+        errors.ChannelPrivate,
+        errors.ChatWriteForbidden,
+        errors.ChatAdminRequired,
+        errors.ChatRestricted,
+        errors.UserBannedInChannel,
+        errors.UsernameInvalid,
+        errors.UsernameNotOccupied,
+    )
+
+class PeerCache:
+    """群组访问校验缓存：按 (user_id, chat_id) 记录 get_chat 校验通过的时间，TTL内跳过校验
+
+    可选持久化到SQLite，重启后未过期的记录继续有效。发送路径上只改内存并记下待写入的变化，
+    由 worker 每 PEER_CACHE_FLUSH_INTERVAL 秒在调度器线程中批量写入（flush），不在事件循环中等待磁盘。
+    """
+
+    def __init__(self, ttl=PEER_CACHE_TTL, db_path=None):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}  # {(user_id, chat_id): 过期时间戳}
+        self._pending = {}  # {(user_id, chat_id): 过期时间戳，None 表示删除}：尚未写入数据库的变化
+        self._conn = None
+        if db_path:
+            self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS peer_cache ("
+                "user_id TEXT NOT NULL, chat_id TEXT NOT NULL, expires_at REAL NOT NULL, "
+                "PRIMARY KEY (user_id, chat_id))"
+            )
+            now = time.time()
+            self._conn.execute("DELETE FROM peer_cache WHERE expires_at <= ?", (now,))
+            for user_id, chat_id, expires_at in self._conn.execute("SELECT user_id, chat_id, expires_at FROM peer_cache"):
+                self._entries[(user_id, chat_id)] = expires_at
+
+    def __len__(self):
+        return len(self._entries)
+
+    def is_valid(self, user_id, chat_id):
+        expires_at = self._entries.get((str(user_id), str(chat_id)))
+        return expires_at is not None and expires_at > time.time()
+
+    def mark_valid(self, user_id, chat_id):
+        key = (str(user_id), str(chat_id))
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._entries[key] = expires_at
+            if self._conn is not None:
+                self._pending[key] = expires_at
+
+    def invalidate(self, user_id, chat_id):
+        key = (str(user_id), str(chat_id))
+        with self._lock:
+            self._entries.pop(key, None)
+            if self._conn is not None:
+                self._pending[key] = None
+
+    def flush(self):
+        """把待写入的变化在一个事务中写入数据库，返回写入条数"""
+        if self._conn is None:
+            return 0
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO peer_cache (user_id, chat_id, expires_at) VALUES (?, ?, ?)",
+                    [(key[0], key[1], expires_at) for key, expires_at in pending.items() if expires_at is not None]
+                )
+                self._conn.executemany(
+                    "DELETE FROM peer_cache WHERE user_id = ? AND chat_id = ?",
+                    [key for key, expires_at in pending.items() if expires_at is None]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return len(pending)
+
+    def drop_user(self, user_id):
+        """清除某个账号的全部缓存（删除数据或更换session时调用）"""
+        user_id = str(user_id)
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == user_id]:
+                del self._entries[key]
+            for key in [key for key in self._pending if key[0] == user_id]:
+                del self._pending[key]
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM peer_cache WHERE user_id = ?", (user_id,))
+
+peer_cache = None  # 由 init_app() 创建
+
+async def ensure_chat_access(client, user_id, chat_id):
+    """校验群组权限（缓存有效期内不再调用 get_chat）"""
+    if peer_cache.is_valid(user_id, chat_id):
+        return
+    await client.get_chat(chat_id)
+    peer_cache.mark_valid(user_id, chat_id)
+
+class MediaStore:
+    """内容寻址媒体存储：文件按SHA-256只存一份，用户通过文件名引用，引用计数归零时删除
+
+    同一素材上传给多少个账号都只占一份磁盘空间；删除用户数据时只移除引用。
+    """
+
+    def __init__(self, blob_dir, db_path):
+        self.blob_dir = blob_dir
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS media_blobs (
+                sha256     TEXT PRIMARY KEY,
+                size       INTEGER NOT NULL,
+                refcount   INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                media_type TEXT
+            );
+            CREATE TABLE IF NOT EXISTS media_refs (
+                user_id    TEXT NOT NULL,
+                name       TEXT NOT NULL,
+                sha256     TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (user_id, name)
+            );
+            CREATE INDEX IF NOT EXISTS idx_media_refs_sha256 ON media_refs(sha256);
+        """)
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(media_blobs)")]
+        if "media_type" not in columns:
+            self._conn.execute("ALTER TABLE media_blobs ADD COLUMN media_type TEXT")
+
+    def blob_path(self, sha256):
+        return os.path.join(self.blob_dir, sha256[:2], sha256)
+
+    def put_file(self, user_id, name, tmp_path, sha256=None, media_type=None):
+        """把临时文件收入存储并登记 user_id 下的文件名引用，返回 (sha256, blob路径)
+
+        内容已存在时直接丢弃临时文件；同名引用指向其他内容时先释放旧引用。
+        媒体类型在上传时确定并随内容保存，发送时不再识别文件内容。
+        """
+        user_id, name = str(user_id), os.path.basename(name)
+        sha256 = sha256 or file_sha256(tmp_path)
+        media_type = media_type or get_media_type(tmp_path)
+        blob_path = self.blob_path(sha256)
+        size = os.path.getsize(tmp_path)
+        orphan = None
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                old = self._conn.execute(
+                    "SELECT sha256 FROM media_refs WHERE user_id = ? AND name = ?", (user_id, name)
+                ).fetchone()
+                if old and old[0] != sha256:
+                    orphan = self._decref(old[0])
+                # 内容文件缺失（例如被清理或手工删除）时用本次上传的文件补回
+                if os.path.exists(blob_path):
+                    os.remove(tmp_path)
+                else:
+                    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                    os.replace(tmp_path, blob_path)
+                if old and old[0] == sha256:
+                    self._conn.execute("COMMIT")
+                    return sha256, blob_path
+                self._conn.execute(
+                    "INSERT INTO media_blobs (sha256, size, refcount, created_at, media_type) VALUES (?, ?, 1, ?, ?) "
+                    "ON CONFLICT(sha256) DO UPDATE SET refcount = refcount + 1, "
+                    "media_type = COALESCE(media_blobs.media_type, excluded.media_type)",
+                    (sha256, size, time.time(), media_type)
+                )
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO media_refs (user_id, name, sha256, created_at) VALUES (?, ?, ?, ?)",
+                    (user_id, name, sha256, time.time())
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        self._remove_blobs([orphan])
+        return sha256, blob_path
+
+    def _decref(self, sha256):
+        """引用计数减一（需在事务内调用），归零时删除记录并返回待删除的sha256"""
+        self._conn.execute("UPDATE media_blobs SET refcount = refcount - 1 WHERE sha256 = ?", (sha256,))
+        row = self._conn.execute("SELECT refcount FROM media_blobs WHERE sha256 = ?", (sha256,)).fetchone()
+        if row and row[0] <= 0:
+            self._conn.execute("DELETE FROM media_blobs WHERE sha256 = ?", (sha256,))
+            return sha256
+        return None
+
+    def _remove_blobs(self, sha256_list):
+        """删除引用计数已归零的内容文件
+
+        在写事务内重新确认没有记录后才删除：与 put_file 的“检查文件是否存在并登记引用”互斥（包括其他进程），
+        期间重新上传了相同内容时保留文件，不会留下指向缺失文件的记录。
+        """
+        sha256_list = [sha256 for sha256 in sha256_list if sha256]
+        if not sha256_list:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for sha256 in sha256_list:
+                    if self._conn.execute("SELECT 1 FROM media_blobs WHERE sha256 = ?", (sha256,)).fetchone():
+                        continue
+                    try:
+                        os.remove(self.blob_path(sha256))
+                    except OSError:
+                        pass
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def resolve(self, user_id, name):
+        """按文件名找到用户引用的文件路径，不存在时返回 None"""
+        record = self.lookup(user_id, name)
+        return record[0] if record else None
+
+    def lookup(self, user_id, name):
+        """按文件名查询引用的内容，返回 (文件路径, sha256, 媒体类型)，不存在时返回 None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT r.sha256, b.media_type FROM media_refs r JOIN media_blobs b ON b.sha256 = r.sha256 "
+                "WHERE r.user_id = ? AND r.name = ?", (str(user_id), os.path.basename(name))
+            ).fetchone()
+        return (self.blob_path(row[0]), row[0], row[1]) if row else None
+
+    def list_names(self, user_id):
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                "SELECT name FROM media_refs WHERE user_id = ? ORDER BY created_at", (str(user_id),)
+            )]
+
+    def remove_ref(self, user_id, name):
+        """删除用户的单个文件引用"""
+        self._drop_refs("user_id = ? AND name = ?", (str(user_id), os.path.basename(name)))
+
+    def drop_user(self, user_id):
+        """删除用户的全部文件引用（其他用户仍在引用的内容保留）"""
+        self._drop_refs("user_id = ?", (str(user_id),))
+
+    def _drop_refs(self, where, params):
+        orphans = []
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(f"SELECT sha256 FROM media_refs WHERE {where}", params).fetchall()
+                self._conn.execute(f"DELETE FROM media_refs WHERE {where}", params)
+                for (sha256,) in rows:
+                    orphans.append(self._decref(sha256))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        self._remove_blobs(orphans)
+
+media_store = None  # 由 init_app() 创建
+
+def new_media_tmp_path():
+    """媒体临时文件路径（与存储目录在同一文件系统，收入存储时可原子重命名）"""
+    return os.path.join(MEDIA_TMP_DIR, f"{os.getpid()}_{threading.get_ident()}_{time.time_ns()}.part")
+
+LEGACY_MEDIA_MARKER = ".imported"  # 旧版用户媒体目录导入完成后写入的标记文件
+
+def import_legacy_media():
+    """一次性把旧版 data/user_media/user_<id>/ 下的文件登记到媒体库（init_app 调用）
+
+    通过硬链接收入存储，旧目录中的文件保留（旧任务保存的 media_path 仍然有效），不额外占用磁盘；
+    同名引用已存在时跳过（上传了新文件的以新文件为准）。每个目录导入完成后写入标记，之后启动不再扫描。
+    """
+    imported = 0
+    for media_dir in glob.glob(os.path.join(MEDIA_DIR, "user_*")):
+        marker = os.path.join(media_dir, LEGACY_MEDIA_MARKER)
+        if not os.path.isdir(media_dir) or os.path.exists(marker):
+            continue
+        user_id = os.path.basename(media_dir)[len("user_"):]
+        try:
+            for entry in os.scandir(media_dir):
+                if not entry.is_file() or media_store.lookup(user_id, entry.name):
+                    continue
+                tmp_path = new_media_tmp_path()
+                try:
+                    os.link(entry.path, tmp_path)
+                except OSError:
+                    shutil.copy2(entry.path, tmp_path)
+                media_store.put_file(user_id, entry.name, tmp_path)
+                imported += 1
+            open(marker, "w").close()
+        except Exception as e:
+            log_operation(user_id, "import_media", "failed", f"旧版媒体目录导入失败：{str(e)}")
+    if imported:
+        log_operation("system", "import_media", "success", f"导入{imported}个旧版媒体文件")
+
+def resolve_task_media(user_id, task_info):
+    """找到媒体任务要发送的文件，返回 (文件路径, sha256, 媒体类型)，找不到时返回 None
+
+    新任务按文件名引用媒体库（哈希与类型都已在上传时记录），旧任务直接使用保存的路径。
+    """
+    media_name = task_info.get("media_name")
+    if media_name:
+        return media_store.lookup(user_id, media_name)
+    media_path = task_info.get("media_path")
+    if media_path and os.path.exists(media_path):
+        return media_path, None, task_info.get("media_type")
+    return None
+
+def media_type_from_mime(mime_type):
+    """MIME类型映射为发送接口类型"""
+    if mime_type.startswith("image/"):
+        return "photo"
+    elif mime_type.startswith("video/"):
+        return "video"
+    else:
+        return "document"
+
+@lru_cache(maxsize=1024)
+def _detect_media_type(file_path, st_ino, st_size, st_mtime_ns):
+    import magic
+    return media_type_from_mime(magic.from_file(file_path, mime=True))
+
+def get_media_type(file_path):
+    """识别媒体文件类型（按 inode/大小/修改时间缓存，文件未变化时不再读取内容）"""
+    stat = os.stat(file_path)
+    return _detect_media_type(file_path, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+@lru_cache(maxsize=4096)
+def _file_sha256(file_path, st_ino, st_size, st_mtime_ns):
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def file_sha256(file_path):
+    """计算文件SHA-256（按 inode/大小/修改时间缓存，文件未变化时不重复读取）"""
+    stat = os.stat(file_path)
+    return _file_sha256(file_path, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+@lru_cache(maxsize=None)
+def media_reference_errors():
+    """Telegram侧文件引用失效时返回的错误，出现时回退为重新上传"""
+    from pyrogram import errors
+    return (
+        errors.FileReferenceExpired,
+        errors.FileReferenceInvalid,
+        errors.MediaEmpty,
+    )
+
+class MediaCache:
+    """已上传媒体的 file_id 缓存：按 (user_id, 文件SHA-256) 记录首次上传后Telegram返回的 file_id
+
+    Pyrogram的 file_id 内含 file_reference，后续发送直接引用，无需重新上传文件内容。
+    """
+
+    def __init__(self, db_path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS media_cache ("
+            "user_id TEXT NOT NULL, sha256 TEXT NOT NULL, media_type TEXT NOT NULL, "
+            "file_id TEXT NOT NULL, updated_at REAL NOT NULL, "
+            "PRIMARY KEY (user_id, sha256))"
+        )
+
+    def get(self, user_id, sha256, media_type):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT file_id FROM media_cache WHERE user_id = ? AND sha256 = ? AND media_type = ?",
+                (str(user_id), sha256, media_type)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, user_id, sha256, media_type, file_id):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO media_cache (user_id, sha256, media_type, file_id, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (str(user_id), sha256, media_type, file_id, time.time())
+            )
+
+    def invalidate(self, user_id, sha256):
+        with self._lock:
+            self._conn.execute("DELETE FROM media_cache WHERE user_id = ? AND sha256 = ?", (str(user_id), sha256))
+
+    def drop_user(self, user_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM media_cache WHERE user_id = ?", (str(user_id),))
+
+media_cache = None  # 由 init_app() 创建
+
+async def send_media_by_type(client, media_type, chat_id, media, caption="", parse_mode="markdown", file_name=None):
+    """按媒体类型调用对应的发送接口（media 可以是本地路径或 file_id），返回发送的消息"""
+    if media_type == "photo":
+        return await client.send_photo(chat_id, media, caption=caption, parse_mode=parse_mode)
+    elif media_type == "video":
+        return await client.send_video(chat_id, media, caption=caption, parse_mode=parse_mode, file_name=file_name)
+    return await client.send_document(chat_id, media, caption=caption, parse_mode=parse_mode, file_name=file_name)
+
+async def send_cached_media(client, user_id, chat_id, media_path, media_type, media_hash, caption="", parse_mode="markdown", file_name=None):
+    """优先用缓存的 file_id 发送，引用失效或无缓存时上传文件并记录新的 file_id"""
+    file_id = media_cache.get(user_id, media_hash, media_type)
+    if file_id:
+        try:
+            return await send_media_by_type(client, media_type, chat_id, file_id, caption, parse_mode, file_name)
+        except media_reference_errors():
+            media_cache.invalidate(user_id, media_hash)
+    message = await send_media_by_type(client, media_type, chat_id, media_path, caption, parse_mode, file_name)
+    media = getattr(message, media_type, None)
+    if media is not None:
+        media_cache.put(user_id, media_hash, media_type, media.file_id)
+    return message
+
+# ======================== 消息发送函数 ========================
+@rate_limit
+async def send_text_message(user_id, chat_id, text, parse_mode="markdown"):
+    """发送文本消息"""
+    # 内容风控
+    is_valid, msg = check_content(text)
+    if not is_valid:
+        log_operation(user_id, "send_text", "failed", f"内容违规：{msg}", chat_id=chat_id)
+        return False, msg
+    
+    async def _send(client):
+        # 校验群组权限
+        await ensure_chat_access(client, user_id, chat_id)
+        # 发送消息
+        await client.send_message(chat_id, text, parse_mode=parse_mode)
+
+    started = time.monotonic()
+    try:
+        await client_pool.call(user_id, _send)
+        SEND_LATENCY.observe(time.monotonic() - started, "send_text", "success")
+        log_operation(user_id, "send_text", "success", f"发送到{chat_id}，内容长度：{len(text)}",
+                      chat_id=chat_id, latency_ms=elapsed_ms(started))
+        return True, "文本消息发送成功"
+    except chat_access_errors() as e:
+        peer_cache.invalidate(user_id, chat_id)
+        SEND_LATENCY.observe(time.monotonic() - started, "send_text", "failed")
+        log_operation(user_id, "send_text", "failed", f"群组/用户不可访问：{chat_id}，{type(e).__name__}",
+                      chat_id=chat_id, latency_ms=elapsed_ms(started), error=type(e).__name__)
+        return False, "无法发送：群组/用户不存在或你未加入该群组"
+    except Exception as e:
+        SEND_LATENCY.observe(time.monotonic() - started, "send_text", "failed")
+        log_operation(user_id, "send_text", "failed", str(e),
+                      chat_id=chat_id, latency_ms=elapsed_ms(started), error=type(e).__name__)
+        return False, f"文本发送失败：{str(e)}"
+
+@rate_limit
+async def send_media_message(user_id, chat_id, media_path, caption="", parse_mode="markdown",
+                             file_name=None, media_type=None, media_hash=None):
+    """发送媒体消息
+
+    file_name 为用户看到的文件名（媒体库中的文件路径不带原始扩展名）；
+    media_type/media_hash 为上传时记录的类型与哈希，缺省时才读取文件识别。
+    """
+    # 内容风控
+    is_valid, msg = check_content(caption)
+    if not is_valid:
+        log_operation(user_id, "send_media", "failed", f"说明文字违规：{msg}", chat_id=chat_id)
+        return False, msg
+    
+    # 过滤可执行文件
+    banned_ext = [".exe", ".bat", ".sh", ".py", ".js"]
+    file_name = file_name or os.path.basename(media_path)
+    file_ext = os.path.splitext(file_name)[1].lower()
+    if file_ext in banned_ext:
+        log_operation(user_id, "send_media", "failed", f"禁止发送可执行文件：{file_ext}", chat_id=chat_id)
+        return False, "禁止发送可执行文件（exe/bat/sh等）"
+    
+    # 没有记录时才识别/计算（会读文件，放到线程中执行，避免阻塞事件循环）
+    if media_type is None:
+        media_type = await asyncio.to_thread(get_media_type, media_path)
+    if media_hash is None:
+        media_hash = await asyncio.to_thread(file_sha256, media_path)
+
+    async def _send(client):
+        # 校验群组权限
+        await ensure_chat_access(client, user_id, chat_id)
+        # 发送媒体（已上传过的文件直接引用 file_id）
+        await send_cached_media(client, user_id, chat_id, media_path, media_type, media_hash, caption, parse_mode, file_name)
+
+    started = time.monotonic()
+    try:
+        await client_pool.call(user_id, _send)
+        SEND_LATENCY.observe(time.monotonic() - started, "send_media", "success")
+        log_operation(user_id, "send_media", "success", f"发送到{chat_id}，文件：{file_name}",
+                      chat_id=chat_id, latency_ms=elapsed_ms(started))
+        return True, "媒体消息发送成功"
+    except chat_access_errors() as e:
+        peer_cache.invalidate(user_id, chat_id)
+        SEND_LATENCY.observe(time.monotonic() - started, "send_media", "failed")
+        log_operation(user_id, "send_media", "failed", f"群组/用户不可访问：{chat_id}，{type(e).__name__}",
+                      chat_id=chat_id, latency_ms=elapsed_ms(started), error=type(e).__name__)
+        return False, "无法发送：群组/用户不存在或你未加入该群组"
+    except Exception as e:
+        SEND_LATENCY.observe(time.monotonic() - started, "send_media", "failed")
+        log_operation(user_id, "send_media", "failed", str(e),
+                      chat_id=chat_id, latency_ms=elapsed_ms(started), error=type(e).__name__)
+        return False, f"媒体发送失败：{str(e)}"
+
+async def send_checkin_message(user_id, chat_id, checkin_cmd):
+    """发送签到指令"""
+    sensitive_cmds = ["/kick", "/ban", "/mute", "/unban", "/promote"]
+    if any(cmd in checkin_cmd for cmd in sensitive_cmds):
+        log_operation(user_id, "send_checkin", "failed", f"敏感指令：{checkin_cmd}", chat_id=chat_id)
+        return False, "禁止发送群组管理类敏感指令"
+    return await send_text_message(user_id, chat_id, checkin_cmd)
+
+async def send_broadcast(user_id, task_id, task_info, targets):
+    """广播：用同一个已连接客户端把同一条文本/媒体并发发送到多个群组
+
+    每个群组单独预占频率名额，每分钟/每群每天限额照常生效；媒体先发给第一个群组完成上传，
+    其余群组复用 file_id。返回 ({chat_id: (是否成功, 说明)}, 因每分钟限额待顺延的群组, 顺延秒数)
+    """
+    results, pending, retry_after = {}, [], 0
+    text = task_info.get("text", "")
+    caption = task_info.get("caption", "")
+    media = None
+    if task_info.get("media_name"):
+        media = resolve_task_media(user_id, task_info)
+        if media is None:
+            return {chat_id: (False, "媒体文件不存在") for chat_id in targets}, [], 0
+    is_valid, msg = check_content(caption if media else text)
+    if not is_valid:
+        log_operation(user_id, "send_broadcast", "failed", f"内容违规：{msg}", task_id=task_id)
+        return {chat_id: (False, msg) for chat_id in targets}, [], 0
+
+    admitted = []
+    reserved = await rate_limiter.run(
+        lambda: [rate_limiter.try_reserve(str(user_id), str(chat_id)) for chat_id in targets]
+    )
+    for chat_id, (reservation, rule, wait) in zip(targets, reserved):
+        if reservation is not None:
+            admitted.append((chat_id, reservation))
+        elif rule == "per_minute":
+            RATE_LIMIT_REJECTIONS.inc("per_minute")
+            pending.append(chat_id)
+            retry_after = min(retry_after, wait) if retry_after else wait
+        else:
+            RATE_LIMIT_REJECTIONS.inc("per_chat_daily")
+            results[chat_id] = (False, f"向该群组发送消息过多（每天最多{GROUP_MSG_LIMIT}条）")
+    if not admitted:
+        return results, pending, retry_after
+
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    async def _send_one(client, chat_id, reservation):
+        async with semaphore:
+            started = time.monotonic()
+            try:
+                await ensure_chat_access(client, user_id, chat_id)
+                if media:
+                    media_path, media_hash, media_type = media
+                    await send_cached_media(client, user_id, chat_id, media_path, media_type, media_hash,
+                                            caption, "markdown", task_info["media_name"])
+                else:
+                    await client.send_message(chat_id, text, parse_mode="markdown")
+            except Exception as e:
+                # 单个群组失败不影响其他群组（也不触发连接池整体重试，避免重复发送）
+                await rate_limiter.run(reservation.release)
+                if isinstance(e, chat_access_errors()):
+                    peer_cache.invalidate(user_id, chat_id)
+                    results[chat_id] = (False, "群组/用户不存在或你未加入该群组")
+                else:
+                    results[chat_id] = (False, str(e))
+                SEND_LATENCY.observe(time.monotonic() - started, "send_broadcast", "failed")
+                log_operation(user_id, "send_broadcast", "failed", f"任务ID：{task_id}，发送到{chat_id}：{e}",
+                              task_id=task_id, chat_id=chat_id, latency_ms=elapsed_ms(started), error=type(e).__name__)
+                return
+            reservation.commit()
+            results[chat_id] = (True, "发送成功")
+            SEND_LATENCY.observe(time.monotonic() - started, "send_broadcast", "success")
+            log_operation(user_id, "send_broadcast", "success", f"任务ID：{task_id}，发送到{chat_id}",
+                          task_id=task_id, chat_id=chat_id, latency_ms=elapsed_ms(started))
+
+    async def _fan_out(client):
+        rest = admitted
+        if media:
+            # 第一个群组完成上传并缓存 file_id 后，其余群组不再重复上传
+            await _send_one(client, *admitted[0])
+            rest = admitted[1:]
+        await asyncio.gather(*(_send_one(client, chat_id, reservation) for chat_id, reservation in rest))
+
+    try:
+        await client_pool.call(user_id, _fan_out)
+    except Exception as e:
+        for chat_id, reservation in admitted:
+            if chat_id not in results:
+                await rate_limiter.run(reservation.release)
+                results[chat_id] = (False, f"客户端连接失败：{e}")
+    return results, pending, retry_after
+
+# ======================== 定时任务执行函数 ========================
+JOB_TIMING_SAMPLES = 200      # 每个任务保留的最近执行样本数
+JOB_TIMING_GLOBAL_SAMPLES = 10000
+
+def percentiles(values, points=(50, 90, 99)):
+    """最近邻秩百分位，返回 {"p50": ..., "max": ...}（毫秒，保留1位小数）"""
+    if not values:
+        return {}
+    ordered = sorted(values)
+    result = {f"p{p}": round(ordered[min(len(ordered) - 1, max(0, -(-p * len(ordered) // 100) - 1))] * 1000, 1)
+              for p in points}
+    result["max"] = round(ordered[-1] * 1000, 1)
+    return result
+
+class JobTimings:
+    """调度器作业计时：开始执行时记录时间，由 EVENT_JOB_EXECUTED/ERROR 事件计算
+    计划时间→实际开始的延迟与执行耗时，并统计错过执行（MISSED）与因上次未结束被跳过的次数
+
+    样本按任务ID（顺延补发的作业并入原任务）保存在定长队列中，内存占用有上限。
+    """
+
+    def __init__(self, samples=JOB_TIMING_SAMPLES, global_samples=JOB_TIMING_GLOBAL_SAMPLES):
+        self.samples = samples
+        self._lock = threading.Lock()
+        self._started = {}  # {作业ID: 开始时间戳}（顺延补发的作业与原任务的作业可能同时在执行）
+        self._tasks = {}    # {任务ID: {"lag": deque, "duration": deque, "runs", "errors", "missed", "skipped"}}
+        self._global = {"lag": deque(maxlen=global_samples), "duration": deque(maxlen=global_samples)}
+        self._dirty = set()  # 上次发布后有变化的任务ID
+
+    @staticmethod
+    def task_id_of(job_id):
+        return job_id.split(":", 1)[0]
+
+    def mark_start(self, job_id):
+        """作业函数开始时调用；线程模式下外层已记录时保留最早的时间（包含等待事件循环的时间）"""
+        self._started.setdefault(job_id, time.time())
+
+    def _stats(self, task_id):
+        stats = self._tasks.get(task_id)
+        if stats is None:
+            stats = self._tasks[task_id] = {
+                "lag": deque(maxlen=self.samples), "duration": deque(maxlen=self.samples),
+                "runs": 0, "errors": 0, "missed": 0, "skipped": 0,
+            }
+        return stats
+
+    def listener(self, event):
+        from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED
+        task_id = self.task_id_of(event.job_id)
+        now = time.time()
+        with self._lock:
+            if task_id not in task_index:
+                self._started.pop(event.job_id, None)
+                return  # 非任务作业（同步、日志清理、关键词重载等）不计入统计
+            stats = self._stats(task_id)
+            self._dirty.add(task_id)
+            if event.code == EVENT_JOB_MISSED:
+                stats["missed"] += 1
+                return
+            if event.code == EVENT_JOB_MAX_INSTANCES:
+                stats["skipped"] += 1
+                SCHEDULER_SKIPPED.inc()
+                return
+            started = self._started.pop(event.job_id, None)
+            stats["runs"] += 1
+            if event.code == EVENT_JOB_ERROR:
+                stats["errors"] += 1
+            if started is None:
+                return
+            lag = max(started - event.scheduled_run_time.timestamp(), 0)
+            duration = now - started
+            stats["lag"].append(lag)
+            stats["duration"].append(duration)
+            self._global["lag"].append(lag)
+            self._global["duration"].append(duration)
+        JOB_START_LAG.observe(lag)
+
+    def summary(self, task_id=None):
+        """单个任务（或全部作业）的执行次数、错过/跳过次数与延迟/耗时百分位（毫秒）"""
+        with self._lock:
+            if task_id is None:
+                lag, duration = list(self._global["lag"]), list(self._global["duration"])
+                counts = {key: sum(s[key] for s in self._tasks.values()) for key in ("runs", "errors", "missed", "skipped")}
+            else:
+                stats = self._tasks.get(task_id)
+                if stats is None:
+                    return None
+                lag, duration = list(stats["lag"]), list(stats["duration"])
+                counts = {key: stats[key] for key in ("runs", "errors", "missed", "skipped")}
+        return {**counts, "lag_ms": percentiles(lag), "duration_ms": percentiles(duration)}
+
+    def pop_dirty(self):
+        """取出并清空上次调用后有变化的任务ID"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        return dirty
+
+    def forget(self, task_id):
+        with self._lock:
+            self._tasks.pop(task_id, None)
+            self._started.pop(task_id, None)
+            self._started.pop(f"{task_id}:deferred", None)
+            self._dirty.discard(task_id)
+
+job_timings = JobTimings()
+
+class TaskStatsStore:
+    """任务执行统计的共享表（SQLite）：统计在执行任务的 worker 内存中产生，
+    worker 随心跳只发布有变化的任务，机器人/Web进程从这里读取
+    """
+
+    OVERALL_PREFIX = "worker:"  # 各 worker 全部作业汇总的行，task_id 为 worker:<worker_id>
+
+    def __init__(self, db_path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS task_stats (
+                task_id    TEXT PRIMARY KEY,
+                timing     TEXT,
+                last_run   TEXT,
+                updated_at REAL NOT NULL
+            )
+        """)
+
+    def publish(self, rows):
+        """rows：[(task_id, 计时汇总, 广播最近结果)]，一个事务写入"""
+        now = time.time()
+        data = [
+            (task_id, json.dumps(timing) if timing else None,
+             json.dumps(last_run, ensure_ascii=False) if last_run else None, now)
+            for task_id, timing, last_run in rows
+        ]
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO task_stats (task_id, timing, last_run, updated_at) VALUES (?, ?, ?, ?)", data
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def get_many(self, task_ids):
+        """返回 {task_id: (计时汇总, 广播最近结果)}，没有统计的任务不包含在内"""
+        task_ids = list(task_ids)
+        result = {}
+        for start in range(0, len(task_ids), 500):
+            chunk = task_ids[start:start + 500]
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT task_id, timing, last_run FROM task_stats WHERE task_id IN ({','.join('?' * len(chunk))})",
+                    chunk
+                ).fetchall()
+            for task_id, timing, last_run in rows:
+                result[task_id] = (json.loads(timing) if timing else None, json.loads(last_run) if last_run else None)
+        return result
+
+    def get(self, task_id):
+        return self.get_many([task_id]).get(task_id, (None, None))
+
+    def overall(self):
+        """各 worker 全部作业的汇总：{worker_id: 计时汇总}"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT task_id, timing FROM task_stats WHERE task_id LIKE ? AND timing IS NOT NULL",
+                (self.OVERALL_PREFIX + "%",)
+            ).fetchall()
+        return {task_id[len(self.OVERALL_PREFIX):]: json.loads(timing) for task_id, timing in rows}
+
+    def delete(self, task_ids):
+        with self._lock:
+            self._conn.executemany("DELETE FROM task_stats WHERE task_id = ?", [(task_id,) for task_id in task_ids])
+
+task_stats = None  # 由 init_app() 创建
+
+async def mark_task_fired(task_id, task_info):
+    """一次性任务开始发送前持久化已执行标记（至多执行一次：发送中途重启也不会重发）"""
+    if task_info.get("trigger_type", "date") != "date" or task_info.get("fired_at"):
+        return
+    fired_at = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    task_info["fired_at"] = fired_at
+    await asyncio.to_thread(task_store.mark_fired, task_id, fired_at)
+
+async def execute_task_async(task_id, targets=None, job_id=None):
+    """执行定时任务（在发送引擎事件循环中运行）；targets 为广播任务顺延补发的群组，job_id 为顺延补发作业的ID"""
+    job_timings.mark_start(job_id or task_id)
+    user_id, task_info = find_task(task_id)
+    if not task_info:
+        log_operation("system", "execute_task", "failed", f"任务不存在：{task_id}", task_id=task_id)
+        return
+    
+    chat_id = task_info.get("chat_id")
+    task_type = task_info.get("type", "text")
+    if task_type == "broadcast":
+        if targets is None:
+            await mark_task_fired(task_id, task_info)
+        await execute_broadcast(task_id, user_id, task_info, targets or task_info["chat_ids"])
+        return
+
+    # 发送前检查限额，没有空闲名额时顺延到下一个空闲时刻，不启动客户端
+    admitted, retry_after = await rate_limiter.run(rate_limiter.check, str(user_id), str(chat_id))
+    if not admitted:
+        defer_task(task_id, retry_after)
+        TASK_RUNS.inc(task_type, "deferred")
+        log_operation(user_id, "execute_task", "deferred", f"任务ID：{task_id}，限额已满，{int(retry_after) + 1}秒后重试",
+                      task_id=task_id, chat_id=chat_id)
+        return
+    
+    await mark_task_fired(task_id, task_info)
+    started = time.monotonic()
+    try:
+        async with send_engine.slot(user_id):
+            if task_type == "checkin":
+                checkin_cmd = task_info["checkin_cmd"]
+                success, msg = await send_checkin_message(user_id, chat_id, checkin_cmd)
+            elif task_type == "media":
+                media = resolve_task_media(user_id, task_info)
+                caption = task_info.get("caption", "")
+                if media:
+                    media_path, media_hash, media_type = media
+                    file_name = task_info.get("media_name") or os.path.basename(media_path)
+                    success, msg = await send_media_message(
+                        user_id, chat_id, media_path, caption,
+                        file_name=file_name, media_type=media_type, media_hash=media_hash
+                    )
+                else:
+                    success, msg = False, "媒体文件不存在"
+            else:
+                text = task_info["text"]
+                success, msg = await send_text_message(user_id, chat_id, text)
+        
+        result = "success" if success else "failed"
+        TASK_RUNS.inc(task_type, result)
+        TASK_DURATION.observe(time.monotonic() - started, task_type)
+        log_operation(user_id, "execute_task", result, 
+                      f"任务ID：{task_id}，类型：{task_type}，结果：{msg}",
+                      task_id=task_id, chat_id=chat_id, latency_ms=elapsed_ms(started))
+    except Exception as e:
+        TASK_RUNS.inc(task_type, "error")
+        TASK_DURATION.observe(time.monotonic() - started, task_type)
+        log_operation(user_id, "execute_task", "failed", f"任务ID：{task_id}，异常：{str(e)}",
+                      task_id=task_id, chat_id=chat_id, latency_ms=elapsed_ms(started), error=type(e).__name__)
+
+# 广播任务最近一次执行的逐群组结果
+broadcast_results = {}  # {task_id: {"time": 执行时间, "results": {chat_id: {"success", "message"}}, "pending": [待顺延群组]}}
+
+async def execute_broadcast(task_id, user_id, task_info, targets):
+    """执行广播任务：逐群组记录结果，因每分钟限额未发出的群组合并为一次顺延补发"""
+    started = time.monotonic()
+    try:
+        async with send_engine.slot(user_id):
+            results, pending, retry_after = await send_broadcast(user_id, task_id, task_info, targets)
+    except Exception as e:
+        TASK_RUNS.inc("broadcast", "error")
+        TASK_DURATION.observe(time.monotonic() - started, "broadcast")
+        log_operation(user_id, "execute_task", "failed", f"任务ID：{task_id}，异常：{str(e)}",
+                      task_id=task_id, latency_ms=elapsed_ms(started), error=type(e).__name__)
+        return
+
+    record = broadcast_results.get(task_id)
+    if record is None or targets == task_info["chat_ids"]:
+        record = broadcast_results[task_id] = {"results": {}}
+    record["time"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    record["results"].update({chat_id: {"success": ok, "message": msg} for chat_id, (ok, msg) in results.items()})
+    record["pending"] = pending
+
+    sent = sum(1 for ok, _ in results.values() if ok)
+    detail = f"任务ID：{task_id}，类型：broadcast，成功{sent}/{len(targets)}个群组"
+    if pending:
+        defer_task(task_id, retry_after, targets=pending)
+        detail += f"，{len(pending)}个群组限额已满，{int(retry_after) + 1}秒后补发"
+    result = "success" if sent == len(targets) else ("partial" if sent or pending else "failed")
+    TASK_RUNS.inc("broadcast", result)
+    TASK_DURATION.observe(time.monotonic() - started, "broadcast")
+    log_operation(user_id, "execute_task", result, detail, task_id=task_id, latency_ms=elapsed_ms(started))
+
+def defer_task(task_id, delay, targets=None):
+    """把本次执行顺延 delay 秒（以一次性作业补发，不影响原有周期）；targets 为广播任务待补发的群组"""
+    from apscheduler.triggers.date import DateTrigger
+    run_date = datetime.datetime.now() + datetime.timedelta(seconds=delay + 1)
+    scheduler.add_job(
+        get_task_job_func(),
+        trigger=DateTrigger(run_date=run_date),
+        args=[task_id],
+        kwargs={"targets": targets, "job_id": f"{task_id}:deferred"},
+        id=f"{task_id}:deferred",
+        replace_existing=True,
+        misfire_grace_time=MISFIRE_GRACE_TIME
+    )
+
+def execute_task(task_id, targets=None, job_id=None):
+    """执行定时任务（线程模式：调度器线程阻塞等待发送完成）"""
+    job_timings.mark_start(job_id or task_id)
+    send_engine.run(execute_task_async(task_id, targets, job_id))
+
+def get_task_job_func():
+    """按发送引擎模式返回调度器的任务函数"""
+    return execute_task_async if SEND_ENGINE == "asyncio" else execute_task
+
+def create_scheduler():
+    """创建调度器：asyncio模式下直接运行在发送引擎的事件循环中"""
+    from apscheduler.events import (
+        EVENT_JOB_SUBMITTED, EVENT_JOB_EXECUTED, EVENT_JOB_ERROR, EVENT_JOB_MISSED, EVENT_JOB_MAX_INSTANCES
+    )
+    if SEND_ENGINE == "asyncio":
+        from apscheduler.schedulers.asyncio import AsyncIOScheduler
+        scheduler = AsyncIOScheduler(event_loop=send_engine.loop)
+    else:
+        from apscheduler.schedulers.background import BackgroundScheduler
+        scheduler = BackgroundScheduler()
+    scheduler.add_listener(scheduler_metrics_listener, EVENT_JOB_SUBMITTED | EVENT_JOB_MISSED)
+    scheduler.add_listener(
+        job_timings.listener, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES
+    )
+    return scheduler
+
+MISFIRE_GRACE_TIME = 300  # 任务错过执行后，允许延迟5分钟执行
+
+# 周期类型对应的触发器参数（日历规则时区默认Asia/Shanghai）
+TRIGGER_PRESETS = {
+    "date": {},
+    "interval_minute": {"seconds": 60},
+    "interval_hour": {"hours": 1},
+    "interval_day": {"days": 1},
+    "interval_2day": {"days": 2},
+    "interval_week": {"weeks": 1},
+    "cron_daily_0800": {"hour": 8, "minute": 0, "timezone": "Asia/Shanghai"},
+    "cron_week135_1800": {"day_of_week": "1,3,5", "hour": 18, "minute": 0, "timezone": "Asia/Shanghai"},
+    "cron_month1_0000": {"day": 1, "hour": 0, "minute": 0, "timezone": "Asia/Shanghai"},
+    "cron_workday_0900": {"day_of_week": "1-5", "hour": 9, "minute": 0, "timezone": "Asia/Shanghai"},
+    "cron_weekend_1000": {"day_of_week": "6,0", "hour": 10, "minute": 0, "timezone": "Asia/Shanghai"},
+}
+
+def normalize_start_time(trigger_type, text):
+    """按周期类型校验并规范化首次执行时间，格式不符时抛出 ValueError"""
+    text = text.strip()
+    # 一次性/间隔重复需要完整时间 YYYY-MM-DD HH:MM
+    if trigger_type == "date" or trigger_type.startswith("interval_"):
+        return datetime.datetime.strptime(text, "%Y-%m-%d %H:%M").strftime("%Y-%m-%d %H:%M")
+    # 日历规则-每月1号仅需要 YYYY-MM
+    if trigger_type == "cron_month1_0000":
+        return datetime.datetime.strptime(text, "%Y-%m").strftime("%Y-%m")
+    # 其他日历规则仅需要 YYYY-MM-DD
+    if trigger_type.startswith("cron_"):
+        return datetime.datetime.strptime(text, "%Y-%m-%d").strftime("%Y-%m-%d")
+    raise ValueError(f"未知周期类型：{trigger_type}")
+
+def build_trigger(trigger_type, trigger_args, start_time_str):
+    """根据任务的 trigger_type/trigger_args/start_time 构建 APScheduler 触发器"""
+    from apscheduler.triggers.cron import CronTrigger
+    from apscheduler.triggers.date import DateTrigger
+    from apscheduler.triggers.interval import IntervalTrigger
+    if trigger_type == "date":
+        # 一次性任务
+        start_time = datetime.datetime.strptime(start_time_str, "%Y-%m-%d %H:%M")
+        return DateTrigger(run_date=start_time)
+    elif trigger_type.startswith("interval_"):
+        # 间隔重复任务
+        start_time = datetime.datetime.strptime(start_time_str, "%Y-%m-%d %H:%M")
+        return IntervalTrigger(start_date=start_time, **trigger_args)
+    elif trigger_type.startswith("cron_"):
+        # 日历规则任务
+        if trigger_type == "cron_month1_0000":
+            # 每月1号：拼接完整时间
+            start_time = datetime.datetime.strptime(start_time_str + "-01 00:00", "%Y-%m-%d %H:%M")
+        else:
+            # 其他日历规则：拼接默认时间（00:00）
+            start_time = datetime.datetime.strptime(start_time_str + " 00:00", "%Y-%m-%d %H:%M")
+        return CronTrigger(start_date=start_time, **trigger_args)
+    raise ValueError(f"不支持的周期类型：{trigger_type}")
+
+def add_task_job(scheduler, task_id, trigger_type, trigger, **kwargs):
+    """把任务添加到调度器（间隔任务合并重叠的执行）"""
+    return scheduler.add_job(
+        get_task_job_func(),
+        trigger=trigger,
+        args=[task_id],
+        id=task_id,
+        replace_existing=True,
+        misfire_grace_time=MISFIRE_GRACE_TIME,
+        coalesce=trigger_type.startswith("interval_"),
+        **kwargs
+    )
+
+def restore_scheduled_jobs(scheduler, task_ids=None):
+    """根据已保存的任务批量重建调度器作业（worker 首次同步时传入全部负责的任务，之后只传入变化的任务）
+
+    相同周期参数的任务共用一个触发器和首次执行时间；已执行（fired_at）或已过期的一次性任务直接跳过。
+    worker 在调度器启动前完成首次同步：作业先进入待添加列表，start() 时一次性加入并只唤醒一次调度器，
+    按 (执行时间, 作业ID) 排序后作业存储只需顺序追加。之后的同步只添加变化的少量任务，逐个加入即可。
+    """
+    started = time.perf_counter()
+    trigger_cache = {}  # {(trigger_type, trigger_args, start_time): (trigger, next_run_time)}
+    pending = []
+    skipped = failed = 0
+    items = list(task_index.items()) if task_ids is None else [(tid, task_index[tid]) for tid in task_ids if tid in task_index]
+    for task_id, (user_id, task_info) in items:
+        trigger_type = task_info.get("trigger_type", "date")
+        if trigger_type == "date" and task_info.get("fired_at"):
+            skipped += 1
+            continue
+        key = (trigger_type, json.dumps(task_info.get("trigger_args", {}), sort_keys=True), task_info.get("start_time"))
+        try:
+            cached = trigger_cache.get(key)
+            if cached is None:
+                trigger = build_trigger(trigger_type, task_info.get("trigger_args", {}), task_info.get("start_time"))
+                now = datetime.datetime.now(datetime.timezone.utc)
+                next_run_time = trigger.get_next_fire_time(None, now)
+                if next_run_time is not None and next_run_time < now - datetime.timedelta(seconds=MISFIRE_GRACE_TIME):
+                    next_run_time = None  # 一次性任务已过期
+                cached = trigger_cache[key] = (trigger, next_run_time)
+        except Exception as e:
+            failed += 1
+            log_operation(user_id, "restore_job", "failed", f"任务ID：{task_id}，{str(e)}")
+            continue
+        trigger, next_run_time = cached
+        if next_run_time is None:
+            skipped += 1
+            continue
+        pending.append((next_run_time, task_id, trigger_type, trigger))
+
+    pending.sort(key=lambda item: (item[0], item[1]))
+    for next_run_time, task_id, trigger_type, trigger in pending:
+        add_task_job(scheduler, task_id, trigger_type, trigger, next_run_time=next_run_time)
+
+    elapsed = time.perf_counter() - started
+    summary = f"恢复{len(pending)}个作业，跳过已执行/过期{skipped}个，失败{failed}个，耗时{elapsed:.2f}秒"
+    log_operation("system", "restore_jobs", "success", summary)
+    return len(pending), skipped, failed
+
+# ======================== 多进程任务分片 ========================
+class WorkerCoordinator:
+    """多进程任务分片协调（SQLite）：worker 定期心跳，按 user_id 做最高随机权重（rendezvous）哈希分配账号
+
+    worker 加入或退出时只有约 1/N 的账号换手；换手期间两个 worker 的判断可能短暂重叠，
+    由 SessionLock 保证同一账号不会被两个进程同时打开。
+    """
+
+    def __init__(self, db_path, worker_id, ttl=WORKER_TTL):
+        self.worker_id = worker_id
+        self.ttl = ttl
+        self.members = (worker_id,)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS workers (
+                worker_id    TEXT PRIMARY KEY,
+                host         TEXT NOT NULL,
+                pid          INTEGER NOT NULL,
+                started_at   REAL NOT NULL,
+                heartbeat_at REAL NOT NULL
+            )
+        """)
+        self._started_at = time.time()
+
+    def heartbeat(self):
+        """更新心跳并返回当前存活的 worker 列表（有序）"""
+        now = time.time()
+        self._conn.execute(
+            "INSERT INTO workers (worker_id, host, pid, started_at, heartbeat_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(worker_id) DO UPDATE SET host=excluded.host, pid=excluded.pid, heartbeat_at=excluded.heartbeat_at",
+            (self.worker_id, socket.gethostname(), os.getpid(), self._started_at, now)
+        )
+        rows = self._conn.execute(
+            "SELECT worker_id FROM workers WHERE heartbeat_at > ? ORDER BY worker_id", (now - self.ttl,)
+        ).fetchall()
+        self.members = tuple(row[0] for row in rows) or (self.worker_id,)
+        return self.members
+
+    def leave(self):
+        self._conn.execute("DELETE FROM workers WHERE worker_id = ?", (self.worker_id,))
+
+    @staticmethod
+    def owner(user_id, members):
+        return max(members, key=lambda worker_id: hashlib.blake2b(f"{worker_id}:{user_id}".encode(), digest_size=8).digest())
+
+    def owns(self, user_id):
+        return self.owner(user_id, self.members) == self.worker_id
+
+coordinator = None  # 仅worker进程中创建
+_worker_sync_state = {"members": None, "seq": None, "reset_seq": 0}  # 上次同步时的成员、任务变更序号、账号重置序号
+
+class AccountResetLog:
+    """账号重置通知（SQLite）：机器人/Web进程删除数据或更换session后登记，worker 同步时断开该账号的连接并清除缓存
+
+    连接池和群组校验缓存都在 worker 进程内存中，只在处理请求的进程里清除不会影响 worker。
+    """
+
+    def __init__(self, db_path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS account_resets (
+                seq        INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id    TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+
+    def publish(self, user_id):
+        with self._lock:
+            self._conn.execute("INSERT INTO account_resets (user_id, created_at) VALUES (?, ?)", (str(user_id), time.time()))
+
+    def last_seq(self):
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM account_resets").fetchone()[0]
+
+    def since(self, seq):
+        """返回 (最新序号, 序号 seq 之后登记的 user_id 集合)"""
+        with self._lock:
+            rows = self._conn.execute("SELECT seq, user_id FROM account_resets WHERE seq > ? ORDER BY seq", (seq,)).fetchall()
+        return (rows[-1][0] if rows else seq), {user_id for _, user_id in rows}
+
+    def prune(self, max_age=TASK_CHANGE_RETENTION):
+        with self._lock:
+            self._conn.execute("DELETE FROM account_resets WHERE created_at < ?", (time.time() - max_age,))
+
+account_resets = None  # 由 init_app() 创建
+
+def reset_account(user_id):
+    """删除数据或更换session后调用：清除本进程的连接与缓存，并通知 worker 在下一次同步时清除"""
+    client_pool.close(user_id)
+    peer_cache.drop_user(user_id)
+    media_cache.drop_user(user_id)
+    account_resets.publish(user_id)
+
+def publish_task_stats():
+    """把本 worker 有变化的任务统计（及全部作业汇总）写入共享表，供机器人/Web进程查看"""
+    dirty = [task_id for task_id in job_timings.pop_dirty() if task_id in task_index]
+    if not dirty:
+        return
+    rows = [(task_id, job_timings.summary(task_id), broadcast_results.get(task_id)) for task_id in dirty]
+    rows.append((TaskStatsStore.OVERALL_PREFIX + coordinator.worker_id, job_timings.summary(), None))
+    task_stats.publish(rows)
+
+def sync_worker_tasks(scheduler):
+    """worker 定期执行：心跳并发布执行统计，处理账号重置通知，按任务变更日志调整本 worker 负责账号的作业
 
-# 6. 文件权限设置
-def set_file_permission(file_path):
-    """设置文件权限为600"""
-    try:
-        os.chmod(file_path, 0o600)
-        return True
-    except:
-        return False
+    只读取上次同步后变化的任务；首次同步、worker 成员变化（账号重新分配）或变更日志已清理时全量读取。
+    不再负责/已无任务的账号：移除作业并断开连接（释放session锁）；新增/修改的任务：重建作业。
+    """
+    from apscheduler.jobstores.base import JobLookupError
+    state = _worker_sync_state
+    members = coordinator.heartbeat()
+    publish_task_stats()
+    publish_metrics(coordinator.worker_id)
 
-# ======================== 数据存储函数 ========================
-def load_user_tasks():
-    """加载用户定时任务"""
-    global user_tasks
-    if os.path.exists(TASKS_FILE):
-        try:
-            with open(TASKS_FILE, "r", encoding="utf-8") as f:
-                user_tasks = json.load(f)
-        except:
-            user_tasks = {}
+    state["reset_seq"], reset_users = account_resets.since(state["reset_seq"])
+    for uid in reset_users:
+        client_pool.close(uid)
+        peer_cache.drop_user(uid)
+        media_cache.drop_user(uid)
+
+    changes = None
+    if members == state["members"] and state["seq"] is not None:
+        changes = task_store.changes_since(state["seq"])
+    if changes is None:
+        seq = task_store.last_change()
+        owned = task_store.load_all(user_filter=coordinator.owns)
+        incoming = {task_id: (uid, info) for uid, tasks in owned.items() for task_id, info in tasks.items()}
+        incoming.update({task_id: (uid, None) for task_id, (uid, _) in task_index.items() if task_id not in incoming})
     else:
-        user_tasks = {}
+        seq, changed_tasks = changes
+        # 其他 worker 负责的账号的变化按删除处理（本 worker 没有该任务时忽略）
+        incoming = {task_id: (uid, info if coordinator.owns(uid) else None)
+                    for task_id, (uid, info) in changed_tasks.items()}
+    state["members"], state["seq"] = members, seq
 
-def save_user_tasks():
-    """保存用户定时任务"""
-    with open(TASKS_FILE, "w", encoding="utf-8") as f:
-        json.dump(user_tasks, f, ensure_ascii=False, indent=2)
+    changed, removed, touched_users = [], 0, set()
+    for task_id, (uid, info) in incoming.items():
+        if not apply_task_change(task_id, uid, info):
+            continue
+        if info is not None:
+            changed.append(task_id)
+            continue
+        touched_users.add(uid)
+        job_timings.forget(task_id)
+        broadcast_results.pop(task_id, None)
+        for job_id in (task_id, f"{task_id}:deferred"):
+            try:
+                scheduler.remove_job(job_id)
+            except JobLookupError:
+                pass
+        removed += 1
+    for uid in touched_users:
+        if not user_tasks.get(uid):
+            user_tasks.pop(uid, None)
+            client_pool.close(uid)
 
-# 初始化加载任务
-load_user_tasks()
+    if changed:
+        restore_scheduled_jobs(scheduler, changed)
+    if changed or removed:
+        log_operation("system", "worker_sync", "success",
+                      f"worker {coordinator.worker_id}（共{len(members)}个）：负责{len(user_tasks)}个账号，"
+                      f"调度{len(changed)}个任务，移除{removed}个")
 
-# ======================== 工具函数 ========================
-def get_user_client(user_id):
-    """获取Pyrogram客户端"""
-    session_path = os.path.join(SESSION_DIR, f"user_{user_id}")
-    client = Client(
-        name=session_path,
-        api_id=API_ID,
-        api_hash=API_HASH,
-        workdir=SESSION_DIR
-    )
-    return client
+def run_worker(worker_id):
+    """任务执行 worker：只调度自己负责账号的任务，不启动机器人与Web服务
 
-def get_user_media_dir(user_id):
-    """获取用户媒体文件目录"""
-    media_dir = os.path.join(MEDIA_DIR, f"user_{user_id}")
-    os.makedirs(media_dir, exist_ok=True)
-    return media_dir
+    收到 SIGTERM/SIGINT 后先暂停调度器不再触发新作业，等待进行中的发送完成（最长 SHUTDOWN_TIMEOUT 秒）再断开连接退出。
+    """
+    global scheduler, coordinator
+    if RATE_LIMIT_BACKEND == "memory":
+        # 账号会在 worker 之间换手，进程内计数无法跟随，改用同一主机共享的 SQLite 计数
+        rate_limiter.store = SqliteRateStore(RATE_LIMIT_DB)
+    coordinator = WorkerCoordinator(WORKERS_DB, worker_id)
+    user_tasks.clear()
+    task_index.clear()
+    _worker_sync_state["reset_seq"] = account_resets.last_seq()  # 新进程没有旧连接，之前的重置通知无需处理
 
-def get_media_type(file_path):
-    """识别媒体文件类型"""
-    mime_type = magic.from_file(file_path, mime=True)
-    if mime_type.startswith("image/"):
-        return "photo"
-    elif mime_type.startswith("video/"):
-        return "video"
-    else:
-        return "document"
+    scheduler = create_scheduler()
+    sync_worker_tasks(scheduler)  # 首次同步在启动前完成，全部作业在 start() 时批量加入
+    scheduler.add_job(sync_worker_tasks, 'interval', seconds=WORKER_HEARTBEAT_INTERVAL, args=[scheduler],
+                      coalesce=True, max_instances=1)
+    scheduler.add_job(reload_banned_keywords, 'interval', seconds=KEYWORDS_RELOAD_INTERVAL, coalesce=True)
+    scheduler.add_job(rate_limiter.store.evict_idle, 'interval', minutes=10, coalesce=True)
+    scheduler.add_job(peer_cache.flush, 'interval', seconds=PEER_CACHE_FLUSH_INTERVAL, coalesce=True)
+    scheduler.start()
+    print(f"🛠️ 任务worker {worker_id} 已启动（pid {os.getpid()}）")
 
-# ======================== 消息发送函数 ========================
-@rate_limit
-def send_text_message(user_id, chat_id, text, parse_mode="markdown"):
-    """发送文本消息"""
-    # 内容风控
-    is_valid, msg = check_content(text)
-    if not is_valid:
-        log_operation(user_id, "send_text", "failed", f"内容违规：{msg}")
-        return False, msg
-    
-    client = get_user_client(user_id)
-    try:
-        client.start()
-        # 校验群组权限
-        client.get_chat(chat_id)
-        # 发送消息
-        client.send_message(chat_id, text, parse_mode=parse_mode)
-        client.stop()
-        log_operation(user_id, "send_text", "success", f"发送到{chat_id}，内容长度：{len(text)}")
-        return True, "文本消息发送成功"
-    except errors.ChatNotFound:
-        client.stop()
-        log_operation(user_id, "send_text", "failed", f"群组/用户不存在：{chat_id}")
-        return False, "无法发送：群组/用户不存在或你未加入该群组"
-    except Exception as e:
-        client.stop()
-        log_operation(user_id, "send_text", "failed", str(e))
-        return False, f"文本发送失败：{str(e)}"
+    wait_for_stop_signal()
 
-@rate_limit
-def send_media_message(user_id, chat_id, media_path, caption="", parse_mode="markdown"):
-    """发送媒体消息"""
-    # 内容风控
-    is_valid, msg = check_content(caption)
-    if not is_valid:
-        log_operation(user_id, "send_media", "failed", f"说明文字违规：{msg}")
-        return False, msg
-    
-    # 过滤可执行文件
-    banned_ext = [".exe", ".bat", ".sh", ".py", ".js"]
-    file_ext = os.path.splitext(media_path)[1].lower()
-    if file_ext in banned_ext:
-        log_operation(user_id, "send_media", "failed", f"禁止发送可执行文件：{file_ext}")
-        return False, "禁止发送可执行文件（exe/bat/sh等）"
-    
-    client = get_user_client(user_id)
-    try:
-        client.start()
-        # 校验群组权限
-        client.get_chat(chat_id)
-        # 发送媒体
-        media_type = get_media_type(media_path)
-        if media_type == "photo":
-            client.send_photo(chat_id, media_path, caption=caption, parse_mode=parse_mode)
-        elif media_type == "video":
-            client.send_video(chat_id, media_path, caption=caption, parse_mode=parse_mode)
-        else:
-            client.send_document(chat_id, media_path, caption=caption, parse_mode=parse_mode)
-        client.stop()
-        log_operation(user_id, "send_media", "success", f"发送到{chat_id}，文件：{os.path.basename(media_path)}")
-        return True, "媒体消息发送成功"
-    except errors.ChatNotFound:
-        client.stop()
-        log_operation(user_id, "send_media", "failed", f"群组/用户不存在：{chat_id}")
-        return False, "无法发送：群组/用户不存在或你未加入该群组"
-    except Exception as e:
-        client.stop()
-        log_operation(user_id, "send_media", "failed", str(e))
-        return False, f"媒体发送失败：{str(e)}"
+    # asyncio 模式下 scheduler.shutdown() 会取消仍在运行的作业协程，所以先暂停再等待发送完成
+    scheduler.pause()
+    unfinished = send_engine.drain(SHUTDOWN_TIMEOUT)
+    if unfinished:
+        log_operation("system", "worker_stop", "failed", f"worker {worker_id}：{unfinished}个发送未在{SHUTDOWN_TIMEOUT}秒内完成")
+    publish_task_stats()
+    scheduler.shutdown()
+    client_pool.shutdown()
+    send_engine.shutdown()
+    peer_cache.flush()
+    coordinator.leave()
+    metric_snapshots.remove(worker_id)
+    print(f"🛠️ 任务worker {worker_id} 已退出")
 
-def send_checkin_message(user_id, chat_id, checkin_cmd):
-    """发送签到指令"""
-    sensitive_cmds = ["/kick", "/ban", "/mute", "/unban", "/promote"]
-    if any(cmd in checkin_cmd for cmd in sensitive_cmds):
-        log_operation(user_id, "send_checkin", "failed", f"敏感指令：{checkin_cmd}")
-        return False, "禁止发送群组管理类敏感指令"
-    return send_text_message(user_id, chat_id, checkin_cmd)
+def spawn_task_workers(count):
+    """启动 count 个本机任务worker子进程（独立进程组，停止信号由父进程统一转发）"""
+    host = socket.gethostname()
+    return [
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), "--role", "worker", "--worker-id", f"{host}-{index}"],
+                         start_new_session=True)
+        for index in range(count)
+    ]
 
-# ======================== 定时任务执行函数 ========================
-def execute_task(task_id):
-    """执行定时任务"""
-    task_info = None
-    user_id = None
-    for uid, tasks in user_tasks.items():
-        if task_id in tasks:
-            user_id = uid
-            task_info = tasks[task_id]
-            break
-    
-    if not task_info:
-        log_operation("system", "execute_task", "failed", f"任务不存在：{task_id}")
-        return
-    
-    chat_id = task_info.get("chat_id")
-    task_type = task_info.get("type", "text")
-    
-    try:
-        if task_type == "checkin":
-            checkin_cmd = task_info["checkin_cmd"]
-            success, msg = send_checkin_message(user_id, chat_id, checkin_cmd)
-        elif task_type == "media":
-            media_path = task_info["media_path"]
-            caption = task_info.get("caption", "")
-            success, msg = send_media_message(user_id, chat_id, media_path, caption)
-        else:
-            text = task_info["text"]
-            success, msg = send_text_message(user_id, chat_id, text)
-        
-        log_operation(user_id, "execute_task", "success" if success else "failed", 
-                      f"任务ID：{task_id}，类型：{task_type}，结果：{msg}")
-    except Exception as e:
-        log_operation(user_id, "execute_task", "failed", f"任务ID：{task_id}，异常：{str(e)}")
+def wait_for_stop_signal(processes=()):
+    """阻塞到收到 SIGTERM/SIGINT；传入子进程时若其中之一意外退出则返回该进程"""
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    while not stop.wait(1):
+        for process in processes:
+            if process.poll() is not None:
+                return process
+    return None
+
+def terminate_processes(processes):
+    for process in processes:
+        if process.poll() is None:
+            process.terminate()
+
+def wait_processes(processes, timeout=SHUTDOWN_TIMEOUT + 5):
+    """等待已发送 SIGTERM 的子进程退出（worker 等待发送完成，gunicorn 等待请求完成），超时后强制结束
+
+    默认比子进程自身的等待时间多5秒，留出断开连接的时间。
+    """
+    deadline = time.monotonic() + timeout
+    for process in processes:
+        try:
+            process.wait(max(deadline - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
 
 # ======================== 按钮菜单构建（多级周期） ========================
 def build_main_menu():
     """构建主功能按钮菜单"""
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
     keyboard = [
         [InlineKeyboardButton("📝 添加文本任务", callback_data="add_text_task")],
         [InlineKeyboardButton("🔄 添加签到任务", callback_data="add_checkin_task")],
         [InlineKeyboardButton("🖼️ 添加媒体任务", callback_data="add_media_task")],
+        [InlineKeyboardButton("📢 添加广播任务", callback_data="add_broadcast_task")],
         [InlineKeyboardButton("📋 查看所有任务", callback_data="list_tasks")],
         [InlineKeyboardButton("🗑️ 删除任务", callback_data="delete_task")],
         [InlineKeyboardButton("🚫 删除所有数据", callback_data="delete_all")]
@@ -348,6 +3012,7 @@ def build_main_menu():
 
 def build_trigger_menu():
     """构建周期选择一级菜单（大类）"""
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
     keyboard = [
         [InlineKeyboardButton("⏱️ 一次性任务", callback_data="trigger_date")],
         [InlineKeyboardButton("📅 间隔重复", callback_data="trigger_interval_menu")],
@@ -357,6 +3022,7 @@ def build_trigger_menu():
 
 def build_interval_submenu():
     """间隔重复二级菜单"""
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
     keyboard = [
         [InlineKeyboardButton("每分钟重复", callback_data="interval_minute")],
         [InlineKeyboardButton("每小时重复", callback_data="interval_hour")],
@@ -369,6 +3035,7 @@ def build_interval_submenu():
 
 def build_cron_submenu():
     """日历规则二级菜单"""
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
     keyboard = [
         [InlineKeyboardButton("每天08:00执行", callback_data="cron_daily_0800")],
         [InlineKeyboardButton("每周一三五18:00", callback_data="cron_week135_1800")],
@@ -385,7 +3052,6 @@ def start(update: Update, context: CallbackContext):
     user_id = str(update.effective_user.id)
     if user_id not in user_tasks:
         user_tasks[user_id] = {}
-        save_user_tasks()
     
     session_file = os.path.join(SESSION_DIR, f"user_{user_id}.session")
     if os.path.exists(session_file):
@@ -412,11 +3078,11 @@ def button_callback(update: Update, context: CallbackContext):
         list_tasks(update, context)
     elif callback_data == "delete_all":
         delete_all(update, context)
-    elif callback_data in ["add_text_task", "add_checkin_task", "add_media_task"]:
+    elif callback_data in ["add_text_task", "add_checkin_task", "add_media_task", "add_broadcast_task"]:
         # 选择任务类型，进入周期选择一级菜单
         user_task_state[user_id] = {
             "step": "select_trigger",
-            "temp_data": {"task_type": callback_data.split("_")[1]}  # text/checkin/media
+            "temp_data": {"task_type": callback_data.split("_")[1]}  # text/checkin/media/broadcast
         }
         query.edit_message_text("请选择任务重复周期：", reply_markup=build_trigger_menu())
     elif callback_data == "delete_task":
@@ -448,21 +3114,8 @@ def button_callback(update: Update, context: CallbackContext):
         temp_data["trigger_type"] = callback_data
         
         # 设置间隔重复参数
-        if callback_data == "interval_minute":
-            temp_data["trigger_args"] = {"seconds": 60}
-            prompt = "请回复 **首次执行时间**（格式：YYYY-MM-DD HH:MM）："
-        elif callback_data == "interval_hour":
-            temp_data["trigger_args"] = {"hours": 1}
-            prompt = "请回复 **首次执行时间**（格式：YYYY-MM-DD HH:MM）："
-        elif callback_data == "interval_day":
-            temp_data["trigger_args"] = {"days": 1}
-            prompt = "请回复 **首次执行时间**（格式：YYYY-MM-DD HH:MM）："
-        elif callback_data == "interval_2day":
-            temp_data["trigger_args"] = {"days": 2}
-            prompt = "请回复 **首次执行时间**（格式：YYYY-MM-DD HH:MM）："
-        elif callback_data == "interval_week":
-            temp_data["trigger_args"] = {"weeks": 1}
-            prompt = "请回复 **首次执行时间**（格式：YYYY-MM-DD HH:MM）："
+        temp_data["trigger_args"] = dict(TRIGGER_PRESETS[callback_data])
+        prompt = "请回复 **首次执行时间**（格式：YYYY-MM-DD HH:MM）："
         
         user_task_state[user_id]["step"] = "input_time"
         user_task_state[user_id]["temp_data"] = temp_data
@@ -474,20 +3127,10 @@ def button_callback(update: Update, context: CallbackContext):
         temp_data["trigger_type"] = callback_data
         
         # 设置日历规则参数（时区默认Asia/Shanghai）
-        if callback_data == "cron_daily_0800":
-            temp_data["trigger_args"] = {"hour": 8, "minute": 0, "timezone": "Asia/Shanghai"}
-            prompt = "请回复 **首次执行日期**（格式：YYYY-MM-DD）："
-        elif callback_data == "cron_week135_1800":
-            temp_data["trigger_args"] = {"day_of_week": "1,3,5", "hour": 18, "minute": 0, "timezone": "Asia/Shanghai"}
-            prompt = "请回复 **首次执行日期**（格式：YYYY-MM-DD）："
-        elif callback_data == "cron_month1_0000":
-            temp_data["trigger_args"] = {"day": 1, "hour": 0, "minute": 0, "timezone": "Asia/Shanghai"}
+        temp_data["trigger_args"] = dict(TRIGGER_PRESETS[callback_data])
+        if callback_data == "cron_month1_0000":
             prompt = "请回复 **首次执行年份月份**（格式：YYYY-MM）："
-        elif callback_data == "cron_workday_0900":
-            temp_data["trigger_args"] = {"day_of_week": "1-5", "hour": 9, "minute": 0, "timezone": "Asia/Shanghai"}
-            prompt = "请回复 **首次执行日期**（格式：YYYY-MM-DD）："
-        elif callback_data == "cron_weekend_1000":
-            temp_data["trigger_args"] = {"day_of_week": "6,0", "hour": 10, "minute": 0, "timezone": "Asia/Shanghai"}
+        else:
             prompt = "请回复 **首次执行日期**（格式：YYYY-MM-DD）："
         
         user_task_state[user_id]["step"] = "input_time"
@@ -508,19 +3151,7 @@ def handle_user_input(update: Update, context: CallbackContext):
     # ===== 步骤1：输入时间（适配不同周期的时间格式）=====
     if step == "input_time":
         try:
-            trigger_type = temp_data["trigger_type"]
-            # 处理一次性/间隔重复（需要完整时间 YYYY-MM-DD HH:MM）
-            if trigger_type in ["date"] or trigger_type.startswith("interval_"):
-                task_time = datetime.datetime.strptime(input_text, "%Y-%m-%d %H:%M")
-                temp_data["start_time"] = task_time.strftime("%Y-%m-%d %H:%M")
-            # 处理日历规则-每月1号（仅需要 YYYY-MM）
-            elif trigger_type == "cron_month1_0000":
-                task_time = datetime.datetime.strptime(input_text, "%Y-%m")
-                temp_data["start_time"] = task_time.strftime("%Y-%m")
-            # 处理其他日历规则（仅需要 YYYY-MM-DD）
-            elif trigger_type.startswith("cron_"):
-                task_time = datetime.datetime.strptime(input_text, "%Y-%m-%d")
-                temp_data["start_time"] = task_time.strftime("%Y-%m-%d")
+            temp_data["start_time"] = normalize_start_time(temp_data["trigger_type"], input_text)
             
             # 根据任务类型提示输入下一个参数
             task_type = temp_data["task_type"]
@@ -533,6 +3164,9 @@ def handle_user_input(update: Update, context: CallbackContext):
             elif task_type == "media":
                 prompt = "请回复 **群组ID + 媒体文件名 + 说明**（示例：-123456789 pic1.jpg 今日福利）："
                 next_step = "input_media_info"
+            elif task_type == "broadcast":
+                prompt = f"请回复 **目标群组ID列表**（空格或逗号分隔，最多{BROADCAST_MAX_TARGETS}个）："
+                next_step = "input_broadcast_targets"
             
             user_task_state[user_id]["step"] = next_step
             user_task_state[user_id]["temp_data"] = temp_data
@@ -579,14 +3213,12 @@ def handle_user_input(update: Update, context: CallbackContext):
             media_filename = parts[1].strip()
             caption = parts[2].strip() if len(parts)>=3 else ""
             
-            media_dir = get_user_media_dir(user_id)
-            media_path = os.path.join(media_dir, media_filename)
-            if not os.path.exists(media_path):
+            if media_store.resolve(user_id, media_filename) is None:
                 update.message.reply_text("❌ 媒体文件不存在！")
                 return
             
             temp_data["chat_id"] = chat_id
-            temp_data["media_path"] = media_path
+            temp_data["media_name"] = os.path.basename(media_filename)
             temp_data["caption"] = caption
             create_scheduled_task(user_id, temp_data)
             del user_task_state[user_id]
@@ -594,73 +3226,96 @@ def handle_user_input(update: Update, context: CallbackContext):
         except ValueError:
             update.message.reply_text("格式错误！请回复：群组ID 媒体文件名 说明")
     
-    # ===== 步骤5：输入删除任务ID =====
+    # ===== 步骤5：输入广播目标与内容 =====
+    elif step == "input_broadcast_targets":
+        try:
+            temp_data["chat_ids"] = parse_chat_ids(input_text)
+            user_task_state[user_id]["step"] = "input_broadcast_content"
+            update.message.reply_text(
+                f"已选择{len(temp_data['chat_ids'])}个群组。请回复 **文本内容**，"
+                "或回复 `媒体:文件名 说明` 发送媒体（示例：媒体:pic1.jpg 今日福利）：",
+                parse_mode="markdown"
+            )
+        except ValueError as e:
+            update.message.reply_text(f"格式错误！{e}")
+
+    elif step == "input_broadcast_content":
+        try:
+            apply_broadcast_content(user_id, temp_data, input_text)
+            create_scheduled_task(user_id, temp_data)
+            del user_task_state[user_id]
+            update.message.reply_text(f"✅ 广播任务添加成功！（{len(temp_data['chat_ids'])}个群组）", reply_markup=build_main_menu())
+        except ValueError as e:
+            update.message.reply_text(f"❌ {e}")
+        except Exception as e:
+            update.message.reply_text(f"❌ 任务创建失败：{str(e)}")
+
+    # ===== 步骤6：输入删除任务ID =====
     elif step == "input_delete_task_id":
         task_id = input_text.strip()
+        refresh_task_index()
         if user_id not in user_tasks or task_id not in user_tasks[user_id]:
             update.message.reply_text("❌ 任务不存在或无权限！", reply_markup=build_main_menu())
         else:
-            try:
-                scheduler.remove_job(task_id)
-                del user_tasks[user_id][task_id]
-                save_user_tasks()
-                update.message.reply_text(f"✅ 任务 {task_id} 已删除！", reply_markup=build_main_menu())
-            except JobLookupError:
-                del user_tasks[user_id][task_id]
-                save_user_tasks()
-                update.message.reply_text(f"✅ 任务 {task_id} 记录已删除！", reply_markup=build_main_menu())
+            # 调度作业（含顺延作业）由负责该账号的worker在下次同步时移除
+            unindex_task(user_id, task_id)
+            task_store.delete(task_id)
+            task_stats.delete([task_id])
+            update.message.reply_text(f"✅ 任务 {task_id} 已删除！", reply_markup=build_main_menu())
         if user_id in user_task_state:
             del user_task_state[user_id]
 
+CHAT_ID_PATTERN = re.compile(r"^(-?\d+|@\w{4,})$")
+
+def parse_chat_ids(text):
+    """解析广播目标群组列表（空格/逗号/换行分隔，去重保序）"""
+    chat_ids = list(dict.fromkeys(part for part in re.split(r"[\s,，]+", text.strip()) if part))
+    if not chat_ids:
+        raise ValueError("请至少输入一个群组ID")
+    invalid = [chat_id for chat_id in chat_ids if not CHAT_ID_PATTERN.match(chat_id)]
+    if invalid:
+        raise ValueError(f"群组ID无效：{', '.join(invalid[:5])}")
+    if len(chat_ids) > BROADCAST_MAX_TARGETS:
+        raise ValueError(f"最多{BROADCAST_MAX_TARGETS}个群组，当前{len(chat_ids)}个")
+    return chat_ids
+
+def apply_broadcast_content(user_id, temp_data, text):
+    """广播内容：普通文本，或“媒体:文件名 说明”引用媒体库中的文件"""
+    for prefix in ("媒体:", "媒体：", "media:"):
+        if text.startswith(prefix):
+            parts = text[len(prefix):].strip().split(" ", 1)
+            media_name = os.path.basename(parts[0].strip())
+            if not media_name or media_store.resolve(user_id, media_name) is None:
+                raise ValueError("媒体文件不存在！")
+            temp_data["media_name"] = media_name
+            temp_data["caption"] = parts[1].strip() if len(parts) > 1 else ""
+            return
+    if not text:
+        raise ValueError("内容不能为空")
+    temp_data["content"] = text
+
 def create_scheduled_task(user_id, temp_data):
-    """创建定时任务（适配所有周期类型）"""
+    """创建定时任务（适配所有周期类型），返回任务ID"""
     task_type = temp_data["task_type"]
     trigger_type = temp_data["trigger_type"]
     trigger_args = temp_data["trigger_args"]
     start_time_str = temp_data["start_time"]
 
-    # 生成任务ID
-    task_id = f"{task_type}_{user_id}_{int(time.time())}"
+    # 生成任务ID（随机后缀：同一秒内创建多个同类任务时不会互相覆盖）
+    task_id = f"{task_type}_{user_id}_{int(time.time())}_{secrets.token_hex(4)}"
 
-    # 构建 APScheduler 触发器
+    # 构建 APScheduler 触发器并添加到调度器
     try:
-        if trigger_type == "date":
-            # 一次性任务
-            start_time = datetime.datetime.strptime(start_time_str, "%Y-%m-%d %H:%M")
-            trigger = start_time
-        elif trigger_type.startswith("interval_"):
-            # 间隔重复任务
-            start_time = datetime.datetime.strptime(start_time_str, "%Y-%m-%d %H:%M")
-            trigger = IntervalTrigger(start_date=start_time,** trigger_args, coalesce=True)  # 合并重叠任务
-        elif trigger_type.startswith("cron_"):
-            # 日历规则任务
-            if trigger_type == "cron_month1_0000":
-                # 每月1号：拼接完整时间
-                start_time = datetime.datetime.strptime(start_time_str + "-01 00:00", "%Y-%m-%d %H:%M")
-            else:
-                # 其他日历规则：拼接默认时间（00:00）
-                start_time = datetime.datetime.strptime(start_time_str + " 00:00", "%Y-%m-%d %H:%M")
-            trigger = CronTrigger(start_date=start_time, **trigger_args)
-        else:
-            raise ValueError(f"不支持的周期类型：{trigger_type}")
-
-        # 添加任务到调度器
-        scheduler.add_job(
-            execute_task,
-            trigger=trigger,
-            args=[task_id],
-            id=task_id,
-            replace_existing=True,
-            misfire_grace_time=300  # 任务错过执行后，允许延迟5分钟执行
-        )
+        # 校验周期参数；作业由负责该账号的worker同步任务后创建，这里只保存
+        build_trigger(trigger_type, trigger_args, start_time_str)
 
-        # 保存任务信息到 JSON
+        # 保存任务信息（广播任务的目标群组保存在 chat_ids 中）
         task_info = {
             "type": task_type,
             "trigger_type": trigger_type,
             "trigger_args": trigger_args,
             "start_time": start_time_str,
-            "chat_id": temp_data["chat_id"]
+            "chat_id": temp_data.get("chat_id")
         }
         # 补充任务类型相关字段
         if task_type == "text":
@@ -668,22 +3323,39 @@ def create_scheduled_task(user_id, temp_data):
         elif task_type == "checkin":
             task_info["checkin_cmd"] = temp_data["checkin_cmd"]
         elif task_type == "media":
-            task_info["media_path"] = temp_data["media_path"]
+            task_info["media_name"] = temp_data["media_name"]
             task_info["caption"] = temp_data["caption"]
+        elif task_type == "broadcast":
+            task_info["chat_ids"] = temp_data["chat_ids"]
+            if temp_data.get("media_name"):
+                task_info["media_name"] = temp_data["media_name"]
+                task_info["caption"] = temp_data.get("caption", "")
+            else:
+                task_info["text"] = temp_data["content"]
         
-        # 初始化用户任务字典
-        if user_id not in user_tasks:
-            user_tasks[user_id] = {}
-        user_tasks[user_id][task_id] = task_info
-        save_user_tasks()
+        # 登记任务（同步更新反向索引）
+        index_task(user_id, task_id, task_info)
+        task_store.upsert(user_id, task_id, task_info)
         log_operation(user_id, "create_task", "success", f"任务ID：{task_id}，周期：{trigger_type}")
+        return task_id
     except Exception as e:
         log_operation(user_id, "create_task", "failed", f"创建任务失败：{str(e)}")
         raise e
 
+def format_job_timing(timing):
+    """任务执行统计的简短描述（list_tasks 用）"""
+    text = f"⏱️ 已执行{timing['runs']}次"
+    if timing["lag_ms"]:
+        text += f"，延迟 p50/p90：{timing['lag_ms']['p50']:.0f}/{timing['lag_ms']['p90']:.0f}ms"
+        text += f"，耗时 p50：{timing['duration_ms']['p50']:.0f}ms"
+    if timing["missed"] or timing["skipped"]:
+        text += f"，错过{timing['missed']}次/跳过{timing['skipped']}次"
+    return text
+
 def list_tasks(update: Update, context: CallbackContext):
     """查看所有任务（优化周期描述）"""
     user_id = str(update.effective_user.id)
+    refresh_task_index()
     if user_id not in user_tasks or not user_tasks[user_id]:
         update.message.reply_text("📄 你还没有添加任何任务！")
         log_operation(user_id, "list_tasks", "success", "无任务")
@@ -704,6 +3376,7 @@ def list_tasks(update: Update, context: CallbackContext):
         "cron_weekend_1000": "周末10:00执行"
     }
 
+    stats = task_stats.get_many(user_tasks[user_id])  # worker发布的执行统计
     task_list = []
     for task_id, task_info in user_tasks[user_id].items():
         task_type = task_info.get("type", "text")
@@ -717,15 +3390,26 @@ def list_tasks(update: Update, context: CallbackContext):
                 f"⏰ 首次执行：{start_time}\n"
                 f"👥 群组：{task_info['chat_id']}\n"
                 f"📝 指令：{task_info['checkin_cmd']}\n"
-                "---"
             )
+        elif task_type == "broadcast":
+            content = f"🖼️ 文件：{task_info['media_name']}" if task_info.get("media_name") else f"📝 内容：{task_info['text'][:50]}..."
+            task_desc = (
+                f"🆔 {task_id}（广播-{trigger_desc}）\n"
+                f"⏰ 首次执行：{start_time}\n"
+                f"👥 群组：{len(task_info['chat_ids'])}个\n"
+                f"{content}\n"
+            )
+            last_run = stats.get(task_id, (None, None))[1]
+            if last_run:
+                sent = sum(1 for r in last_run["results"].values() if r["success"])
+                task_desc += f"📊 最近执行（{last_run['time']}）：成功{sent}/{len(task_info['chat_ids'])}"
+                task_desc += f"，待补发{len(last_run['pending'])}\n" if last_run["pending"] else "\n"
         elif task_type == "media":
             task_desc = (
                 f"🆔 {task_id}（媒体-{trigger_desc}）\n"
                 f"⏰ 首次执行：{start_time}\n"
                 f"👥 群组：{task_info['chat_id']}\n"
-                f"🖼️ 文件：{os.path.basename(task_info['media_path'])}\n"
-                "---"
+                f"🖼️ 文件：{task_info.get('media_name') or os.path.basename(task_info['media_path'])}\n"
             )
         else:
             task_desc = (
@@ -733,36 +3417,65 @@ def list_tasks(update: Update, context: CallbackContext):
                 f"⏰ 首次执行：{start_time}\n"
                 f"👥 发送到：{task_info['chat_id']}\n"
                 f"📝 内容：{task_info['text'][:50]}...\n"
-                "---"
             )
-        task_list.append(task_desc)
+        timing = stats.get(task_id, (None, None))[0]
+        if timing and (timing["runs"] or timing["missed"] or timing["skipped"]):
+            task_desc += format_job_timing(timing) + "\n"
+        task_list.append(task_desc + "---")
     
     update.message.reply_text("📋 你的所有任务：\n" + "\n".join(task_list))
     log_operation(user_id, "list_tasks", "success", f"查看{len(task_list)}个任务")
 
+HISTORY_PAGE_SIZE = 10
+HISTORY_RESULT_ICONS = {"success": "✅", "failed": "❌", "deferred": "⏳", "partial": "⚠️"}
+
+def show_history(update: Update, context: CallbackContext):
+    """查看最近的任务发送记录（/history [游标] 翻页）"""
+    user_id = str(update.effective_user.id)
+    before = context.args[0] if context.args and context.args[0].isdigit() else None
+    records, next_cursor = audit_log.query(user_id, operations=("execute_task",), before=before, limit=HISTORY_PAGE_SIZE)
+    if not records:
+        update.message.reply_text("📄 暂无发送记录" if not before else "📄 没有更早的记录了")
+        return
+
+    lines = []
+    for record in records:
+        icon = HISTORY_RESULT_ICONS.get(record.get("result"), "•")
+        line = f"{icon} {record.get('time', '')[:19]} 任务：{record.get('task_id', '-')} → {record.get('chat_id', '-')}"
+        if record.get("latency_ms") is not None:
+            line += f"（{record['latency_ms']:.0f}ms）"
+        if record.get("result") != "success":
+            line += f"\n    {record.get('error') or record.get('detail', '')[:80]}"
+        lines.append(line)
+    text = "🕘 最近的发送记录：\n" + "\n".join(lines)
+    if next_cursor:
+        text += f"\n\n更早的记录：/history {next_cursor}"
+    update.message.reply_text(text)
+
 def delete_all(update: Update, context: CallbackContext):
     """删除所有数据"""
     user_id = str(update.effective_user.id)
     try:
-        # 删除session文件
+        # 删除session文件，之后断开本进程与 worker 中的客户端并清除缓存（先删除文件，worker 不会再用旧session重连）
         session_file = os.path.join(SESSION_DIR, f"user_{user_id}.session")
         if os.path.exists(session_file):
             os.remove(session_file)
+        reset_account(user_id)
         
-        # 删除媒体文件
-        media_dir = get_user_media_dir(user_id)
+        # 删除媒体文件引用（其他用户仍在使用的内容保留），以及旧版的用户媒体目录
+        media_store.drop_user(user_id)
+        media_dir = os.path.join(MEDIA_DIR, f"user_{user_id}")
         if os.path.exists(media_dir):
             shutil.rmtree(media_dir)
         
         # 删除任务
+        refresh_task_index()
         if user_id in user_tasks:
             for task_id in user_tasks[user_id]:
-                try:
-                    scheduler.remove_job(task_id)
-                except:
-                    pass
+                task_index.pop(task_id, None)
+            task_stats.delete(user_tasks[user_id])
             del user_tasks[user_id]
-            save_user_tasks()
+            task_store.delete_user(user_id)
         
         update.message.reply_text("✅ 你的所有数据已删除，不可恢复！", reply_markup=build_main_menu())
         log_operation(user_id, "delete_all", "success", "删除所有数据")
@@ -770,58 +3483,322 @@ def delete_all(update: Update, context: CallbackContext):
         update.message.reply_text(f"❌ 数据删除失败：{str(e)}")
         log_operation(user_id, "delete_all", "failed", str(e))
 
+class DownloadPool:
+    """有界下载池：机器人收到的媒体在独立线程中下载，不占用 dispatcher 工作线程
+
+    同时下载数为 workers，另允许 max_pending 个排队；已满时 submit 返回 None。
+    """
+
+    def __init__(self, workers, max_pending):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="media-download")
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+
+    def submit(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            return None
+        future = self._executor.submit(func, *args)
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def shutdown(self, wait=False):
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+download_pool = DownloadPool(DOWNLOAD_WORKERS, DOWNLOAD_QUEUE_SIZE)
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_PROGRESS_INTERVAL = 3  # 进度消息最短编辑间隔（秒），避免触发Telegram编辑频率限制
+
+def download_telegram_file(file, tmp_path, on_progress=None):
+    """流式下载机器人文件到 tmp_path，边下载边计算SHA-256，返回哈希值
+
+    on_progress(已下载字节, 总字节) 按 DOWNLOAD_PROGRESS_INTERVAL 节流回调。
+    """
+    if not file.file_path.startswith(("http://", "https://")):
+        # 本地 Bot API 服务器返回的是本地路径，直接复制
+        file.download(tmp_path)
+        return file_sha256(tmp_path)
+
+    digest = hashlib.sha256()
+    received, last_report = 0, time.monotonic()
+    import requests
+    with requests.get(file.file_path, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        total = int(response.headers.get("Content-Length") or file.file_size or 0)
+        with open(tmp_path, "wb") as f:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                digest.update(chunk)
+                received += len(chunk)
+                if on_progress and time.monotonic() - last_report >= DOWNLOAD_PROGRESS_INTERVAL:
+                    last_report = time.monotonic()
+                    on_progress(received, total)
+    return digest.hexdigest()
+
+BOT_TOKEN_PATTERN = re.compile(r"/bot\d+:[\w-]+")
+
+def describe_download_error(e):
+    """下载失败的日志说明：异常类型加去掉Bot Token的异常信息
+
+    requests 的异常信息包含完整的文件URL（https://api.telegram.org/file/bot<Token>/...），不能原样输出。
+    """
+    message = BOT_TOKEN_PATTERN.sub("/bot<BOT_TOKEN>", str(e))
+    if BOT_TOKEN:
+        message = message.replace(BOT_TOKEN, "<BOT_TOKEN>")
+    return f"{type(e).__name__}：{message}"
+
+def edit_status(message, text):
+    """编辑上传状态消息（内容未变化、消息已删除等错误忽略）"""
+    try:
+        message.edit_text(text)
+    except Exception:
+        pass
+
+def process_media_download(bot, status_message, user_id, file_id, media_kind, filename):
+    """下载池中执行：下载媒体、收入媒体库并更新状态消息"""
+    labels = {"photo": "图片", "video": "视频", "document": "文档"}
+    label = labels[media_kind]
+    tmp_path = new_media_tmp_path()
+
+    def on_progress(received, total):
+        if total:
+            edit_status(status_message, f"⏳ 正在上传{label}… {received * 100 // total}%（{received // 1024}KB/{total // 1024}KB）")
+        else:
+            edit_status(status_message, f"⏳ 正在上传{label}… 已接收 {received // 1024}KB")
+
+    try:
+        file = bot.get_file(file_id)
+        sha256 = download_telegram_file(file, tmp_path, on_progress)
+        if media_kind == "photo":
+            filename = f"photo_{sha256[:12]}.jpg"
+        elif media_kind == "video":
+            filename = f"video_{sha256[:12]}.mp4"
+        # 图片/视频类型由Telegram确定，文档在收入媒体库时识别一次
+        media_type = media_kind if media_kind != "document" else None
+        media_store.put_file(user_id, filename, tmp_path, sha256, media_type=media_type)
+        edit_status(status_message, f"✅ {label}上传成功！\n文件ID：{filename}\n可用于媒体任务")
+        log_operation(user_id, "upload_media", "success", f"上传{label}：{filename}")
+    except Exception as e:
+        edit_status(status_message, "❌ 媒体上传失败，请稍后重试")
+        log_operation(user_id, "upload_media", "failed", describe_download_error(e))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
 def handle_media_upload(update: Update, context: CallbackContext):
-    """处理媒体文件上传"""
+    """处理媒体文件上传：立即回复上传状态，下载交给下载池完成后再编辑状态消息"""
     user_id = str(update.effective_user.id)
-    media_dir = get_user_media_dir(user_id)
     
     try:
         if update.message.photo:
-            photo = update.message.photo[-1]
-            file_id = photo.file_id
-            file = context.bot.get_file(file_id)
-            filename = f"photo_{int(time.time())}.jpg"
-            file_path = os.path.join(media_dir, filename)
-            file.download(file_path)
-            update.message.reply_text(f"✅ 图片上传成功！\n文件ID：{filename}\n可用于媒体任务")
-            log_operation(user_id, "upload_media", "success", f"上传图片：{filename}")
-        
+            file_id, media_kind, filename = update.message.photo[-1].file_id, "photo", None
         elif update.message.video:
-            video = update.message.video
-            file_id = video.file_id
-            file = context.bot.get_file(file_id)
-            filename = f"video_{int(time.time())}.mp4"
-            file_path = os.path.join(media_dir, filename)
-            file.download(file_path)
-            update.message.reply_text(f"✅ 视频上传成功！\n文件ID：{filename}\n可用于媒体任务")
-            log_operation(user_id, "upload_media", "success", f"上传视频：{filename}")
-        
+            file_id, media_kind, filename = update.message.video.file_id, "video", None
         elif update.message.document:
             doc = update.message.document
-            file_id = doc.file_id
-            file = context.bot.get_file(file_id)
-            filename = doc.file_name or f"doc_{int(time.time())}.bin"
+            filename = os.path.basename(doc.file_name or f"doc_{int(time.time())}.bin")
             banned_ext = [".exe", ".bat", ".sh", ".py", ".js"]
             file_ext = os.path.splitext(filename)[1].lower()
             if file_ext in banned_ext:
                 update.message.reply_text(f"❌ 禁止上传可执行文件：{file_ext}")
                 log_operation(user_id, "upload_media", "failed", f"禁止上传可执行文件：{filename}")
                 return
-            
-            file_path = os.path.join(media_dir, filename)
-            file.download(file_path)
-            update.message.reply_text(f"✅ 文档上传成功！\n文件ID：{filename}\n可用于媒体任务")
-            log_operation(user_id, "upload_media", "success", f"上传文档：{filename}")
+            file_id, media_kind = doc.file_id, "document"
+        else:
+            return
+
+        status_message = update.message.reply_text("⏳ 正在上传，请稍候…")
+        future = download_pool.submit(
+            process_media_download, context.bot, status_message, user_id, file_id, media_kind, filename
+        )
+        if future is None:
+            edit_status(status_message, "❌ 当前上传任务过多，请稍后再试")
+            log_operation(user_id, "upload_media", "failed", "下载队列已满")
     except Exception as e:
-        update.message.reply_text(f"❌ 媒体上传失败：{str(e)}")
-        log_operation(user_id, "upload_media", "failed", str(e))
+        update.message.reply_text("❌ 媒体上传失败，请稍后重试")
+        log_operation(user_id, "upload_media", "failed", describe_download_error(e))
+
+# ======================== 应用初始化 ========================
+_init_lock = threading.Lock()
+_initialized = False
+
+def init_app():
+    """创建数据目录、日志与审计写入线程、关键词匹配器、限流和各SQLite存储，并加载任务
+
+    导入模块不做这些事（工具脚本与基准可以直接 import app）；各角色启动时与 create_app() 中调用，重复调用无副作用。
+    """
+    global _initialized, audit_log, audit_writer, BANNED_KEYWORDS, keyword_matcher, _keywords_signature
+    global rate_limiter, metric_snapshots, task_store, peer_cache, media_store, media_cache, task_stats, account_resets
+    with _init_lock:
+        if _initialized:
+            return
+        for path in DATA_DIRS:
+            os.makedirs(path, exist_ok=True)
+        setup_logging()
+
+        audit_logger.addHandler(audit_handler)
+        audit_log = AuditLog(LOG_DIR, AUDIT_INDEX_DB)
+        audit_writer = AuditLogWriter(audit_queue, audit_log, audit_handler, AUDIT_BATCH_SIZE)
+        audit_writer.start()
+        atexit.register(audit_writer.stop)
+
+        BANNED_KEYWORDS = load_banned_keywords()
+        keyword_matcher = KeywordMatcher(BANNED_KEYWORDS)
+        _keywords_signature = _keywords_file_signature()
+        rate_limiter = RateLimiter(create_rate_store())
+
+        metric_snapshots = MetricsSnapshotStore(WORKERS_DB)
+        task_stats = TaskStatsStore(WORKERS_DB)
+        task_store = TaskStore(TASKS_DB)
+        peer_cache = PeerCache(db_path=PEER_CACHE_DB if PEER_CACHE_PERSIST else None)
+        media_store = MediaStore(MEDIA_BLOB_DIR, MEDIA_STORE_DB)
+        media_cache = MediaCache(MEDIA_CACHE_DB)
+        account_resets = AccountResetLog(WORKERS_DB)
+        import_legacy_media()
+        load_user_tasks()
+        _initialized = True
 
 # ======================== Flask Web服务 ========================
-app = Flask(__name__, static_folder=STATIC_DIR)
+# 视图函数在函数内导入 flask/werkzeug；路由先登记，create_app() 时注册到 Blueprint
+WEB_ROUTES = []  # [(rule, options, 视图函数)]
+WEB_BLUEPRINT = "web"
+_flask_app = None
+
+def route(rule, **options):
+    """登记路由（与 Blueprint.route 参数相同），不在导入时加载 flask"""
+    def decorator(func):
+        WEB_ROUTES.append((rule, options, func))
+        return func
+    return decorator
+
+# 禁止上传的可执行文件（扩展名 + 内容识别出的MIME类型）
+BANNED_UPLOAD_EXTENSIONS = {".exe", ".bat", ".sh", ".py", ".js"}
+BANNED_UPLOAD_MIME_TYPES = {
+    "application/x-dosexec", "application/x-msdownload", "application/x-executable",
+    "application/x-sharedlib", "application/x-pie-executable", "application/x-mach-binary",
+    "text/x-shellscript", "text/x-python", "text/x-script.python", "application/x-bat",
+    "text/javascript", "application/javascript",
+}
+
+class UploadSink:
+    """流式上传落盘：边接收边写临时文件、计算SHA-256并检查大小，首段数据识别MIME类型
+
+    内存占用与文件大小无关；超限或类型不符时立即中断接收。
+    """
+
+    SNIFF_BYTES = 2048
+
+    def __init__(self, filename, max_bytes, tmp_dir, validator):
+        self.filename = os.path.basename(filename)
+        self.max_bytes = max_bytes
+        self.validator = validator
+        self.tmp_path = os.path.join(tmp_dir, f".{os.getpid()}_{threading.get_ident()}_{time.time_ns()}.part")
+        self.size = 0
+        self.mime_type = None
+        self._head = b""
+        self._sha256 = hashlib.sha256()
+        self._file = open(self.tmp_path, "w+b")
+
+    def write(self, data):
+        from werkzeug.exceptions import RequestEntityTooLarge
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.close()
+            raise RequestEntityTooLarge(f"文件过大，最大{self.max_bytes // (1024 * 1024)}MB")
+        if self.mime_type is None:
+            self._head += data[:self.SNIFF_BYTES - len(self._head)]
+            if len(self._head) >= self.SNIFF_BYTES:
+                self._sniff()
+        self._sha256.update(data)
+        self._file.write(data)
+        return len(data)
+
+    def _sniff(self):
+        from werkzeug.exceptions import HTTPException
+        import magic
+        self.mime_type = magic.from_buffer(self._head, mime=True)
+        try:
+            self.validator(self)
+        except HTTPException:
+            self.close()
+            raise
 
-@app.route('/login')
+    def seek(self, offset, whence=0):
+        # 表单解析结束时会调用 seek(0)，此时文件已接收完整（小于识别长度的文件在这里识别）
+        if self.mime_type is None:
+            self._sniff()
+        return self._file.seek(offset, whence)
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def tell(self):
+        return self._file.tell()
+
+    @property
+    def sha256(self):
+        return self._sha256.hexdigest()
+
+    @property
+    def head(self):
+        return self._head
+
+    def finish(self):
+        """接收完成：刷新并关闭临时文件，之后可原子重命名到目标位置"""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+    def close(self):
+        """关闭并删除未被取走的临时文件"""
+        if not self._file.closed:
+            self._file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+def validate_media_upload(sink):
+    """媒体上传校验：扩展名在开始接收前检查，内容类型在收到首段数据后检查"""
+    from werkzeug.exceptions import UnsupportedMediaType
+    file_ext = os.path.splitext(sink.filename)[1].lower()
+    if file_ext in BANNED_UPLOAD_EXTENSIONS:
+        raise UnsupportedMediaType("禁止上传可执行文件")
+    if sink.mime_type in BANNED_UPLOAD_MIME_TYPES:
+        raise UnsupportedMediaType(f"禁止上传可执行文件：{sink.mime_type}")
+
+def validate_session_upload(sink):
+    """Session上传校验：必须是.session扩展名的SQLite数据库文件"""
+    from werkzeug.exceptions import UnsupportedMediaType
+    if not sink.filename.endswith(".session"):
+        raise UnsupportedMediaType("请上传.session文件")
+    if sink.mime_type is not None and not sink.head.startswith(b"SQLite format 3\x00"):
+        raise UnsupportedMediaType("Session文件格式无效")
+
+# {视图函数名: (大小上限, 临时目录, 校验函数)}，临时目录与目标目录同一文件系统，保证原子重命名
+UPLOAD_POLICIES = {
+    "upload_media": (MEDIA_UPLOAD_MAX_MB * 1024 * 1024, MEDIA_TMP_DIR, validate_media_upload),
+    "upload_session": (SESSION_UPLOAD_MAX_MB * 1024 * 1024, SESSION_DIR, validate_session_upload),
+}
+
+class StreamingUploadMixin:
+    """上传接口的文件部分直接写入 UploadSink，而不是先整体缓存再保存（与 flask.Request 组合使用）"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        from werkzeug.exceptions import HTTPException
+        policy = UPLOAD_POLICIES.get((self.endpoint or "").rpartition(".")[2])  # 去掉 Blueprint 前缀
+        if policy is None:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        max_bytes, tmp_dir, validator = policy
+        sink = UploadSink(filename or "", max_bytes, tmp_dir, validator)
+        try:
+            validator(sink)  # 文件名类检查在接收内容之前完成
+        except HTTPException:
+            sink.close()
+            raise
+        return sink
+
+@route('/login')
 def login_page():
     """登录页面"""
+    from flask import render_template, request
     user_id = request.args.get('user_id', '')
     return render_template(
         'login.html',
@@ -831,98 +3808,434 @@ def login_page():
         user_id=user_id
     )
 
-@app.route('/privacy')
+@route('/privacy')
 def privacy_page():
     """隐私政策"""
+    from flask import send_from_directory
     return send_from_directory(STATIC_DIR, 'privacy.html')
 
-@app.route('/auth')
+@route('/auth')
 def telegram_auth():
     """授权回调"""
+    from flask import redirect, request, url_for
     user_id = request.args.get('id', '')
     log_operation(user_id, "telegram_auth", "success", "扫码授权成功")
-    return redirect(url_for('login_page', user_id=user_id))
+    return redirect(url_for('.login_page', user_id=user_id))
 
-@app.route('/upload_session', methods=['POST'])
+@route('/upload_session', methods=['POST'])
 def upload_session():
-    """上传Session文件"""
+    """上传Session文件（流式接收，校验通过后原子替换）"""
+    from flask import jsonify, request
+    from werkzeug.exceptions import HTTPException
     try:
         user_id = request.form.get('user_id')
         session_file = request.files.get('session_file')
-        
+    except HTTPException as e:
+        log_operation("unknown", "upload_session", "failed", e.description)
+        return jsonify({"success": False, "message": e.description}), e.code
+    
+    try:
         if not user_id or not session_file:
             return jsonify({"success": False, "message": "缺少参数"})
+        if not user_id.isdigit():
+            return jsonify({"success": False, "message": "用户ID无效"})
         
-        if not session_file.filename.endswith('.session'):
-            return jsonify({"success": False, "message": "请上传.session文件"})
-        
+        sink = session_file.stream
+        sink.finish()
         save_path = os.path.join(SESSION_DIR, f"user_{user_id}.session")
-        session_file.save(save_path)
-        set_file_permission(save_path)
+        set_file_permission(sink.tmp_path)
+        os.replace(sink.tmp_path, save_path)
+        reset_account(user_id)  # 旧连接失效（包括 worker 中的），下次发送时用新session重连
         
         log_operation(user_id, "upload_session", "success", f"上传session文件：{session_file.filename}")
         return jsonify({"success": True, "message": "Session文件上传成功"})
     except Exception as e:
-        log_operation(request.form.get('user_id', 'unknown'), "upload_session", "failed", str(e))
+        log_operation(user_id or "unknown", "upload_session", "failed", str(e))
         return jsonify({"success": False, "message": str(e)})
 
-@app.route('/upload_media', methods=['POST'])
+@route('/upload_media', methods=['POST'])
 def upload_media():
-    """Web端上传媒体"""
+    """Web端上传媒体（流式接收，边收边算哈希，收完直接收入媒体库）"""
+    from flask import jsonify, request
+    from werkzeug.exceptions import HTTPException
     try:
         user_id = request.form.get('user_id')
         media_file = request.files.get('media_file')
-        
+    except HTTPException as e:
+        log_operation("unknown", "web_upload_media", "failed", e.description)
+        return jsonify({"success": False, "message": e.description}), e.code
+    
+    try:
         if not user_id or not media_file:
             return jsonify({"success": False, "message": "缺少参数"})
+        if not user_id.isdigit():
+            return jsonify({"success": False, "message": "用户ID无效"})
         
-        banned_ext = [".exe", ".bat", ".sh", ".py", ".js"]
-        file_ext = os.path.splitext(media_file.filename)[1].lower()
-        if file_ext in banned_ext:
-            return jsonify({"success": False, "message": "禁止上传可执行文件"})
+        sink = media_file.stream
+        sink.finish()
+        filename = sink.filename
+        media_store.put_file(user_id, filename, sink.tmp_path, sink.sha256, media_type_from_mime(sink.mime_type))
         
-        media_dir = get_user_media_dir(user_id)
-        filename = media_file.filename
-        save_path = os.path.join(media_dir, filename)
-        media_file.save(save_path)
-        
-        log_operation(user_id, "web_upload_media", "success", f"上传媒体：{filename}")
+        log_operation(user_id, "web_upload_media", "success", f"上传媒体：{filename}，{sink.size}字节")
         return jsonify({
             "success": True,
             "message": "媒体文件上传成功",
             "filename": filename
         })
     except Exception as e:
-        log_operation(request.form.get('user_id', 'unknown'), "web_upload_media", "failed", str(e))
+        log_operation(user_id or "unknown", "web_upload_media", "failed", str(e))
         return jsonify({"success": False, "message": str(e)})
 
-# ======================== 主程序启动 ========================
-if __name__ == "__main__":
-    # 初始化调度器
+def require_admin_token(view):
+    """管理接口校验请求头 X-Admin-Token；未配置 ADMIN_TOKEN 时拒绝访问"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        from flask import jsonify, request
+        token = request.headers.get("X-Admin-Token", "")
+        if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN):
+            return jsonify({"success": False, "message": "未授权"}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+@route('/metrics')
+def metrics_endpoint():
+    """Prometheus 文本格式指标（汇总机器人与各 worker 进程发布的样本）；配置了 ADMIN_TOKEN 时需携带 Authorization: Bearer 令牌或 X-Admin-Token"""
+    from flask import jsonify, request
+    if ADMIN_TOKEN:
+        token = request.headers.get("X-Admin-Token") or request.headers.get("Authorization", "").removeprefix("Bearer ")
+        if not hmac.compare_digest(token, ADMIN_TOKEN):
+            return jsonify({"success": False, "message": "未授权"}), 403
+    parts = metric_snapshots.collect(WORKER_TTL)
+    if webhook_dispatcher is not None:
+        # webhook 模式只有一个Web工作进程，直接附上本进程（dispatcher 所在进程）的样本
+        parts.append(metrics.samples(("process",), (WEB_PROCESS,)))
+    return metrics.render(parts), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@route('/api/tasks', methods=['POST'])
+@require_admin_token
+def create_task_api():
+    """创建定时任务（JSON）：user_id、type（text/checkin/media/broadcast）、trigger_type、start_time 必填；
+    broadcast 需 chat_ids 列表及 text 或 media_name/caption，其余类型需 chat_id 及对应内容字段"""
+    from flask import jsonify, request
+    data = request.get_json(silent=True) or {}
+    user_id = str(data.get("user_id", ""))
+    task_type = data.get("type")
+    trigger_type = data.get("trigger_type", "date")
+    if not user_id.isdigit() or task_type not in ("text", "checkin", "media", "broadcast"):
+        return jsonify({"success": False, "message": "参数无效：user_id/type"}), 400
+    if trigger_type not in TRIGGER_PRESETS:
+        return jsonify({"success": False, "message": f"未知周期类型：{trigger_type}"}), 400
+
+    try:
+        start_time = normalize_start_time(trigger_type, str(data.get("start_time", "")))
+    except ValueError:
+        return jsonify({"success": False, "message": "start_time 格式错误（一次性/间隔：YYYY-MM-DD HH:MM，"
+                                                     "每月1号：YYYY-MM，其他日历规则：YYYY-MM-DD）"}), 400
+
+    try:
+        temp_data = {
+            "task_type": task_type,
+            "trigger_type": trigger_type,
+            "trigger_args": dict(TRIGGER_PRESETS[trigger_type]),
+            "start_time": start_time,
+        }
+        if task_type == "broadcast":
+            chat_ids = data.get("chat_ids")
+            if not isinstance(chat_ids, list):
+                raise ValueError("chat_ids 必须是列表")
+            temp_data["chat_ids"] = parse_chat_ids(" ".join(str(chat_id) for chat_id in chat_ids))
+            if data.get("media_name"):
+                apply_broadcast_content(user_id, temp_data, f"media:{data['media_name']} {data.get('caption', '')}")
+            else:
+                apply_broadcast_content(user_id, temp_data, str(data.get("text", "")).strip())
+        else:
+            chat_id = str(data.get("chat_id", "")).strip()
+            if not CHAT_ID_PATTERN.match(chat_id):
+                raise ValueError("chat_id 无效")
+            temp_data["chat_id"] = chat_id
+            if task_type == "text":
+                temp_data["content"] = data["text"]
+            elif task_type == "checkin":
+                temp_data["checkin_cmd"] = data["checkin_cmd"]
+            else:
+                media_name = os.path.basename(data["media_name"])
+                if media_store.resolve(user_id, media_name) is None:
+                    raise ValueError("媒体文件不存在！")
+                temp_data["media_name"] = media_name
+                temp_data["caption"] = data.get("caption", "")
+    except KeyError as e:
+        return jsonify({"success": False, "message": f"缺少参数：{e.args[0]}"}), 400
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+
+    try:
+        task_id = create_scheduled_task(user_id, temp_data)
+    except Exception as e:
+        return jsonify({"success": False, "message": f"任务创建失败：{str(e)}"}), 500
+    return jsonify({"success": True, "task_id": task_id})
+
+@route('/api/tasks/<task_id>')
+@require_admin_token
+def task_detail_api(task_id):
+    """任务详情；广播任务附带最近一次执行的逐群组结果"""
+    from flask import jsonify
+    refresh_task_index()
+    user_id, task_info = find_task(task_id)
+    if not task_info:
+        return jsonify({"success": False, "message": "任务不存在"}), 404
+    return jsonify({"success": True, "user_id": user_id, "task": task_info,
+                    "last_run": task_stats.get(task_id)[1]})
+
+@route('/api/jobs/timing')
+@require_admin_token
+def job_timing_api():
+    """调度延迟与执行耗时百分位：task_id 或 user_id 查询指定任务，都不传时返回各 worker 全部作业的汇总"""
+    from flask import jsonify, request
+    task_id = request.args.get('task_id')
+    user_id = request.args.get('user_id')
+    if task_id:
+        task_ids = [task_id]
+    elif user_id:
+        refresh_task_index()
+        task_ids = list(user_tasks.get(user_id, {}))
+    else:
+        return jsonify({"success": True, "overall": task_stats.overall()})
+    stats = task_stats.get_many(task_ids)
+    return jsonify({"success": True, "tasks": {tid: timing for tid, (timing, _) in stats.items() if timing}})
+
+@route('/api/history')
+@require_admin_token
+def history_api():
+    """分页查询用户审计记录：user_id 必填，operation（逗号分隔）/day（YYYY-MM-DD）/before（游标）/limit 可选"""
+    from flask import jsonify, request
+    user_id = request.args.get('user_id', '')
+    if not user_id:
+        return jsonify({"success": False, "message": "缺少参数"}), 400
+    operations = [op for op in request.args.get('operation', '').split(',') if op]
+    before = request.args.get('before', '')
+    limit = min(request.args.get('limit', 50, type=int), 500)
+    records, next_cursor = audit_log.query(
+        user_id, operations=operations, day=request.args.get('day') or None,
+        before=before if before.isdigit() else None, limit=limit
+    )
+    return jsonify({"success": True, "records": records, "next": next_cursor})
+
+# ======================== Telegram Webhook ========================
+WEBHOOK_PATH = "/telegram/webhook"
+WEBHOOK_SECRET_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,256}$")  # Telegram 对 secret_token 的字符要求
+WEB_PROCESS = f"web-{socket.gethostname()}"  # webhook 模式下Web进程指标的 process 标签
+
+webhook_dispatcher = None  # webhook 模式下只在（唯一的）Web工作进程中创建
+metrics.register(Gauge("tg_webhook_queue_size", "webhook 待处理更新数", lambda: webhook_dispatcher.update_queue.qsize()))
+
+def register_handlers(dispatcher):
+    from telegram.ext import CallbackQueryHandler, CommandHandler, Filters, MessageHandler
+    dispatcher.add_handler(CommandHandler("start", start))
+    dispatcher.add_handler(CommandHandler("history", show_history))
+    dispatcher.add_handler(CallbackQueryHandler(button_callback))
+    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_user_input))
+    dispatcher.add_handler(MessageHandler(Filters.photo | Filters.video | Filters.document, handle_media_upload))
+
+def webhook_url():
+    return f"{(DOMAIN or '').rstrip('/')}{WEBHOOK_PATH}"
+
+def set_bot_webhook():
+    """webhook 模式：向 Telegram 登记回调地址与校验令牌（机器人角色启动时调用一次）"""
+    if not (DOMAIN or "").startswith("https://"):
+        raise RuntimeError("webhook 模式需要 HTTPS 的 DOMAIN")
+    if not WEBHOOK_SECRET_PATTERN.match(WEBHOOK_SECRET):
+        raise RuntimeError("webhook 模式需要 WEBHOOK_SECRET（1-256位字母、数字、_ 或 -）")
+    from telegram import Bot
+    Bot(BOT_TOKEN).set_webhook(url=webhook_url(), secret_token=WEBHOOK_SECRET)
+
+def _run_webhook_dispatcher(dispatcher):
+    # dispatcher 启动时需要读取机器人信息（getMe），失败会直接结束线程，所以先重试到成功
+    from telegram.error import TelegramError
+    while True:
+        try:
+            dispatcher.bot.get_me()
+            break
+        except TelegramError as e:
+            print(f"⚠️ 获取机器人信息失败，5秒后重试：{e}")
+            time.sleep(5)
+    dispatcher.start()
+
+def start_webhook_dispatcher():
+    """webhook 模式下在Web工作进程中启动 dispatcher（gunicorn post_worker_init 调用）
+
+    路由校验后把更新放入有界队列，由 dispatcher 线程按顺序处理；按钮交互状态在进程内存中，所以只能有一个工作进程。
+    """
+    global webhook_dispatcher
+    if BOT_MODE != "webhook" or webhook_dispatcher is not None:
+        return
+    from telegram import Bot
+    from telegram.ext import Dispatcher
+    dispatcher = Dispatcher(Bot(BOT_TOKEN), queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE), use_context=True)
+    register_handlers(dispatcher)
+    threading.Thread(target=_run_webhook_dispatcher, args=(dispatcher,), name="webhook-dispatcher", daemon=True).start()
+    webhook_dispatcher = dispatcher
+    print(f"🤖 Telegram Bot webhook 已启动（pid {os.getpid()}）")
+
+def stop_webhook_dispatcher(timeout=SHUTDOWN_TIMEOUT):
+    """处理完队列中已接收的更新后停止 dispatcher（gunicorn worker_exit 调用）；之后到达的更新返回503由Telegram重试"""
+    global webhook_dispatcher
+    dispatcher, webhook_dispatcher = webhook_dispatcher, None
+    if dispatcher is None:
+        return
+    deadline = time.monotonic() + timeout
+    while dispatcher.running and not dispatcher.update_queue.empty() and time.monotonic() < deadline:
+        time.sleep(0.1)
+    if dispatcher.running:
+        dispatcher.stop()
+
+@route(WEBHOOK_PATH, methods=['POST'])
+def telegram_webhook():
+    """Telegram 推送更新：校验 X-Telegram-Bot-Api-Secret-Token，放入有界队列后立即返回"""
+    from flask import jsonify, request
+    if BOT_MODE != "webhook":
+        return jsonify({"success": False, "message": "未启用webhook"}), 404
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not WEBHOOK_SECRET or not hmac.compare_digest(token, WEBHOOK_SECRET):
+        WEBHOOK_UPDATES.inc("unauthorized")
+        return jsonify({"success": False, "message": "未授权"}), 403
+    dispatcher = webhook_dispatcher
+    if dispatcher is None:
+        return jsonify({"success": False, "message": "服务未就绪"}), 503
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or "update_id" not in data:
+        WEBHOOK_UPDATES.inc("invalid")
+        return jsonify({"success": False, "message": "更新格式错误"}), 400
+    from telegram import Update
+    try:
+        dispatcher.update_queue.put_nowait(Update.de_json(data, dispatcher.bot))
+    except queue.Full:
+        WEBHOOK_UPDATES.inc("queue_full")
+        return jsonify({"success": False, "message": "队列已满"}), 503, {"Retry-After": "1"}
+    WEBHOOK_UPDATES.inc("accepted")
+    return jsonify({"success": True})
+
+# ======================== Web应用工厂 ========================
+def create_app():
+    """创建 Flask 应用（gunicorn 入口 app:create_app()）：执行 init_app() 并把登记的路由注册到 Blueprint，同一进程内只创建一次"""
+    global _flask_app
+    if _flask_app is not None:
+        return _flask_app
+    from flask import Blueprint, Flask, Request
+    init_app()
+
+    web = Blueprint(WEB_BLUEPRINT, __name__)
+    for rule, options, func in WEB_ROUTES:
+        web.add_url_rule(rule, view_func=func, **options)
+    flask_app = Flask(__name__, static_folder=STATIC_DIR, template_folder=BASE_DIR)
+    flask_app.request_class = type("StreamingUploadRequest", (StreamingUploadMixin, Request), {})
+    # 请求体总上限（Content-Length超限时在读取前直接拒绝），单文件上限由 UPLOAD_POLICIES 控制
+    flask_app.config["MAX_CONTENT_LENGTH"] = (max(MEDIA_UPLOAD_MAX_MB, SESSION_UPLOAD_MAX_MB) + 1) * 1024 * 1024
+    flask_app.register_blueprint(web)
+    _flask_app = flask_app
+    return flask_app
+
+def __getattr__(name):
+    # 兼容旧的 app:app 入口（gunicorn app:app、flask --app app）：首次访问 app.app 时才创建应用
+    if name == "app":
+        return create_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# ======================== 进程角色 ========================
+APP_ROLES = ("all", "bot", "web", "worker")
+GUNICORN_CONF = os.path.join(BASE_DIR, "gunicorn.conf.py")
+BOT_PROCESS = f"bot-{socket.gethostname()}"  # 机器人进程发布指标时的 process 标签
+# 各角色启动前检查的配置（Web角色由 gunicorn 启动，不需要账号凭据）
+ROLE_REQUIRED_CONFIG = {
+    "all": ("BOT_TOKEN", "API_ID", "API_HASH"),
+    "bot": ("BOT_TOKEN", "API_ID", "API_HASH"),
+    "worker": ("API_ID", "API_HASH"),
+    "web": (),
+}
+
+def gunicorn_command():
+    return [sys.executable, "-m", "gunicorn", "-c", GUNICORN_CONF, "app:create_app()"]
+
+def spawn_web_server():
+    """启动 gunicorn 子进程提供Web服务（多工作进程，上传等慢请求不占用机器人/调度器所在的解释器）"""
+    return subprocess.Popen(gunicorn_command(), cwd=BASE_DIR, start_new_session=True)
+
+def run_bot():
+    """机器人角色：长轮询处理交互（webhook 模式下只登记回调地址，由Web进程处理），
+    附带日志清理与关键词重载等维护作业；定时任务由 worker 执行
+    """
+    from apscheduler.schedulers.background import BackgroundScheduler
+    from telegram.ext import Updater
+    global scheduler
     scheduler = BackgroundScheduler()
     scheduler.add_job(clean_expired_logs, 'cron', hour=0, minute=0)
+    scheduler.add_job(clean_expired_logs)  # 启动时执行一次，尽快拆分旧版日志
+    scheduler.add_job(reload_banned_keywords, 'interval', seconds=KEYWORDS_RELOAD_INTERVAL, coalesce=True)
+    scheduler.add_job(publish_metrics, 'interval', seconds=WORKER_HEARTBEAT_INTERVAL, args=[BOT_PROCESS], coalesce=True)
+    scheduler.add_job(task_store.prune_changes, 'interval', hours=1, coalesce=True)
+    scheduler.add_job(account_resets.prune, 'interval', hours=1, coalesce=True)
     scheduler.start()
-    print("⏰ APScheduler 定时任务调度器已启动")
+    print("⏰ 维护作业调度器已启动")
 
-    # 初始化Telegram Bot
+    if BOT_MODE == "webhook":
+        set_bot_webhook()
+        print(f"🤖 Telegram Bot webhook 已登记 ({webhook_url()})")
+        return None
     updater = Updater(BOT_TOKEN)
-    dp = updater.dispatcher
-    
-    # 注册处理器
-    dp.add_handler(CommandHandler("start", start))
-    dp.add_handler(CallbackQueryHandler(button_callback))
-    dp.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_user_input))
-    dp.add_handler(MessageHandler(Filters.photo | Filters.video | Filters.document, handle_media_upload))
-    
-    # 启动Bot
-    updater.start_polling()
+    register_handlers(updater.dispatcher)
+    updater.start_polling()  # 会删除已登记的 webhook，切回长轮询无需额外操作
     print(f"🤖 Telegram Bot 已启动 (@{BOT_USERNAME})")
+    return updater
 
-    # 启动Flask Web服务
-    app.template_folder = BASE_DIR
-    print(f"🌐 Flask Web服务已启动 ({DOMAIN})")
-    app.run(host=FLASK_HOST, port=FLASK_PORT, debug=False)
-
-    # 停止调度器
+def stop_bot(updater):
+    """停止拉取更新并等待处理中的消息与下载完成"""
+    if updater is not None:
+        updater.stop()
     scheduler.shutdown()
-    updater.idle()
\ No newline at end of file
+    download_pool.shutdown(wait=True)
+    metric_snapshots.remove(BOT_PROCESS)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Telegram 定时发送服务")
+    parser.add_argument("--role", default=APP_ROLE,
+                        help="all：机器人+Web+任务worker（默认，读取 APP_ROLE）；bot / web / worker：只运行对应角色")
+    parser.add_argument("--worker-id", help="worker 角色的ID，默认为 主机名-进程号")
+    args = parser.parse_args(argv)
+    if args.role not in APP_ROLES:
+        parser.error(f"未知角色：{args.role}（可选 {' / '.join(APP_ROLES)}）")
+    missing = [name for name in ROLE_REQUIRED_CONFIG[args.role] if not globals()[name]]
+    if missing:
+        parser.error(f"缺少配置：{', '.join(missing)}（见 .env.example）")
+
+    if args.role != "web":
+        init_app()
+    if args.role == "worker":
+        run_worker(args.worker_id or f"{socket.gethostname()}-{os.getpid()}")
+        return 0
+    if args.role == "web":
+        os.chdir(BASE_DIR)
+        os.execv(sys.executable, gunicorn_command())
+
+    children, bot_started, exited = [], False, None
+    try:
+        if args.role == "all":
+            children.append(spawn_web_server())
+            print(f"🌐 Flask Web服务已启动 ({DOMAIN}，gunicorn {WEB_WORKERS}个进程)")
+            children.extend(spawn_task_workers(TASK_WORKERS))
+            print(f"🛠️ 已启动{TASK_WORKERS}个任务worker")
+        updater = run_bot()
+        bot_started = True
+        exited = wait_for_stop_signal(children)
+        if exited is not None:
+            print(f"⚠️ 子进程 {' '.join(exited.args[2:])} 意外退出（返回码 {exited.returncode}），停止全部服务")
+    finally:
+        # 子进程同时开始各自的退出流程，机器人停止后再统一等待；启动失败时同样结束已启动的子进程
+        terminate_processes(children)
+        if bot_started:
+            stop_bot(updater)
+        wait_processes(children)
+        print("👋 已退出")
+    return 1 if exited is not None else 0
+
+# ======================== 主程序启动 ========================
+if __name__ == "__main__":
+    sys.exit(main())
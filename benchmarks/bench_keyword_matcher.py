@@ -0,0 +1,49 @@
+"""违规关键词匹配基准：对比逐个 `keyword in content` 与 KeywordMatcher 自动机
+
+用法：python benchmarks/bench_keyword_matcher.py
+"""
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("API_ID", "0")
+
+import app  # noqa: E402
+
+SIZES = [10, 1_000, 50_000]
+MESSAGE_COUNT = 200
+MESSAGE_LENGTH = 300
+# 常用汉字区间，随机生成关键词与消息
+CHARSET = [chr(code) for code in range(0x4E00, 0x4E00 + 3000)]
+
+
+def random_text(rng, length):
+    return "".join(rng.choice(CHARSET) for _ in range(length))
+
+
+def loop_check(keywords, content):
+    """旧实现：逐个关键词做子串查找"""
+    for keyword in keywords:
+        if keyword in content:
+            return False
+    return True
+
+
+def main():
+    rng = random.Random(42)
+    # 合规消息是常态，也是旧实现的最坏情况（需要遍历全部关键词）
+    messages = [random_text(rng, MESSAGE_LENGTH) for _ in range(MESSAGE_COUNT)]
+    print(f"{'关键词数':>8} {'编译(ms)':>10} {'循环(us/条)':>12} {'自动机(us/条)':>14}")
+    for size in SIZES:
+        keywords = list({random_text(rng, rng.randint(3, 6)) for _ in range(size)})
+        build = timeit.timeit(lambda: app.KeywordMatcher(keywords), number=1) * 1e3
+        matcher = app.KeywordMatcher(keywords)
+        loop = timeit.timeit(lambda: [loop_check(keywords, m) for m in messages], number=1) / MESSAGE_COUNT * 1e6
+        automaton = timeit.timeit(lambda: [matcher.search(m) for m in messages], number=1) / MESSAGE_COUNT * 1e6
+        print(f"{size:>8} {build:>10.1f} {loop:>12.1f} {automaton:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""启动耗时基准：python -X importtime 的模块导入耗时，以及机器人角色从启动进程到第一次拉取更新（getUpdates）的耗时
+
+用法：python benchmarks/bench_startup.py [--runs 3] [--record] [--revision REV]
+在临时目录中运行 app.py 的副本（不在仓库内产生数据目录）；Bot API 请求在子进程内被替换为本地应答，不需要网络。
+导入耗时在 app.py 已编译为 .pyc 后测量（与部署后重启一致）；首次拉取按 python app.py 启动，包含编译 app.py 的时间。
+--record 把结果追加到本机的 benchmarks/startup_history.jsonl（首次运行时创建，不纳入版本库：耗时只在同一台机器上可比），
+用于跟踪每次提交的变化；工作区 app.py 有未提交的修改时不记录。--revision 测量指定提交的 app.py。
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HISTORY_FILE = os.path.join(REPO_DIR, "benchmarks", "startup_history.jsonl")
+
+# 子进程驱动：替换 python-telegram-bot 的 HTTP 请求，收到第一个 getUpdates 时输出时间戳并退出
+FIRST_POLL_DRIVER = r"""
+import os, runpy, sys, time
+from telegram.utils.request import Request
+
+def post(self, url, data=None, timeout=None):
+    method = url.rsplit("/", 1)[-1]
+    if method == "getUpdates":
+        print(f"FIRST_POLL {time.time()}", flush=True)
+        os._exit(0)
+    if method == "getMe":
+        return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+    return True
+
+Request.post = post
+sys.argv = ["app.py", "--role", "bot"]
+runpy.run_path("app.py", run_name="__main__")
+"""
+
+
+def bench_env():
+    env = dict(os.environ)
+    env.update({"API_ID": "1", "API_HASH": "bench", "BOT_TOKEN": "123456:bench-token", "BOT_MODE": "polling"})
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    return env
+
+
+def prepare_workdir(revision=None):
+    workdir = tempfile.mkdtemp(prefix="bench-startup-")
+    for name in ("app.py", "banned_keywords.txt"):
+        if revision:
+            content = subprocess.run(["git", "show", f"{revision}:{name}"], cwd=REPO_DIR,
+                                     capture_output=True, check=name == "app.py").stdout
+            with open(os.path.join(workdir, name), "wb") as f:
+                f.write(content)
+        elif os.path.exists(os.path.join(REPO_DIR, name)):
+            shutil.copy(os.path.join(REPO_DIR, name), workdir)
+    # 预先编译（不导入，避免导入时的副作用在测量前发生）
+    subprocess.run([sys.executable, "-m", "py_compile", "app.py"], cwd=workdir, env=bench_env(), check=True)
+    return workdir
+
+
+def measure_import(workdir):
+    """返回 (import app 累计耗时ms, 导入时产生的文件/目录, 最耗时的直接依赖)"""
+    before = set(os.listdir(workdir))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"],
+                            cwd=workdir, env=bench_env(), capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr[-2000:])
+    created = sorted(set(os.listdir(workdir)) - before - {"__pycache__"})
+    # importtime 先输出子模块再输出父模块：app 之前、上一个顶层模块之后的第一层模块即 app 的直接依赖
+    total, children, pending = None, [], []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not name.startswith("   "):
+            if name.strip() == "app":
+                total, children = int(cumulative) / 1000, pending
+            pending = []
+        elif not name.startswith("     "):
+            pending.append((int(cumulative) / 1000, name.strip()))
+    heaviest = [f"{name} {ms:.0f}ms" for ms, name in sorted(children, reverse=True)[:5]]
+    return total, created, heaviest
+
+
+def measure_first_poll(workdir):
+    started = time.time()
+    result = subprocess.run([sys.executable, "-c", FIRST_POLL_DRIVER], cwd=workdir, env=bench_env(),
+                            capture_output=True, text=True, timeout=120)
+    for line in result.stdout.splitlines():
+        if line.startswith("FIRST_POLL "):
+            return (float(line.split()[1]) - started) * 1000
+    raise RuntimeError(result.stdout[-1000:] + result.stderr[-2000:])
+
+
+def git_revision(revision=None):
+    if revision:
+        return subprocess.run(["git", "rev-parse", "--short", revision], cwd=REPO_DIR,
+                              capture_output=True, text=True).stdout.strip() or revision
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                                  capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--", "app.py"], cwd=REPO_DIR,
+                               capture_output=True, text=True).stdout.strip()
+        return revision + ("-dirty" if dirty else "")
+    except OSError:
+        return "unknown"
+
+
+def last_record():
+    if not os.path.exists(HISTORY_FILE):
+        return None
+    with open(HISTORY_FILE, "r", encoding="utf-8") as f:
+        lines = [line for line in f if line.strip()]
+    return json.loads(lines[-1]) if lines else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="启动耗时基准")
+    parser.add_argument("--runs", type=int, default=3, help="重复次数，取中位数")
+    parser.add_argument("--record", action="store_true", help="追加到 benchmarks/startup_history.jsonl")
+    parser.add_argument("--revision", help="测量指定提交（git 版本号）的 app.py，默认为工作区")
+    args = parser.parse_args()
+
+    revision = git_revision(args.revision)
+    if args.record and revision.endswith("-dirty"):
+        parser.error("app.py 有未提交的修改，结果无法对应到提交，不记录（提交后再运行，或用 --revision 测量已有提交）")
+
+    workdir = prepare_workdir(args.revision)
+    try:
+        imports = [measure_import(workdir) for _ in range(args.runs)]
+        first_polls = [measure_first_poll(workdir) for _ in range(args.runs)]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    record = {
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "revision": revision,
+        "python": platform.python_version(),
+        "import_ms": round(statistics.median(total for total, _, _ in imports), 1),
+        "first_poll_ms": round(statistics.median(first_polls), 1),
+        "import_side_effects": imports[0][1],
+        "heaviest_imports": imports[0][2],
+    }
+    previous = last_record()
+    print(f"import app：{record['import_ms']}ms（-X importtime 累计，{args.runs}次中位数）")
+    print(f"机器人角色启动到第一次 getUpdates：{record['first_poll_ms']}ms")
+    print(f"导入时产生的文件/目录：{record['import_side_effects'] or '无'}")
+    print(f"最耗时的直接依赖：{', '.join(record['heaviest_imports'])}")
+    if previous:
+        print(f"上次记录（{previous['revision']}，{previous['time']}）："
+              f"import {previous['import_ms']}ms，首次拉取 {previous['first_poll_ms']}ms")
+    if args.record:
+        with open(HISTORY_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""任务查找微基准：对比逐用户线性查找与 task_index 反向索引
+
+用法：python benchmarks/bench_task_index.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("API_ID", "0")
+
+import app  # noqa: E402
+
+TASKS_PER_USER = 20
+SIZES = [1_000, 10_000, 100_000]
+LOOKUPS = 2_000
+
+
+def linear_find(task_id):
+    """旧实现：遍历所有用户的任务字典"""
+    for uid, tasks in app.user_tasks.items():
+        if task_id in tasks:
+            return uid, tasks[task_id]
+    return None, None
+
+
+def fill_tasks(total):
+    """构造 total 个任务（仅写内存，不落盘）"""
+    app.user_tasks.clear()
+    for i in range(total):
+        user_id = str(100000 + i // TASKS_PER_USER)
+        app.user_tasks.setdefault(user_id, {})[f"text_{user_id}_{i}"] = {"type": "text", "chat_id": "-1", "text": "x"}
+    app.rebuild_task_index()
+
+
+def main():
+    print(f"{'任务数':>10} {'线性查找(us)':>14} {'索引查找(us)':>14}")
+    for total in SIZES:
+        fill_tasks(total)
+        # 取最后一个用户的任务，线性查找的最坏情况
+        last_user = str(100000 + (total - 1) // TASKS_PER_USER)
+        task_id = next(iter(app.user_tasks[last_user]))
+        linear = timeit.timeit(lambda: linear_find(task_id), number=LOOKUPS) / LOOKUPS * 1e6
+        indexed = timeit.timeit(lambda: app.find_task(task_id), number=LOOKUPS) / LOOKUPS * 1e6
+        print(f"{total:>10} {linear:>14.3f} {indexed:>14.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""本地 webhook 测试：向Web服务的 webhook 路由投递伪造的 Telegram 更新，统计响应状态与延迟
+
+用法：python benchmarks/post_fake_update.py [--url URL] [--text /start | --callback add_task]
+                                          [--user-id ID] [--count N] [--concurrency N]
+校验令牌读取 .env 中的 WEBHOOK_SECRET（服务端需 BOT_MODE=webhook）。
+处理器回复消息需要真实的 BOT_TOKEN 与 user_id，否则只验证校验与入队；--count 较大时可观察队列满后的503。
+"""
+import argparse
+import itertools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from dotenv import load_dotenv
+
+load_dotenv()
+
+_update_ids = itertools.count(int(time.time()) * 1000)
+
+
+def fake_message(user_id, text):
+    message = {
+        "message_id": next(_update_ids) % 1_000_000,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Test"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return message
+
+
+def fake_update(user_id, text=None, callback=None):
+    """构造 message 更新，或指定 callback 时构造按钮回调更新"""
+    update_id = next(_update_ids)
+    if callback is None:
+        return {"update_id": update_id, "message": fake_message(user_id, text)}
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": {"id": user_id, "is_bot": False, "first_name": "Test"},
+            "chat_instance": "fake",
+            "data": callback,
+            "message": fake_message(user_id, "菜单"),
+        },
+    }
+
+
+def post(session, url, secret, update):
+    started = time.perf_counter()
+    response = session.post(url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": secret}, timeout=10)
+    return response.status_code, (time.perf_counter() - started) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="向 webhook 路由投递伪造的 Telegram 更新")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{os.getenv('FLASK_PORT', 5000)}/telegram/webhook")
+    parser.add_argument("--secret", default=os.getenv("WEBHOOK_SECRET", ""))
+    parser.add_argument("--user-id", type=int, default=123456789)
+    parser.add_argument("--text", default="/start")
+    parser.add_argument("--callback", help="按钮回调数据（如 add_task），指定时发送回调更新")
+    parser.add_argument("--count", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=1)
+    args = parser.parse_args()
+
+    session = requests.Session()
+    updates = [fake_update(args.user_id, args.text, args.callback) for _ in range(args.count)]
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(lambda update: post(session, args.url, args.secret, update), updates))
+
+    statuses = {}
+    for status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    latencies = sorted(latency for _, latency in results)
+    pick = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+    print(f"状态码：{statuses}")
+    print(f"延迟(ms)：p50 {pick(50):.1f}  p90 {pick(90):.1f}  p99 {pick(99):.1f}  max {latencies[-1]:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+# gunicorn 配置（Web角色）：python app.py --role web，或 gunicorn -c gunicorn.conf.py 'app:create_app()'
+import os
+import sys
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+bind = f"{os.getenv('FLASK_HOST', '0.0.0.0')}:{os.getenv('FLASK_PORT', 5000)}"
+workers = int(os.getenv("WEB_WORKERS", 2))
+threads = int(os.getenv("WEB_THREADS", 4))
+worker_class = "gthread"          # 线程模式：慢速上传只占用一个线程
+timeout = 120
+graceful_timeout = int(os.getenv("SHUTDOWN_TIMEOUT", 30))  # SIGTERM 后等待进行中请求完成的秒数
+# 不预加载：每个工作进程各自调用 create_app()，SQLite 连接与后台线程（审计日志写入等）不会跨 fork 共享
+preload_app = False
+accesslog = "-"
+
+if os.getenv("BOT_MODE", "polling") == "webhook":
+    # 机器人 dispatcher 与按钮交互状态在工作进程内存中，webhook 模式只能有一个工作进程（用线程提高并发）
+    workers = 1
+
+
+def post_worker_init(worker):
+    sys.modules["app"].start_webhook_dispatcher()
+
+
+def worker_exit(server, worker):
+    app_module = sys.modules.get("app")
+    if app_module is not None:
+        app_module.stop_webhook_dispatcher()